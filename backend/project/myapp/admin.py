@@ -25,7 +25,10 @@ from .models import (
     BusRuntimeData,
     CarRuntimeData,
     BikeRuntimeData,
-    BookingRequest
+    BookingRequest,
+    Place,
+    CheckpointEvent,
+    Alert
     
 )
 
@@ -48,4 +51,7 @@ admin.site.register(CarRoute)
 admin.site.register(BikeRoute)
 admin.site.register(BusCheckpoint)
 admin.site.register(BookingRequest)
+admin.site.register(Place)
+admin.site.register(CheckpointEvent)
+admin.site.register(Alert)
 
@@ -0,0 +1,386 @@
+"""
+Tick-based fan-out of live location updates.
+
+Consumers hand every accepted fix to the broadcaster instead of calling
+``group_send`` themselves. Fixes are coalesced per group and per vehicle,
+and once per tick each group with pending changes gets a single delta frame.
+Frames are encoded here, once per wire format, and the encoded text and
+bytes travel through the channel layer so consumers forward them without
+re-encoding per subscriber.
+
+Subscribers that asked for a slower update interval join the groups of an
+interval tier (``location.bus-2000ms``). Those groups keep coalescing between
+their flushes, so a 10 s dashboard gets one merged frame every 10 s, still
+encoded once for everyone on that tier.
+
+Only groups with a subscriber on some worker (see ``myapp.subscriptions``)
+are queued for at all, and each tick's frames go out concurrently.
+
+Each group also keeps a short history of which vehicles its recent frames
+touched, so a client reconnecting with the seqs it last saw can be caught
+up with just those vehicles instead of a full snapshot. A group with no
+subscribers for longer than the resume window is forgotten; if it is
+subscribed to again its seqs carry on past any it handed out before, so a
+client holding an old seq gets a snapshot.
+"""
+import asyncio
+import logging
+import time
+import uuid
+from collections import deque
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from .position_store import position_store
+from .subscriptions import subscriptions
+from .vehicle_details import vehicle_details
+from .wire import encode_binary, encode_json
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BROADCAST_INTERVAL_MS = 500
+# Update intervals subscribers can get besides every tick; requests are
+# rounded up to the next tier so subscribers share frames.
+DEFAULT_UPDATE_INTERVAL_TIERS_MS = (1000, 2000, 5000, 10000)
+DEFAULT_MAX_UPDATE_INTERVAL_MS = 10000
+# How often the store is swept for vehicles that stopped reporting.
+SWEEP_INTERVAL_SECONDS = 1
+# Frames per group a reconnecting client can be caught up across.
+DEFAULT_RESUME_HISTORY_FRAMES = 120
+# How long a group's history outlives its last subscriber.
+DEFAULT_RESUME_WINDOW_SECONDS = 60
+
+
+def _tier_suffix(tier):
+    # Tier None is the every-tick stream and keeps the plain group names
+    return f"-{tier}ms" if tier else ""
+
+
+def location_group(vehicle_type, tier=None):
+    """Broadcast group carrying every live position of one vehicle type."""
+    return f"location.{vehicle_type}{_tier_suffix(tier)}"
+
+
+def cell_group(vehicle_type, cell, tier=None):
+    """Broadcast group carrying live positions of one type in one grid cell."""
+    row, col = cell
+    return f"location.{vehicle_type}.{row}_{col}{_tier_suffix(tier)}"
+
+
+class LocationBroadcaster:
+    """Coalesces position changes and emits one frame per group per tick."""
+
+    def __init__(self, store, interval_ms=None, channel_layer=None, details=vehicle_details,
+                 subscriptions=subscriptions):
+        if interval_ms is None:
+            interval_ms = getattr(
+                settings, "LOCATION_BROADCAST_INTERVAL_MS", DEFAULT_BROADCAST_INTERVAL_MS
+            )
+        self.interval = interval_ms / 1000
+        self.max_update_interval_ms = getattr(
+            settings, "LOCATION_MAX_UPDATE_INTERVAL_MS", DEFAULT_MAX_UPDATE_INTERVAL_MS
+        )
+        # interval tier (ms) -> flush every this many ticks
+        self.tiers = {
+            tier: max(1, round(tier / interval_ms))
+            for tier in getattr(
+                settings, "LOCATION_UPDATE_INTERVAL_TIERS_MS", DEFAULT_UPDATE_INTERVAL_TIERS_MS
+            )
+            if interval_ms < tier <= self.max_update_interval_ms
+        }
+        self.history_size = getattr(
+            settings, "LOCATION_RESUME_HISTORY_FRAMES", DEFAULT_RESUME_HISTORY_FRAMES
+        )
+        self.resume_window = getattr(
+            settings, "LOCATION_RESUME_WINDOW_SECONDS", DEFAULT_RESUME_WINDOW_SECONDS
+        )
+        self._ticks = 0
+        self.store = store
+        self.details = details
+        self.subscriptions = subscriptions
+        # Defaults to the project channel layer, looked up on each flush
+        self.channel_layer = channel_layer
+        # Every worker process runs its own broadcaster, so frame sequences
+        # are only comparable within one stream.
+        self.stream_id = uuid.uuid4().hex[:12]
+        # group -> (cell or None, ticks between flushes, {position key:
+        # VehiclePosition}); records are updated in place by the store so a
+        # flush sends the latest fix.
+        self._pending = {}
+        # Frame sequence per group. Each frame carries its stream, its own
+        # seq and the one before it so clients can detect a missed frame.
+        # A group gets an entry once it has a subscriber; only those groups
+        # are published to.
+        self._frame_seq = {}
+        # Seqs of groups created from here on start above every seq handed
+        # out by a group that has been forgotten.
+        self._seq_floor = 0
+        # group -> when it last had a subscriber (monotonic)
+        self._last_watched = {}
+        # group -> [{id, vehicle_type}] of vehicles that went offline
+        self._offline = {}
+        # group -> deque of (seq, position keys) for its recent frames.
+        # Vehicles going offline after frame n are filed under n + 0.5.
+        self._history = {}
+        # group -> newest seq dropped from its history
+        self._history_floor = {}
+        self._last_sweep = 0
+        # Called with each vehicle the sweep expires
+        self._expiry_callbacks = []
+        self._task = None
+
+    def tier_for(self, update_interval_ms):
+        """
+        Interval tier serving a requested update interval: None for every
+        tick, otherwise the smallest tier at least as slow as requested.
+        """
+        if not update_interval_ms:
+            return None
+        requested = min(float(update_interval_ms), self.max_update_interval_ms)
+        if requested <= self.interval * 1000:
+            return None
+        for tier in sorted(self.tiers):
+            if tier >= requested:
+                return tier
+        return max(self.tiers, default=None)
+
+    def tier_interval_ms(self, tier):
+        return tier or round(self.interval * 1000)
+
+    def watch(self, groups):
+        """Register a subscriber to these groups so fixes are published to them."""
+        self.subscriptions.add(groups)
+        for group in groups:
+            self.activate(group)
+
+    def unwatch(self, groups):
+        self.subscriptions.discard(groups)
+
+    async def sync_subscriptions(self):
+        """Pick up groups subscribed to on other workers."""
+        await self.subscriptions.sync()
+        for group in self.subscriptions.groups():
+            self.activate(group)
+
+    def activate(self, group):
+        if group not in self._frame_seq:
+            self._frame_seq[group] = self._history_floor[group] = self._seq_floor
+            self._last_watched[group] = time.monotonic()
+
+    def prune_groups(self, now=None):
+        """Forget groups nobody has subscribed to for longer than the resume window."""
+        if now is None:
+            now = time.monotonic()
+        for group in list(self._frame_seq):
+            if group in self.subscriptions:
+                self._last_watched[group] = now
+            elif now - self._last_watched.get(group, now) > self.resume_window:
+                self._seq_floor = max(self._seq_floor, self._frame_seq.pop(group) + 1)
+                self._last_watched.pop(group, None)
+                self._history.pop(group, None)
+                self._history_floor.pop(group, None)
+                self._pending.pop(group, None)
+                self._offline.pop(group, None)
+
+    def publish(self, group, position, cell=None, every=1):
+        """Queue a changed position for the next flush of one group."""
+        if group not in self._frame_seq:
+            return  # Nobody has subscribed to this group
+        pending = self._pending.get(group)
+        if pending is None:
+            pending = self._pending[group] = (cell, every, {})
+        pending[2][position.key] = position
+        self.ensure_started()
+
+    def publish_position(self, position):
+        """Queue a fix for its type and cell groups on every interval tier."""
+        # The tick writes the fix behind to shared state even when no group
+        # here has a subscriber
+        self.ensure_started()
+        vehicle_type = position.vehicle_type
+        moved = position.prev_cell is not None and position.prev_cell != position.cell
+        for tier, every in ((None, 1), *self.tiers.items()):
+            self.publish(location_group(vehicle_type, tier), position, every=every)
+            self.publish(
+                cell_group(vehicle_type, position.cell, tier), position, position.cell, every
+            )
+            if moved:
+                # Subscribers of the old cell are told the vehicle left
+                self.publish(
+                    cell_group(vehicle_type, position.prev_cell, tier),
+                    position, position.prev_cell, every,
+                )
+
+    def publish_offline(self, position):
+        """Queue a vehicle_offline event for every group that carried the vehicle."""
+        vehicle = {"id": position.id, "vehicle_type": position.vehicle_type}
+        for tier in (None, *self.tiers):
+            for group in (
+                location_group(position.vehicle_type, tier),
+                cell_group(position.vehicle_type, position.cell, tier),
+            ):
+                if group not in self._frame_seq:
+                    continue
+                self._offline.setdefault(group, []).append(vehicle)
+                self.remember(group, self.current_frame_seq(group) + 0.5, (position.key,))
+                pending = self._pending.get(group)
+                if pending is not None:
+                    pending[2].pop(position.key, None)
+        self.ensure_started()
+
+    def on_expire(self, callback):
+        """Have ``callback(position)`` awaited for every vehicle the sweep expires."""
+        self._expiry_callbacks.append(callback)
+
+    async def sweep(self):
+        """Evict vehicles past their TTL and announce them offline."""
+        self._last_sweep = time.monotonic()
+        # Copies of vehicles reported to other workers only get fresh
+        # deadlines when refreshed, so bring them up to date first
+        await self.store.refresh(force=True)
+        expired = self.store.expire()
+        for position in expired:
+            self.publish_offline(position)
+        for position in expired:
+            for callback in self._expiry_callbacks:
+                try:
+                    await callback(position)
+                except Exception:
+                    logger.exception("Expiry callback failed for %s %s", position.vehicle_type, position.id)
+
+    def ensure_started(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def current_frame_seq(self, group):
+        return self._frame_seq.get(group, 0)
+
+    def next_frame_seq(self, group):
+        prev_seq = self._frame_seq.get(group, 0)
+        self._frame_seq[group] = prev_seq + 1
+        return prev_seq, prev_seq + 1
+
+    def remember(self, group, seq, keys):
+        history = self._history.get(group)
+        if history is None:
+            history = self._history[group] = deque()
+        history.append((seq, keys))
+        if len(history) > self.history_size:
+            self._history_floor[group] = history.popleft()[0]
+
+    def changed_since(self, group, seq):
+        """
+        Keys of the vehicles a group's frames after ``seq`` touched, or None
+        when its history no longer reaches back that far or the group has
+        no history here (never subscribed, or forgotten).
+        """
+        if group not in self._frame_seq:
+            return None
+        if not self._history_floor[group] <= seq <= self._frame_seq[group]:
+            return None
+        return {key for entry_seq, keys in self._history.get(group, ()) if entry_seq > seq for key in keys}
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                if time.monotonic() - self._last_sweep >= SWEEP_INTERVAL_SECONDS:
+                    await self.sync_subscriptions()
+                    self.prune_groups()
+                    await self.sweep()
+                await self.flush()
+            except Exception:
+                logger.exception("Location broadcast tick failed")
+
+    def encode(self, frame):
+        """Serialize a frame as JSON; called once per group per tick."""
+        return encode_json(frame)
+
+    def encode_binary(self, frame):
+        """Pack a frame for binary subscribers; None falls back to JSON."""
+        return encode_binary(frame)
+
+    def event(self, frame, **extra):
+        return {
+            "type": frame["type"],
+            **extra,
+            "text": self.encode(frame),
+            "bytes": self.encode_binary(frame),
+        }
+
+    async def flush(self):
+        """
+        Send one coalesced delta frame to every group due this tick, then
+        write the tick's changes behind to shared state.
+        """
+        self._ticks += 1
+        if self._pending or self._offline:
+            await self.fan_out()
+        # Every change is written, fanned out here or not: other workers
+        # serve snapshots, nearest lookups and ETAs from it
+        await self.store.sync()
+
+    async def fan_out(self):
+        pending = {}
+        waiting = {}
+        for group, entry in self._pending.items():
+            if self._ticks % entry[1]:
+                waiting[group] = entry  # Slower tier, keeps coalescing
+            else:
+                pending[group] = entry
+        self._pending = waiting
+        offline, self._offline = self._offline, {}
+        channel_layer = self.channel_layer or get_channel_layer()
+        # Vehicle details come from the cache, so this rarely touches the DB
+        await self.details.attach({
+            key: position
+            for _, _, positions in pending.values()
+            for key, position in positions.items()
+        }.values())
+        await asyncio.gather(*(
+            channel_layer.group_send(group, self.event({
+                "type": "vehicle_offline",
+                "data": vehicles,
+            }))
+            for group, vehicles in offline.items()
+        ))
+        sends = []
+        for group, (cell, _, positions) in pending.items():
+            data = []
+            removed = []
+            for position in positions.values():
+                if cell is None or position.cell == cell:
+                    data.append(position)
+                else:
+                    # Moved out of this group's cell since it was queued
+                    removed.append({"id": position.id, "vehicle_type": position.vehicle_type})
+            if not data and not removed:
+                continue  # Everything queued here went offline
+            prev_seq, seq = self.next_frame_seq(group)
+            self.remember(group, seq, tuple(position.key for position in positions.values()))
+            frame = {
+                "type": "batch_location_update",
+                "mode": "delta",
+                "group": group,
+                "stream": self.stream_id,
+                "seq": seq,
+                "prev_seq": prev_seq,
+                "data": data,
+                "removed": removed,
+            }
+            sends.append(channel_layer.group_send(group, self.event(frame, group=group, seq=seq)))
+        await asyncio.gather(*sends)
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+# Process-wide broadcaster shared by every consumer instance.
+broadcaster = LocationBroadcaster(position_store)
@@ -15,3 +15,12 @@ def get_role_choices():
     """Returns list of role values for use in ChoiceField."""
     return [choice[0] for choice in ROLE_CHOICES]
 
+
+
+# Vehicle types that can report live locations. Each has its own
+# broadcast group so subscribers only receive the type they asked for.
+VEHICLE_TYPES = ["bus", "car", "bike"]
+
+# Compact codes used where vehicle types are stored per row (location history).
+VEHICLE_TYPE_CODES = {"bus": 1, "car": 2, "bike": 3}
+VEHICLE_TYPE_CHOICES = [(code, name) for name, code in VEHICLE_TYPE_CODES.items()]
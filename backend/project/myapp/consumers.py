@@ -1,62 +1,552 @@
 import json
+import logging
+import math
 from channels.generic.websocket import AsyncWebsocketConsumer
+from django.conf import settings
+from .broadcaster import broadcaster, cell_group, location_group
+from .constants import VEHICLE_TYPES
+from .deviation import ALERTS_GROUP
+from .eta import eta_engine
+from .fleet_auth import ANONYMOUS
+from .geofence import checkpoint_group
+from .geo import bbox_around, bbox_cell_count, cells_in_bbox
+from .ingest import fix_ingestor, normalize_vehicle_type, parse_batch, parse_coordinates
+from .nearest import find_nearest, parse_nearest_query
+from .position_store import position_store
+from .reporting_rate import MOVING, reporting_rate
+from .send_queue import SendQueue
+from .vehicle_details import vehicle_details
+from .wire import BINARY_SUBPROTOCOL, encode_binary, encode_json
+
+logger = logging.getLogger(__name__)
+
+REQUIRED_FIX_FIELDS = ('id', 'vehicle_type', 'latitude', 'longitude')
+
+DEFAULT_MAX_SUBSCRIBED_CELLS = 256
+# Checkpoints one socket may watch ETAs for at a time
+MAX_WATCHED_CHECKPOINTS = 20
+
+
+def parse_area(data):
+    """
+    Bounding box (south, west, north, east) of the area in a
+    subscribe/viewport message, or None when the message asks for the whole
+    fleet. Raises ValueError for a point off the map or a bad radius.
+
+    Accepts either ``viewport: {north, south, east, west}`` or a centre point
+    (``latitude``/``longitude`` or ``lat``/``lng``) with ``radius_km``.
+    """
+    viewport = data.get('viewport')
+    if viewport:
+        south, west = parse_coordinates(viewport['south'], viewport['west'])
+        north, east = parse_coordinates(viewport['north'], viewport['east'])
+        return south, west, north, east
+    if data.get('radius_km') is not None:
+        lat, lng = parse_coordinates(
+            data.get('latitude', data.get('lat')),
+            data.get('longitude', data.get('lng')),
+        )
+        radius_km = float(data['radius_km'])
+        if not (math.isfinite(radius_km) and radius_km > 0):
+            raise ValueError("radius_km must be a positive number")
+        return bbox_around(lat, lng, radius_km)
+    return None
+
+
+class FleetLocationConsumer(AsyncWebsocketConsumer):
+    """
+    Live location stream for drivers and riders.
+
+    Callers authenticate once at connect (see ``myapp.fleet_auth``). Drivers
+    may only send fixes for themselves, and get ``reporting_rate`` messages
+    telling their app how often to send them (see ``myapp.reporting_rate``).
+    Subscribers send ``{"type": "subscribe", "vehicle_type": ...}`` and
+    only receive updates for that vehicle type, optionally narrowed to a
+    viewport or radius (see ``parse_area``). A ``{"type": "viewport", ...}``
+    message moves an area subscription, and ``{"type": "nearest", ...}``
+    asks for the k closest live vehicles. ``update_interval`` (ms) on
+    subscribe slows the socket's stream down to the nearest interval tier
+    the broadcaster serves, and ``since`` (the seqs a reconnecting client
+    last saw) gets it just what it missed instead of a snapshot.
+
+    Clients that offer the ``fleet.binary.v1`` subprotocol receive location
+    frames as packed binary messages (see ``myapp.wire``); JSON otherwise.
+
+    Broadcast frames go out through a bounded per-connection SendQueue, so a
+    slow socket is resynced or dropped instead of backing up the channel
+    layer. ``{"type": "stats"}`` returns the connection's queue metrics.
+    """
+
+    # Live positions are held in a keyed store shared by all consumers
+    store = position_store
+    broadcaster = broadcaster
+    # Fixes go through the same path as HTTP uploads (see myapp.ingest)
+    ingestor = fix_ingestor
+    details = vehicle_details
+    eta = eta_engine
+    reporting = reporting_rate
 
-class BikeLocationConsumer(AsyncWebsocketConsumer):
-    groups = ["location_updates"]
-    
-    # Class-level storage for recent updates
-    recent_updates = []  # Now using a list to store all updates
-    
     async def connect(self):
-        await self.accept()
-        await self.channel_layer.group_add("location_updates", self.channel_name)
+        # Resolved once by JWTAuthMiddleware; None means the token was rejected
+        self.identity = self.scope.get("fleet_identity", ANONYMOUS)
+        if self.identity is None or (
+            self.identity is ANONYMOUS and not getattr(settings, "LOCATION_WS_ALLOW_ANONYMOUS", True)
+        ):
+            self.identity = None
+            await self.close()
+            return
+        self.vehicle_type = None
+        self.cells = None
+        # Update interval tier of the subscription; None is every tick
+        self.tier = None
+        self.subscribed_groups = set()
+        # Vehicles this socket has reported fixes for
+        self.reported = set()
+        # position key -> reporting mode this socket's app was last told
+        self.report_modes = {}
+        # Checkpoints this socket receives eta_update frames for
+        self.eta_checkpoints = set()
+        # checkpoint.<id> groups joined for arrival/departure events
+        self.checkpoint_groups = set()
+        # Whether this socket follows the off-route alerts feed
+        self.alerts = False
+        self.binary = BINARY_SUBPROTOCOL in self.scope.get("subprotocols", ())
+        self.queue = SendQueue(self.forward, self.send_snapshot, self.close, name=self.channel_name)
+        self.queue.start()
+        # The broadcaster loop also sweeps out vehicles that went quiet
+        self.broadcaster.ensure_started()
+        await self.accept(BINARY_SUBPROTOCOL if self.binary else None)
         await self.send(json.dumps({
             "type": "connection_established",
             "message": "You are now connected!",
-            "data": self.recent_updates  # Send existing data immediately
+            "vehicle_types": VEHICLE_TYPES,
+            "format": "binary" if self.binary else "json",
         }))
 
-    async def receive(self, text_data):
+    async def receive(self, text_data=None, bytes_data=None):
+        if text_data is None:
+            # Binary is a downstream format only; clients always send JSON
+            await self.send_error("Expected a JSON text message")
+            return
         try:
             data = json.loads(text_data)
-            print("📩 Received data:", data)
-            
+            logger.debug("Received data: %s", data)
+            if not isinstance(data, dict):
+                await self.send_error("Expected a JSON object")
+                return
+
+            # The rider page sends "type", the driver app sends "action"
+            message_type = data.get('type') or data.get('action')
+            if message_type == 'subscribe':
+                await self.subscribe(data)
+                return
+            if message_type == 'viewport':
+                await self.move_area(data)
+                return
+            if message_type == 'unsubscribe':
+                await self.unsubscribe()
+                return
+            if message_type == 'resync':
+                await self.send_snapshot()
+                return
+            if message_type == 'nearest':
+                await self.send_nearest(data)
+                return
+            if message_type == 'eta_subscribe':
+                await self.watch_eta(data)
+                return
+            if message_type == 'eta_unsubscribe':
+                self.unwatch_eta(data.get('checkpoint'))
+                return
+            if message_type in ('checkpoint_subscribe', 'checkpoint_unsubscribe'):
+                await self.follow_checkpoint(data, message_type == 'checkpoint_subscribe')
+                return
+            if message_type in ('alerts_subscribe', 'alerts_unsubscribe'):
+                await self.follow_alerts(message_type == 'alerts_subscribe')
+                return
+            if message_type == 'fixes':
+                await self.receive_batch(data)
+                return
+            if message_type == 'stats':
+                await self.send(json.dumps({"type": "stats", "data": self.queue.stats()}))
+                return
+
             # Validate incoming data
-            if all(key in data for key in ['id', 'vehicle_type', 'latitude', 'longitude']):
-                # Update existing entry if id exists, otherwise append
-                existing_index = next(
-                    (i for i, item in enumerate(self.recent_updates) 
-                     if item['id'] == data['id']), 
-                    None
-                )
-                
-                if existing_index is not None:
-                    self.recent_updates[existing_index] = data
-                else:
-                    self.recent_updates.append(data)
-                
-                # Always broadcast the complete array
-                await self.channel_layer.group_send(
-                    "location_updates",
-                    {
-                        "type": "batch_location_update",
-                        "data": self.recent_updates
-                    }
+            if all(key in data for key in REQUIRED_FIX_FIELDS):
+                vehicle_type = normalize_vehicle_type(data['vehicle_type'])
+                if vehicle_type is None:
+                    await self.send_error(f"Unknown vehicle_type: {data['vehicle_type']}")
+                    return
+                if not self.identity.may_report(vehicle_type, data['id']):
+                    await self.send_error("Not allowed to report fixes for this vehicle")
+                    return
+                try:
+                    latitude, longitude = parse_coordinates(data['latitude'], data['longitude'])
+                except ValueError as e:
+                    await self.send_error(str(e))
+                    return
+
+                position = await self.ingestor.ingest(
+                    vehicle_type,
+                    data['id'],
+                    latitude,
+                    longitude,
+                    data.get('address'),
                 )
-                
+                self.reported.add(position.key)
+                await self.adapt_reporting_rate(position)
+
         except json.JSONDecodeError as e:
-            print(f"❌ JSON decode error: {str(e)}")
-            await self.send(json.dumps({
-                "error": "Invalid JSON format",
-                "details": str(e)
-            }))
+            logger.debug("JSON decode error: %s", e)
+            await self.send_error(f"Invalid JSON format: {e}")
 
-    async def batch_location_update(self, event):
-        """Handler for sending combined location updates"""
+    async def receive_batch(self, data):
+        """Ingest a batch of buffered fixes and acknowledge it."""
+        vehicle_type = normalize_vehicle_type(data.get('vehicle_type'))
+        if vehicle_type is None:
+            await self.send_error(f"Unknown vehicle_type: {data.get('vehicle_type')}")
+            return
+        if not self.identity.may_report(vehicle_type, data.get('id')):
+            await self.send_error("Not allowed to report fixes for this vehicle")
+            return
+        try:
+            fixes = parse_batch(data)
+        except ValueError as e:
+            await self.send_error(str(e))
+            return
+        position = await self.ingestor.ingest_batch(vehicle_type, data['id'], fixes)
+        if position is not None:
+            self.reported.add(position.key)
+            await self.adapt_reporting_rate(position)
+        # The app drops its buffer once the batch is acknowledged
+        await self.send(json.dumps({
+            "type": "fixes_ack",
+            "batch": data.get('batch'),
+            "accepted": len(fixes),
+        }))
+
+    def area_cells(self, data):
+        """Parse the requested area; None means the whole fleet of the type."""
+        bbox = parse_area(data)
+        if bbox is None:
+            return None
+        max_cells = getattr(settings, "LOCATION_MAX_SUBSCRIBED_CELLS", DEFAULT_MAX_SUBSCRIBED_CELLS)
+        # Counted before the cells are built: a world-sized box is millions
+        if bbox_cell_count(*bbox, self.store.cell_size) > max_cells:
+            # Very large areas are cheaper to serve from the type-wide group
+            return None
+        return cells_in_bbox(*bbox, self.store.cell_size)
+
+    def groups_for(self, vehicle_type, cells):
+        if cells is None:
+            return {location_group(vehicle_type, self.tier)}
+        return {cell_group(vehicle_type, cell, self.tier) for cell in cells}
+
+    async def subscribe(self, data):
+        """
+        Join the groups for the requested type and area, then catch the
+        client up from ``since`` or send a snapshot.
+        """
+        vehicle_type = normalize_vehicle_type(data.get('vehicle_type'))
+        if vehicle_type is None:
+            await self.send_error(f"Unknown vehicle_type: {data.get('vehicle_type')}")
+            return
+        try:
+            cells = self.area_cells(data)
+        except (KeyError, TypeError, ValueError):
+            await self.send_error("Invalid subscription area")
+            return
+        try:
+            tier = self.broadcaster.tier_for(data.get('update_interval'))
+        except (TypeError, ValueError):
+            await self.send_error("update_interval must be a number of milliseconds")
+            return
+
+        # One subscription per socket; a new one replaces the old
+        await self.unsubscribe()
+        self.vehicle_type = vehicle_type
+        self.cells = cells
+        self.tier = tier
+        await self.join(self.groups_for(vehicle_type, cells))
+        if not await self.send_missed(data.get('since')):
+            await self.send_snapshot()
+
+    async def move_area(self, data):
+        """Re-target an area subscription, joining and leaving only changed cells."""
+        if self.vehicle_type is None:
+            await self.send_error("Subscribe before sending a viewport")
+            return
+        try:
+            cells = self.area_cells(data)
+        except (KeyError, TypeError, ValueError):
+            await self.send_error("Invalid subscription area")
+            return
+        if cells is None or self.cells is None:
+            # Switching between area and type-wide: start over
+            await self.subscribe({
+                'update_interval': self.tier,
+                **data,
+                'vehicle_type': self.vehicle_type,
+            })
+            return
+
+        added = cells - self.cells
+        dropped = self.cells - cells
+        self.cells = cells
+        await self.leave(self.groups_for(self.vehicle_type, dropped))
+        await self.join(self.groups_for(self.vehicle_type, added))
+
+        await self.store.refresh()
+        positions = self.store.positions(self.vehicle_type, added)
+        await self.details.attach(positions)
+        await self.send_frame({
+            "type": "batch_location_update",
+            "mode": "extend",
+            "stream": self.broadcaster.stream_id,
+            "seqs": self.group_seqs(self.groups_for(self.vehicle_type, added)),
+            "data": positions,
+            "removed": [
+                {"id": position.id, "vehicle_type": position.vehicle_type}
+                for position in self.store.in_cells(self.vehicle_type, dropped)
+            ],
+        })
+
+    async def join(self, groups):
+        for group in groups:
+            await self.channel_layer.group_add(group, self.channel_name)
+        self.broadcaster.watch(groups)
+        self.subscribed_groups |= groups
+
+    async def leave(self, groups):
+        for group in groups:
+            await self.channel_layer.group_discard(group, self.channel_name)
+        self.broadcaster.unwatch(groups)
+        self.subscribed_groups -= groups
+
+    async def unsubscribe(self):
+        await self.leave(set(self.subscribed_groups))
+        self.vehicle_type = None
+        self.cells = None
+        self.tier = None
+
+    async def send_nearest(self, data):
+        """Answer a k-nearest-vehicles request; ``request_id`` is echoed back."""
+        try:
+            query = parse_nearest_query(data)
+        except ValueError as e:
+            await self.send_error(str(e))
+            return
         await self.send(json.dumps({
+            "type": "nearest_vehicles",
+            "request_id": data.get('request_id'),
+            "data": await find_nearest(self.store, query),
+        }))
+
+    async def watch_eta(self, data):
+        """Send a checkpoint's ETAs now and again after every ETA recompute."""
+        try:
+            checkpoint_id = int(data.get('checkpoint'))
+        except (TypeError, ValueError):
+            await self.send_error("checkpoint must be a checkpoint id")
+            return
+        if checkpoint_id not in self.eta_checkpoints and len(self.eta_checkpoints) >= MAX_WATCHED_CHECKPOINTS:
+            await self.send_error(f"At most {MAX_WATCHED_CHECKPOINTS} checkpoints can be watched")
+            return
+        self.eta_checkpoints.add(checkpoint_id)
+        # Updates go through the send queue like location frames
+        self.eta.watch(checkpoint_id, self.queue.put)
+        await self.eta.arrivals_for(checkpoint_id)
+        await self.send(encode_json(self.eta.frame(checkpoint_id)))
+
+    def unwatch_eta(self, checkpoint_id=None):
+        """Stop ETA updates for one checkpoint, or for all of them."""
+        if checkpoint_id is None:
+            checkpoint_ids = set(self.eta_checkpoints)
+        else:
+            try:
+                checkpoint_ids = {int(checkpoint_id)} & self.eta_checkpoints
+            except (TypeError, ValueError):
+                return
+        for checkpoint_id in checkpoint_ids:
+            self.eta.unwatch(checkpoint_id, self.queue.put)
+            self.eta_checkpoints.discard(checkpoint_id)
+
+    async def follow_checkpoint(self, data, follow):
+        """Join or leave a checkpoint's arrival/departure event group."""
+        try:
+            group = checkpoint_group(int(data.get('checkpoint')))
+        except (TypeError, ValueError):
+            await self.send_error("checkpoint must be a checkpoint id")
+            return
+        if follow:
+            if group not in self.checkpoint_groups and len(self.checkpoint_groups) >= MAX_WATCHED_CHECKPOINTS:
+                await self.send_error(f"At most {MAX_WATCHED_CHECKPOINTS} checkpoints can be watched")
+                return
+            await self.channel_layer.group_add(group, self.channel_name)
+            self.checkpoint_groups.add(group)
+        elif group in self.checkpoint_groups:
+            await self.channel_layer.group_discard(group, self.channel_name)
+            self.checkpoint_groups.discard(group)
+
+    async def adapt_reporting_rate(self, position):
+        """Tell the driver app to report less often while its vehicle is parked."""
+        mode = self.reporting.classify(position)
+        # Apps start out reporting at the moving interval
+        if self.report_modes.get(position.key, MOVING) != mode:
+            self.report_modes[position.key] = mode
+            await self.send(json.dumps(self.reporting.control_frame(position, mode)))
+
+    async def follow_alerts(self, follow):
+        """Join or leave the off-route alerts feed."""
+        if follow and not self.identity.is_staff:
+            await self.send_error("Only staff can follow alerts")
+            return
+        if follow and not self.alerts:
+            await self.channel_layer.group_add(ALERTS_GROUP, self.channel_name)
+        elif not follow and self.alerts:
+            await self.channel_layer.group_discard(ALERTS_GROUP, self.channel_name)
+        self.alerts = follow
+
+    async def send_missed(self, since):
+        """
+        Send a reconnecting client only the vehicles that changed after the
+        frames it last saw, given as ``{"<stream>/<group>": seq}``. Returns
+        False when that isn't possible: the client saw another worker's
+        stream, or a group's history has moved past its seq.
+        """
+        if not isinstance(since, dict) or not since:
+            return False
+        stream = self.broadcaster.stream_id
+        seqs = {}
+        for stream_group, seq in since.items():
+            seen_stream, _, group = str(stream_group).partition('/')
+            if seen_stream != stream:
+                return False
+            seqs[group] = seq
+        keys = set()
+        for group in self.subscribed_groups:
+            try:
+                changed = self.broadcaster.changed_since(group, int(seqs[group]))
+            except (KeyError, TypeError, ValueError):
+                return False
+            if changed is None:
+                return False
+            keys |= changed
+        # Taken with the history, so frames flushed from here on still apply
+        current_seqs = self.group_seqs(self.subscribed_groups)
+
+        await self.store.refresh()
+        positions = []
+        removed = []
+        for key in keys:
+            position = self.store.get(*key)
+            if position is not None and (self.cells is None or position.cell in self.cells):
+                positions.append(position)
+            else:
+                removed.append({"id": key[1], "vehicle_type": key[0]})
+        await self.details.attach(positions)
+        await self.send_frame({
             "type": "batch_location_update",
-            "data": event["data"]  # This is already an array
+            "mode": "extend",
+            "stream": stream,
+            "seqs": current_seqs,
+            "data": positions,
+            "removed": removed,
+        })
+        return True
+
+    def group_seqs(self, groups):
+        return {group: self.broadcaster.current_frame_seq(group) for group in groups}
+
+    def snapshot_frame(self):
+        """Subscription state tagged with this worker's stream and frame seqs."""
+        return {
+            "mode": "snapshot",
+            "stream": self.broadcaster.stream_id,
+            "seqs": self.group_seqs(self.subscribed_groups),
+            # Interval actually served after clamping to the server's tiers
+            "update_interval": self.broadcaster.tier_interval_ms(self.tier),
+            "data": self.store.positions(self.vehicle_type, self.cells),
+        }
+
+    async def send_snapshot(self):
+        if self.vehicle_type is None:
+            return
+        await self.store.refresh()
+        frame = self.snapshot_frame()
+        await self.details.attach(frame["data"])
+        await self.send_frame({
+            "type": "batch_location_update",
+            **frame
+        })
+
+    async def send_frame(self, frame):
+        """Encode a frame built for this socket alone in its negotiated format."""
+        if self.binary:
+            data = encode_binary(frame)
+            if data is not None:
+                await self.send(bytes_data=data)
+                return
+        await self.send(encode_json(frame))
+
+    async def forward(self, event):
+        """
+        Send a frame the broadcaster already encoded for every subscriber.
+        Returns the number of bytes written.
+        """
+        if self.binary and event.get("bytes") is not None:
+            await self.send(bytes_data=event["bytes"])
+            return len(event["bytes"])
+        await self.send(event["text"])
+        return len(event["text"])
+
+    async def send_error(self, message):
+        await self.send(json.dumps({
+            "type": "error",
+            "message": message,
         }))
 
+    async def batch_location_update(self, event):
+        """Handler for location deltas, already encoded once by the broadcaster"""
+        self.queue.put(event)
+
+    async def vehicle_offline(self, event):
+        """Handler for vehicles dropped after missing their TTL or signing off"""
+        self.queue.put(event)
+
+    async def checkpoint_event(self, event):
+        """Handler for arrivals at and departures from followed checkpoints"""
+        self.queue.put(event)
+
+    async def fleet_alert(self, event):
+        """Handler for vehicles leaving or rejoining their route"""
+        self.queue.put(event)
+
     async def disconnect(self, close_code):
-        await self.channel_layer.group_discard("location_updates", self.channel_name)
\ No newline at end of file
+        if self.identity is None:
+            # Refused at connect; nothing was set up
+            return
+        await self.queue.stop()
+        self.unwatch_eta()
+        for group in self.checkpoint_groups:
+            await self.channel_layer.group_discard(group, self.channel_name)
+        await self.follow_alerts(False)
+        await self.unsubscribe()
+        for key in self.reported:
+            if close_code == 1000:
+                # The driver closed the app on purpose. Dropped connections
+                # are left to the TTL so a quick reconnect doesn't flap the
+                # vehicle on the map.
+                position = self.store.remove(*key)
+                if position is not None:
+                    self.broadcaster.publish_offline(position)
+            else:
+                position = self.store.get(*key)
+            if position is not None:
+                # Tracking ends with the socket either way: a reconnect may
+                # land on another worker, which starts its own
+                await self.ingestor.sign_off(position)
+
+
+# Kept for existing imports; ws/bike/ serves every vehicle type.
+BikeLocationConsumer = FleetLocationConsumer
@@ -0,0 +1,125 @@
+"""
+Off-route alerts for live vehicles.
+
+Route matching already tells, fix by fix, whether a vehicle is inside its
+route's buffer. The detector adds hysteresis on top of that: a vehicle has
+to stay off route for LOCATION_OFF_ROUTE_CONFIRM_SECONDS before an alert is
+raised, and back well inside the buffer for as long before it is resolved,
+so a stray fix or a vehicle skirting the buffer edge doesn't flood operators.
+Alerts go to the ``alerts`` channel group and, in batches, to the Alert table.
+"""
+import logging
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from .persistence import ALERT_RAISE, ALERT_RESOLVE, alert_recorder
+from .route_matching import DEFAULT_ROUTE_MAX_OFFSET_KM
+from .wire import encode_json
+
+logger = logging.getLogger(__name__)
+
+ALERTS_GROUP = "alerts"
+DEFAULT_OFF_ROUTE_CONFIRM_SECONDS = 30
+# Back on route means within this fraction of the route buffer.
+REJOIN_OFFSET_FACTOR = 0.6
+
+
+class DeviationDetector:
+    """Raises and resolves off-route alerts from matched route progress."""
+
+    def __init__(self, recorder=alert_recorder, channel_layer=None, confirm_seconds=None,
+                 max_offset_km=None):
+        if confirm_seconds is None:
+            confirm_seconds = getattr(
+                settings, "LOCATION_OFF_ROUTE_CONFIRM_SECONDS", DEFAULT_OFF_ROUTE_CONFIRM_SECONDS
+            )
+        if max_offset_km is None:
+            max_offset_km = getattr(settings, "LOCATION_ROUTE_MAX_OFFSET_KM", DEFAULT_ROUTE_MAX_OFFSET_KM)
+        self.confirm_seconds = confirm_seconds
+        self.rejoin_km = max_offset_km * REJOIN_OFFSET_FACTOR
+        self.recorder = recorder
+        self.channel_layer = channel_layer
+        # position key -> [off route since, back on route since, alert raised]
+        self._excursions = {}
+
+    async def sign_off(self, position):
+        """Resolve the alert of a vehicle that went offline while off route."""
+        excursion = self._excursions.pop(position.key, None)
+        if excursion is None or not excursion[2]:
+            return None
+        await self.publish(position, ALERT_RESOLVE)
+        return ALERT_RESOLVE
+
+    def detect(self, position):
+        """
+        Update the vehicle's excursion from its latest fix and return
+        ALERT_RAISE, ALERT_RESOLVE or None.
+        """
+        progress = position.route
+        excursion = self._excursions.get(position.key)
+        if progress is None:
+            # The route was unassigned; there is nothing left to deviate from
+            self._excursions.pop(position.key, None)
+            return ALERT_RESOLVE if excursion is not None and excursion[2] else None
+
+        now = position.updated_at
+        if not progress.on_route:
+            if excursion is None:
+                excursion = self._excursions[position.key] = [now, None, False]
+            excursion[1] = None
+            if not excursion[2] and now - excursion[0] >= self.confirm_seconds:
+                excursion[2] = True
+                return ALERT_RAISE
+            return None
+
+        if excursion is None:
+            return None
+        if not excursion[2]:
+            # Back before the alert was confirmed
+            del self._excursions[position.key]
+            return None
+        if progress.offset_km > self.rejoin_km:
+            # Skirting the buffer edge neither confirms nor clears the alert
+            excursion[1] = None
+            return None
+        if excursion[1] is None:
+            excursion[1] = now
+        if now - excursion[1] >= self.confirm_seconds:
+            del self._excursions[position.key]
+            return ALERT_RESOLVE
+        return None
+
+    async def track(self, position):
+        """Detect a vehicle leaving or rejoining its route, then publish and record it."""
+        action = self.detect(position)
+        if action is not None:
+            await self.publish(position, action)
+        return action
+
+    async def publish(self, position, action):
+        """Send an alert to the alerts group and record it."""
+        route_id = position.route.route_id if position.route is not None else None
+        self.recorder.record(
+            action, position.vehicle_type, position.id, route_id,
+            position.latitude, position.longitude, position.updated_at,
+        )
+        frame = {
+            "type": "alert",
+            "event": "raised" if action == ALERT_RAISE else "resolved",
+            "kind": "off_route",
+            "vehicle": {"id": position.id, "vehicle_type": position.vehicle_type},
+            "route": route_id,
+            "latitude": position.latitude,
+            "longitude": position.longitude,
+            "at": position.updated_at,
+        }
+        channel_layer = self.channel_layer or get_channel_layer()
+        await channel_layer.group_send(ALERTS_GROUP, {
+            "type": "fleet.alert",
+            "text": encode_json(frame),
+        })
+
+
+# Process-wide detector shared by the fleet consumers.
+deviation_detector = DeviationDetector()
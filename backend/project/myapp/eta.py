@@ -0,0 +1,208 @@
+"""
+Live ETAs of buses to the checkpoints ahead of them on their route.
+
+Every interval the engine pairs each bus that is on its route with the
+checkpoints still ahead of it and turns the remaining distance into an
+arrival time at the bus's smoothed speed. Pairing and arithmetic run as
+NumPy array operations over the whole fleet at once; large fleets are split
+by route across a thread pool, where NumPy releases the GIL. Results are
+served by the REST endpoint and pushed to sockets watching a checkpoint.
+"""
+import asyncio
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from django.conf import settings
+
+from .periodic import PeriodicTask
+from .position_store import position_store
+from .route_matching import route_matcher
+from .wire import encode_json
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ETA_INTERVAL_SECONDS = 5
+# Speed assumed for a bus without an estimate yet, and the floor under
+# estimates so a bus waiting at a signal doesn't get an endless ETA.
+DEFAULT_BUS_SPEED_KMH = 18
+MIN_BUS_SPEED_KMH = 5
+MAX_ARRIVALS_PER_CHECKPOINT = 5
+# Below this many buses a single batch beats splitting the work.
+PARALLEL_MIN_BUSES = 2000
+
+
+def compute_arrivals(buses, tables, now, limit=MAX_ARRIVALS_PER_CHECKPOINT):
+    """
+    Soonest arrivals at every checkpoint for one batch of buses.
+
+    ``buses`` holds (vehicle id, route id, distance km, speed km/h or None,
+    measured at) tuples and ``tables`` maps route id -> (checkpoint offsets
+    in km, checkpoint ids), ordered along the route. Returns checkpoint id
+    -> list of arrival dicts, soonest first.
+    """
+    buses = [bus for bus in buses if bus[1] in tables]
+    if not buses:
+        return {}
+
+    # Lay the routes' checkpoints end to end, shifting each route past the
+    # previous one, so a single searchsorted finds every bus's next stop.
+    offsets, ids, shift_of, start_of, end_of = [], [], {}, {}, {}
+    shift = 0.0
+    count = 0
+    for route_id in {bus[1] for bus in buses}:
+        route_offsets, route_ids = tables[route_id]
+        shift_of[route_id] = shift
+        start_of[route_id] = count
+        count += len(route_offsets)
+        end_of[route_id] = count
+        offsets.append(np.asarray(route_offsets, dtype=float) + shift)
+        ids.append(np.asarray(route_ids))
+        shift += route_offsets[-1] + 1.0
+    shifted_offsets = np.concatenate(offsets)
+    checkpoint_ids = np.concatenate(ids)
+
+    distance = np.array([bus[2] for bus in buses], dtype=float)
+    speed = np.array([np.nan if bus[3] is None else bus[3] for bus in buses], dtype=float)
+    speed = np.maximum(np.where(np.isnan(speed), DEFAULT_BUS_SPEED_KMH, speed), MIN_BUS_SPEED_KMH)
+    age = now - np.array([bus[4] for bus in buses], dtype=float)
+    shifts = np.array([shift_of[bus[1]] for bus in buses])
+    ends = np.array([end_of[bus[1]] for bus in buses])
+
+    # Every (bus, checkpoint ahead) pair, as a ragged gather
+    nexts = np.searchsorted(shifted_offsets, distance + shifts, side="right")
+    counts = np.maximum(ends - nexts, 0)
+    total = int(counts.sum())
+    if not total:
+        return {}
+    bus_index = np.repeat(np.arange(len(buses)), counts)
+    pair = np.repeat(nexts - (np.cumsum(counts) - counts), counts) + np.arange(total)
+
+    remaining_km = shifted_offsets[pair] - shifts[bus_index] - distance[bus_index]
+    # The bus has kept moving since its fix was measured
+    eta = np.maximum(remaining_km / speed[bus_index] * 3600 - age[bus_index], 0.0)
+    checkpoint = checkpoint_ids[pair]
+
+    order = np.lexsort((eta, checkpoint))
+    checkpoint, eta, bus_index, remaining_km = (
+        checkpoint[order], eta[order], bus_index[order], remaining_km[order]
+    )
+    group_starts = np.flatnonzero(np.r_[True, checkpoint[1:] != checkpoint[:-1]])
+    rank = np.arange(total) - np.repeat(group_starts, np.diff(np.r_[group_starts, total]))
+
+    arrivals = {}
+    for i in np.flatnonzero(rank < limit):
+        vehicle_id, route_id = buses[bus_index[i]][:2]
+        arrivals.setdefault(int(checkpoint[i]), []).append({
+            "id": vehicle_id,
+            "route": route_id,
+            "eta_seconds": int(round(eta[i])),
+            "distance_km": round(float(remaining_km[i]), 3),
+        })
+    return arrivals
+
+
+def split_by_route(buses, batches):
+    """
+    Split buses into at most ``batches`` lists of similar size, keeping each
+    route in one list so no checkpoint's arrivals span two batches.
+    """
+    by_route = {}
+    for bus in buses:
+        by_route.setdefault(bus[1], []).append(bus)
+    split = [[] for _ in range(batches)]
+    for route_buses in sorted(by_route.values(), key=len, reverse=True):
+        min(split, key=len).extend(route_buses)
+    return [batch for batch in split if batch]
+
+
+class EtaEngine(PeriodicTask):
+    """Recomputes fleet ETAs every interval and pushes them to watchers."""
+
+    def __init__(self, store, matcher, interval=None):
+        if interval is None:
+            interval = getattr(settings, "LOCATION_ETA_INTERVAL_SECONDS", DEFAULT_ETA_INTERVAL_SECONDS)
+        super().__init__(interval)
+        self.store = store
+        self.matcher = matcher
+        self.workers = os.cpu_count() or 1
+        self._executor = None
+        # checkpoint id -> arrival dicts, soonest first
+        self.arrivals = {}
+        self.computed_at = None
+        # checkpoint id -> callbacks taking an encoded eta_update event
+        self._watchers = {}
+
+    def watch(self, checkpoint_id, callback):
+        self._watchers.setdefault(checkpoint_id, set()).add(callback)
+        self.ensure_started()
+
+    def unwatch(self, checkpoint_id, callback):
+        callbacks = self._watchers.get(checkpoint_id)
+        if callbacks is not None:
+            callbacks.discard(callback)
+            if not callbacks:
+                del self._watchers[checkpoint_id]
+
+    def frame(self, checkpoint_id):
+        return {
+            "type": "eta_update",
+            "checkpoint": checkpoint_id,
+            "computed_at": self.computed_at,
+            "arrivals": self.arrivals.get(checkpoint_id, []),
+        }
+
+    async def arrivals_for(self, checkpoint_id):
+        """Current arrivals at a checkpoint, recomputing them if stale."""
+        if self.computed_at is None or time.time() - self.computed_at > self.interval:
+            await self.recompute()
+        return self.arrivals.get(checkpoint_id, [])
+
+    async def tick(self):
+        # Nobody is watching; REST callers recompute on demand
+        if not self._watchers:
+            return
+        await self.recompute()
+        for checkpoint_id, callbacks in list(self._watchers.items()):
+            event = {"type": "eta_update", "text": encode_json(self.frame(checkpoint_id))}
+            for callback in list(callbacks):
+                callback(event)
+
+    async def recompute(self):
+        await self.store.refresh()
+        buses = [
+            (position.id, progress.route_id, progress.distance_km, progress.speed_kmh, progress.updated_at)
+            for position in self.store.positions("bus")
+            # Off-route buses (and ones not matched onto their route yet)
+            # have no distance along it to count down from
+            if (progress := position.route) is not None and progress.on_route
+        ]
+        tables = {}
+        for route_id in {bus[1] for bus in buses}:
+            geometry = await self.matcher.geometry("bus", route_id)
+            if geometry is not None and geometry.checkpoint_ids:
+                tables[route_id] = (geometry.checkpoint_offsets, geometry.checkpoint_ids)
+
+        now = time.time()
+        loop = asyncio.get_running_loop()
+        # Off the event loop either way; big fleets fan out across cores
+        if len(buses) < PARALLEL_MIN_BUSES or self.workers == 1:
+            self.arrivals = await loop.run_in_executor(None, compute_arrivals, buses, tables, now)
+        else:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix="eta")
+            results = await asyncio.gather(*(
+                loop.run_in_executor(self._executor, compute_arrivals, batch, tables, now)
+                for batch in split_by_route(buses, self.workers)
+            ))
+            arrivals = {}
+            for result in results:
+                arrivals.update(result)
+            self.arrivals = arrivals
+        self.computed_at = now
+
+
+# Process-wide engine shared by the REST endpoint and fleet consumers.
+eta_engine = EtaEngine(position_store, route_matcher)
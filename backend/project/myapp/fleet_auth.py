@@ -0,0 +1,134 @@
+"""
+Connect-time JWT authentication for the fleet WebSocket.
+
+Browsers can't set headers on a WebSocket handshake, so the access token
+comes as ``?token=`` (an ``Authorization: Bearer`` header works too). The
+middleware verifies it once, resolves who the caller is and which vehicle
+types a driver may report for, and leaves a FleetIdentity in the scope.
+The consumer checks every fix against that identity without touching the
+database again.
+"""
+import logging
+from urllib.parse import parse_qs
+
+from channels.db import database_sync_to_async
+from channels.middleware import BaseMiddleware
+from django.contrib.auth.models import User
+from rest_framework.permissions import BasePermission
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import AccessToken
+
+from .models import Conductor, Driver
+from .persistence import RUNTIME_MODELS
+
+logger = logging.getLogger(__name__)
+
+# Roles carried in the token's "role" claim (see generate_tokens_for_user);
+# tokens without one belong to auth users, i.e. riders and staff.
+DRIVER = "driver"
+CONDUCTOR = "conductor"
+RIDER = "rider"
+STAFF = "staff"
+
+
+class FleetIdentity:
+    """Who is on the other end of a fleet socket, resolved at connect."""
+
+    __slots__ = ("role", "user_id", "vehicle_types")
+
+    def __init__(self, role, user_id, vehicle_types=frozenset()):
+        self.role = role
+        self.user_id = user_id
+        # Vehicle types a driver has a vehicle of, and so may report fixes for
+        self.vehicle_types = vehicle_types
+
+    @property
+    def is_staff(self):
+        return self.role == STAFF
+
+    def may_report(self, vehicle_type, vehicle_id):
+        return (
+            self.role == DRIVER
+            and vehicle_type in self.vehicle_types
+            and str(vehicle_id) == str(self.user_id)
+        )
+
+
+ANONYMOUS = FleetIdentity(None, None)
+
+
+def token_from_scope(scope):
+    """The raw access token offered in the handshake, or None."""
+    query = parse_qs(scope.get("query_string", b"").decode("latin-1"))
+    if query.get("token"):
+        return query["token"][0]
+    for name, value in scope.get("headers", ()):
+        if name == b"authorization":
+            scheme, _, token = value.decode("latin-1").partition(" ")
+            if scheme.lower() == "bearer" and token:
+                return token.strip()
+    return None
+
+
+def resolve_identity(token):
+    """FleetIdentity for a verified access token, or None if its subject is gone."""
+    role = token.get("role")
+    user_id = token.get(api_settings.USER_ID_CLAIM)
+    if role == DRIVER:
+        if not Driver.objects.filter(pk=user_id).exists():
+            return None
+        vehicle_types = frozenset(
+            vehicle_type
+            for vehicle_type, (vehicle_model, _) in RUNTIME_MODELS.items()
+            if vehicle_model.objects.filter(driver_id=user_id).exists()
+        )
+        return FleetIdentity(DRIVER, user_id, vehicle_types)
+    if role == CONDUCTOR:
+        if not Conductor.objects.filter(pk=user_id).exists():
+            return None
+        return FleetIdentity(CONDUCTOR, user_id)
+    if role is None:
+        user = User.objects.filter(pk=user_id, is_active=True).first()
+        if user is None:
+            return None
+        return FleetIdentity(STAFF if user.is_staff else RIDER, user_id)
+    return None
+
+
+def authenticate_token(raw_token):
+    """FleetIdentity for a raw access token, or None if it doesn't verify."""
+    try:
+        token = AccessToken(raw_token)
+    except TokenError as e:
+        logger.info("Rejected fleet token: %s", e)
+        return None
+    return resolve_identity(token)
+
+
+class IsFleetStaff(BasePermission):
+    """
+    DRF permission for staff-only endpoints. JWTAuthentication looks every
+    token's user_id up as an auth User, but driver and conductor tokens carry
+    their own pk there, so the token's role has to be checked as well.
+    """
+
+    def has_permission(self, request, view):
+        if request.auth is None:
+            return False
+        identity = resolve_identity(request.auth)
+        return identity is not None and identity.is_staff
+
+
+class JWTAuthMiddleware(BaseMiddleware):
+    """
+    Puts the caller's FleetIdentity in ``scope["fleet_identity"]``:
+    ANONYMOUS without a token, None for a token that doesn't verify.
+    """
+
+    async def __call__(self, scope, receive, send):
+        identity = ANONYMOUS
+        raw_token = token_from_scope(scope)
+        if raw_token is not None:
+            identity = await database_sync_to_async(authenticate_token)(raw_token)
+        return await super().__call__({**scope, "fleet_identity": identity}, receive, send)
@@ -0,0 +1,142 @@
+"""
+Small geodesy helpers for live tracking: distances and a fixed lat/lng grid.
+"""
+import math
+
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE_LAT = 111.32
+
+
+def haversine_km(lat1, lng1, lat2, lng2):
+    """Great-circle distance between two points in kilometres."""
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    dphi = phi2 - phi1
+    dlmb = math.radians(lng2 - lng1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlmb / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def valid_coordinates(lat, lng):
+    """Whether a point is a finite, in-range latitude/longitude pair."""
+    return (
+        math.isfinite(lat) and math.isfinite(lng)
+        and -90 <= lat <= 90 and -180 <= lng <= 180
+    )
+
+
+def cell_for(lat, lng, cell_size):
+    """Grid cell (row, col) containing a point, for cells of cell_size degrees."""
+    return (math.floor(lat / cell_size), math.floor(lng / cell_size))
+
+
+def bbox_cell_count(south, west, north, east, cell_size):
+    """How many cells cells_in_bbox would return, without building them."""
+    south_row, west_col = cell_for(south, west, cell_size)
+    north_row, east_col = cell_for(north, east, cell_size)
+    return max(north_row - south_row + 1, 0) * max(east_col - west_col + 1, 0)
+
+
+def cells_in_bbox(south, west, north, east, cell_size):
+    """Every grid cell overlapping a lat/lng bounding box."""
+    south_row, west_col = cell_for(south, west, cell_size)
+    north_row, east_col = cell_for(north, east, cell_size)
+    return {
+        (row, col)
+        for row in range(south_row, north_row + 1)
+        for col in range(west_col, east_col + 1)
+    }
+
+
+def ring_cells(row, col, ring):
+    """Cells on the border of the (2 * ring + 1) square centred on (row, col)."""
+    if ring == 0:
+        yield (row, col)
+        return
+    for c in range(col - ring, col + ring + 1):
+        yield (row - ring, c)
+        yield (row + ring, c)
+    for r in range(row - ring + 1, row + ring):
+        yield (r, col - ring)
+        yield (r, col + ring)
+
+
+def bbox_around(lat, lng, radius_km):
+    """
+    Bounding box (south, west, north, east) of a circle around a point,
+    clipped to the map so a huge radius stays a finite box.
+    """
+    dlat = radius_km / KM_PER_DEGREE_LAT
+    # Clamp near the poles where a degree of longitude shrinks to nothing
+    dlng = radius_km / (KM_PER_DEGREE_LAT * max(math.cos(math.radians(lat)), 0.01))
+    return (
+        max(lat - dlat, -90.0),
+        max(lng - dlng, -180.0),
+        min(lat + dlat, 90.0),
+        min(lng + dlng, 180.0),
+    )
+
+
+def cells_in_radius(lat, lng, radius_km, cell_size):
+    return cells_in_bbox(*bbox_around(lat, lng, radius_km), cell_size)
+
+
+def _encode_value(value):
+    # Google encoded polyline: zig-zag the signed value, then emit 5-bit chunks
+    value = ~(value << 1) if value < 0 else value << 1
+    chunks = []
+    while value >= 0x20:
+        chunks.append(chr((0x20 | (value & 0x1F)) + 63))
+        value >>= 5
+    chunks.append(chr(value + 63))
+    return "".join(chunks)
+
+
+class PolylineEncoder:
+    """Incremental encoder for integer sequences in Google polyline format."""
+
+    def __init__(self, dimensions=2):
+        self._previous = [0] * dimensions
+
+    def add(self, *values):
+        """Encode one point of already-scaled integers and return its text."""
+        parts = []
+        for index, value in enumerate(values):
+            parts.append(_encode_value(value - self._previous[index]))
+            self._previous[index] = value
+        return "".join(parts)
+
+
+def encode_polyline(points, precision=5):
+    """Encode (lat, lng) pairs as a Google encoded polyline."""
+    factor = 10 ** precision
+    encoder = PolylineEncoder()
+    return "".join(encoder.add(round(lat * factor), round(lng * factor)) for lat, lng in points)
+
+
+def decode_values(text, dimensions=2):
+    """Decode a polyline into tuples of integers (deltas already summed)."""
+    values = []
+    current = [0] * dimensions
+    index = 0
+    length = len(text)
+    while index < length:
+        for dimension in range(dimensions):
+            shift = 0
+            result = 0
+            while True:
+                byte = ord(text[index]) - 63
+                index += 1
+                result |= (byte & 0x1F) << shift
+                shift += 5
+                if byte < 0x20:
+                    break
+            current[dimension] += ~(result >> 1) if result & 1 else result >> 1
+        values.append(tuple(current))
+    return values
+
+
+def decode_polyline(text, precision=5):
+    """Decode a Google encoded polyline into a list of (lat, lng) floats."""
+    factor = 10 ** precision
+    return [(lat / factor, lng / factor) for lat, lng in decode_values(text)]
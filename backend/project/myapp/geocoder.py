@@ -0,0 +1,139 @@
+"""
+Offline reverse geocoder that labels live fixes with the nearest known place.
+
+Places are bus checkpoints, the from/to locations of bus routes (placed at
+the route's first and last checkpoint) and imported gazetteer entries (see
+the ``import_gazetteer`` command). They are held in a lat/lng grid and
+lookups are cached on coordinates rounded to about 100 m, so labelling a
+fix never leaves the process once the places are loaded.
+"""
+import functools
+import logging
+import math
+import time
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+
+from .geo import KM_PER_DEGREE_LAT, cell_for, haversine_km, ring_cells
+from .models import BusCheckpoint, BusRoute, Place
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_GEOCODER_CELL_SIZE_DEG = 0.01
+# Fixes further than this from every known place get no label.
+DEFAULT_GEOCODER_MAX_DISTANCE_KM = 2
+DEFAULT_GEOCODER_CACHE_SIZE = 4096
+# Backstop for places edited by another process, where our signals don't fire.
+DEFAULT_GEOCODER_RELOAD_SECONDS = 600
+# Cache key precision: 3 decimals is roughly 110 m.
+CACHE_KEY_DECIMALS = 3
+
+
+def load_places():
+    """(lat, lng, label) for every known place with coordinates."""
+    places = list(Place.objects.values_list("lat", "lng", "name"))
+
+    # route id -> [first checkpoint, last checkpoint] as (lat, lng)
+    route_ends = {}
+    checkpoints = (
+        BusCheckpoint.objects
+        .filter(lat__isnull=False, lng__isnull=False)
+        .order_by("route_id", "id")
+        .values_list("route_id", "lat", "lng", "address")
+    )
+    for route_id, lat, lng, address in checkpoints:
+        places.append((lat, lng, address))
+        ends = route_ends.setdefault(route_id, [(lat, lng), None])
+        ends[1] = (lat, lng)
+
+    routes = BusRoute.objects.filter(id__in=route_ends).values_list("id", "from_location", "to_location")
+    for route_id, from_location, to_location in routes:
+        first, last = route_ends[route_id]
+        places.append((*first, from_location))
+        places.append((*last, to_location))
+    return places
+
+
+class ReverseGeocoder:
+    """Nearest-place lookup over a grid index with an LRU of recent answers."""
+
+    def __init__(self, cell_size=None, max_distance_km=None, cache_size=None, reload_seconds=None):
+        if cell_size is None:
+            cell_size = getattr(settings, "LOCATION_GEOCODER_CELL_SIZE_DEG", DEFAULT_GEOCODER_CELL_SIZE_DEG)
+        if max_distance_km is None:
+            max_distance_km = getattr(
+                settings, "LOCATION_GEOCODER_MAX_DISTANCE_KM", DEFAULT_GEOCODER_MAX_DISTANCE_KM
+            )
+        if cache_size is None:
+            cache_size = getattr(settings, "LOCATION_GEOCODER_CACHE_SIZE", DEFAULT_GEOCODER_CACHE_SIZE)
+        if reload_seconds is None:
+            reload_seconds = getattr(
+                settings, "LOCATION_GEOCODER_RELOAD_SECONDS", DEFAULT_GEOCODER_RELOAD_SECONDS
+            )
+        self.cell_size = cell_size
+        self.max_distance_km = max_distance_km
+        self.reload_seconds = reload_seconds
+        # grid cell -> [(lat, lng, label)]
+        self._cells = {}
+        self._loaded_at = None
+        self._lookup = functools.lru_cache(maxsize=cache_size)(self._nearest_label)
+
+    def index(self, places):
+        """
+        Replace the known places and forget every cached answer. They count
+        as freshly loaded until the next reload.
+        """
+        cells = {}
+        for lat, lng, label in places:
+            label = (label or "").strip()
+            if label:
+                cells.setdefault(cell_for(lat, lng, self.cell_size), []).append((lat, lng, label))
+        self._cells = cells
+        self._lookup.cache_clear()
+        self._loaded_at = time.monotonic()
+
+    def invalidate(self):
+        """Reload the places before the next lookup."""
+        self._loaded_at = None
+
+    async def ensure_loaded(self):
+        if self._loaded_at is not None and time.monotonic() - self._loaded_at < self.reload_seconds:
+            return
+        try:
+            places = await database_sync_to_async(load_places)()
+        except Exception:
+            # Keep labelling from the places we have; retried after the reload interval
+            logger.exception("Could not load places for reverse geocoding")
+        else:
+            self.index(places)
+        self._loaded_at = time.monotonic()
+
+    def lookup(self, latitude, longitude):
+        """Label of the nearest place, or None; needs the places loaded."""
+        return self._lookup(round(latitude, CACHE_KEY_DECIMALS), round(longitude, CACHE_KEY_DECIMALS))
+
+    async def label(self, latitude, longitude):
+        await self.ensure_loaded()
+        return self.lookup(latitude, longitude)
+
+    def _nearest_label(self, latitude, longitude):
+        # Same ring walk as PositionStore.nearest, for k=1
+        row, col = cell_for(latitude, longitude, self.cell_size)
+        cell_height_km = self.cell_size * KM_PER_DEGREE_LAT
+        step = min(cell_height_km, cell_height_km * max(math.cos(math.radians(latitude)), 0.01))
+        best_label = None
+        best_distance = self.max_distance_km
+        for ring in range(math.ceil(self.max_distance_km / step) + 1):
+            for cell in ring_cells(row, col, ring):
+                for lat, lng, label in self._cells.get(cell, ()):
+                    distance = haversine_km(latitude, longitude, lat, lng)
+                    if distance < best_distance:
+                        best_label, best_distance = label, distance
+            if best_label is not None and best_distance <= ring * step:
+                break
+        return best_label
+
+
+# Process-wide geocoder shared by the fleet consumers.
+reverse_geocoder = ReverseGeocoder()
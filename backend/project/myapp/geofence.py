@@ -0,0 +1,179 @@
+"""
+Checkpoint geofences: arrival and departure events for live buses.
+
+Bus checkpoints are indexed on a lat/lng grid, so a fix is only tested
+against the checkpoints in the cells around it, and each bus remembers the
+checkpoints it is inside. A bus arrives when it comes within the geofence
+radius and departs once it is a little further out than that, so GPS
+jitter at the edge doesn't flap. Events go to the ``checkpoint.<id>``
+channel group and, in batches, to the CheckpointEvent table.
+"""
+import logging
+import time
+
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from .geo import cell_for, cells_in_radius, haversine_km
+from .models import BusCheckpoint, CheckpointEvent
+from .persistence import checkpoint_event_recorder
+from .wire import encode_json
+
+logger = logging.getLogger(__name__)
+
+# Larger than any geofence, so a fix never needs more than the 3x3 cells around it.
+GEOFENCE_CELL_SIZE_DEG = 0.005
+DEFAULT_GEOFENCE_RADIUS_M = 75
+# A bus has left once it is this many radii away.
+DEPARTURE_RADIUS_FACTOR = 1.5
+# Backstop for checkpoints edited by another process, where our signals don't fire.
+DEFAULT_GEOFENCE_RELOAD_SECONDS = 600
+
+
+def checkpoint_group(checkpoint_id):
+    return f"checkpoint.{checkpoint_id}"
+
+
+def load_checkpoints():
+    """(id, route id, lat, lng) of every checkpoint with coordinates."""
+    return list(
+        BusCheckpoint.objects
+        .filter(lat__isnull=False, lng__isnull=False)
+        .values_list("id", "route_id", "lat", "lng")
+    )
+
+
+class GeofenceMonitor:
+    """Tracks which checkpoints each live bus is at and reports changes."""
+
+    def __init__(self, radius_m=None, recorder=checkpoint_event_recorder, channel_layer=None,
+                 reload_seconds=None):
+        if radius_m is None:
+            radius_m = getattr(settings, "LOCATION_GEOFENCE_RADIUS_M", DEFAULT_GEOFENCE_RADIUS_M)
+        if reload_seconds is None:
+            reload_seconds = getattr(
+                settings, "LOCATION_GEOFENCE_RELOAD_SECONDS", DEFAULT_GEOFENCE_RELOAD_SECONDS
+            )
+        self.arrival_km = radius_m / 1000
+        self.departure_km = self.arrival_km * DEPARTURE_RADIUS_FACTOR
+        self.reload_seconds = reload_seconds
+        self.recorder = recorder
+        self.channel_layer = channel_layer
+        # grid cell -> [(checkpoint id, route id, lat, lng)]
+        self._cells = {}
+        # checkpoint id -> (route id, lat, lng)
+        self._checkpoints = {}
+        self._loaded_at = None
+        # position key -> {checkpoint id: route id} the bus is inside
+        self._inside = {}
+
+    def index(self, checkpoints):
+        """Replace the known checkpoints; they count as loaded until the next reload."""
+        cells = {}
+        by_id = {}
+        for checkpoint_id, route_id, lat, lng in checkpoints:
+            cells.setdefault(cell_for(lat, lng, GEOFENCE_CELL_SIZE_DEG), []).append(
+                (checkpoint_id, route_id, lat, lng)
+            )
+            by_id[checkpoint_id] = (route_id, lat, lng)
+        self._cells = cells
+        self._checkpoints = by_id
+        self._loaded_at = time.monotonic()
+
+    def invalidate(self):
+        """Reload the checkpoints before the next fix."""
+        self._loaded_at = None
+
+    async def ensure_loaded(self):
+        if self._loaded_at is not None and time.monotonic() - self._loaded_at < self.reload_seconds:
+            return
+        try:
+            checkpoints = await database_sync_to_async(load_checkpoints)()
+        except Exception:
+            logger.exception("Could not load checkpoints for geofencing")
+        else:
+            self.index(checkpoints)
+        self._loaded_at = time.monotonic()
+
+    async def sign_off(self, position):
+        """Depart every checkpoint a bus that went offline was still inside."""
+        inside = self._inside.pop(position.key, {})
+        events = [
+            (CheckpointEvent.DEPARTURE, checkpoint_id, route_id)
+            for checkpoint_id, route_id in inside.items()
+        ]
+        await self.publish(position, events)
+        return events
+
+    def detect(self, position):
+        """
+        Update the bus's geofence state from its latest fix and return the
+        (event, checkpoint id, route id) changes, departures first.
+        """
+        # Buses on a known route only stop at that route's checkpoints
+        route_id = position.route.route_id if position.route is not None else None
+        latitude, longitude = position.latitude, position.longitude
+        inside = self._inside.get(position.key, {})
+
+        events = []
+        still_inside = {}
+        for checkpoint_id, checkpoint_route in inside.items():
+            checkpoint = self._checkpoints.get(checkpoint_id)
+            if (
+                checkpoint is not None
+                and (route_id is None or checkpoint[0] == route_id)
+                and haversine_km(latitude, longitude, checkpoint[1], checkpoint[2]) <= self.departure_km
+            ):
+                still_inside[checkpoint_id] = checkpoint_route
+            else:
+                events.append((CheckpointEvent.DEPARTURE, checkpoint_id, checkpoint_route))
+
+        for cell in cells_in_radius(latitude, longitude, self.arrival_km, GEOFENCE_CELL_SIZE_DEG):
+            for checkpoint_id, checkpoint_route, lat, lng in self._cells.get(cell, ()):
+                if checkpoint_id in still_inside:
+                    continue
+                if route_id is not None and checkpoint_route != route_id:
+                    continue
+                if haversine_km(latitude, longitude, lat, lng) <= self.arrival_km:
+                    still_inside[checkpoint_id] = checkpoint_route
+                    events.append((CheckpointEvent.ARRIVAL, checkpoint_id, checkpoint_route))
+
+        if still_inside:
+            self._inside[position.key] = still_inside
+        else:
+            self._inside.pop(position.key, None)
+        return events
+
+    async def track(self, position):
+        """Detect a bus's geofence changes, then publish and record them."""
+        if position.vehicle_type != "bus":
+            return []
+        await self.ensure_loaded()
+        events = self.detect(position)
+        await self.publish(position, events)
+        return events
+
+    async def publish(self, position, events):
+        """Send and record a bus's geofence changes."""
+        if not events:
+            return
+        channel_layer = self.channel_layer or get_channel_layer()
+        for event, checkpoint_id, route_id in events:
+            self.recorder.record(position.id, checkpoint_id, event, position.updated_at)
+            frame = {
+                "type": "checkpoint_event",
+                "event": event,
+                "checkpoint": checkpoint_id,
+                "route": route_id,
+                "vehicle": {"id": position.id, "vehicle_type": position.vehicle_type},
+                "at": position.updated_at,
+            }
+            await channel_layer.group_send(checkpoint_group(checkpoint_id), {
+                "type": "checkpoint.event",
+                "text": encode_json(frame),
+            })
+
+
+# Process-wide monitor shared by the fleet consumers.
+geofence_monitor = GeofenceMonitor()
@@ -0,0 +1,161 @@
+"""
+The live ingest path for driver fixes, shared by the fleet socket and the
+HTTP fallback.
+
+A fix updates the live store, picks up an address, route progress,
+checkpoint and off-route events, and is queued for fan-out and the
+write-behind database writers.
+
+Driver apps that were offline (or just want to wake the radio less often)
+upload fixes in batches, either as ``fixes: [{latitude, longitude,
+recorded_at}, ...]`` or as a ``polyline`` plus ``times`` trail in the same
+encoding the location history endpoint serves. A batch goes to the history
+in one bulk append, and only its newest fix moves the vehicle live.
+"""
+import time
+
+from .broadcaster import broadcaster
+from .constants import VEHICLE_TYPES
+from .deviation import deviation_detector
+from .geo import decode_polyline, decode_values, valid_coordinates
+from .geocoder import reverse_geocoder
+from .geofence import geofence_monitor
+from .persistence import history_recorder, runtime_persister
+from .position_store import position_store
+from .reporting_rate import reporting_rate
+from .route_matching import route_matcher
+
+MAX_BATCH_FIXES = 2000
+# Fixes stamped further ahead of the server clock than this are rejected.
+MAX_CLOCK_SKEW_SECONDS = 300
+
+
+def normalize_vehicle_type(value):
+    vehicle_type = str(value or '').strip().lower()
+    return vehicle_type if vehicle_type in VEHICLE_TYPES else None
+
+
+def parse_coordinates(latitude, longitude):
+    """
+    A client's latitude/longitude as floats. Accepts numeric strings;
+    raises ValueError for anything else or a point off the map.
+    """
+    try:
+        latitude = float(latitude)
+        longitude = float(longitude)
+    except (TypeError, ValueError):
+        raise ValueError("latitude and longitude must be numbers") from None
+    if not valid_coordinates(latitude, longitude):
+        raise ValueError("latitude/longitude out of range")
+    return latitude, longitude
+
+
+def parse_batch(data, now=None):
+    """
+    (recorded_at, latitude, longitude) fixes of a batch upload, oldest
+    first. Raises ValueError for a malformed batch; fixes that are out of
+    range or from the future are dropped.
+    """
+    try:
+        if data.get('polyline') is not None:
+            points = decode_polyline(str(data['polyline']))
+            times = [value for (value,) in decode_values(str(data.get('times') or ''), dimensions=1)]
+            if len(times) != len(points):
+                raise ValueError("polyline and times must have one entry per fix")
+            fixes = [(float(at), lat, lng) for at, (lat, lng) in zip(times, points)]
+        elif isinstance(data.get('fixes'), list):
+            fixes = [
+                (float(fix['recorded_at']), float(fix['latitude']), float(fix['longitude']))
+                for fix in data['fixes']
+            ]
+        else:
+            raise ValueError("A batch needs a fixes list or a polyline and times")
+    except (IndexError, KeyError, TypeError) as e:
+        raise ValueError(f"Malformed batch: {e}") from None
+    if len(fixes) > MAX_BATCH_FIXES:
+        raise ValueError(f"At most {MAX_BATCH_FIXES} fixes per batch")
+
+    latest = (time.time() if now is None else now) + MAX_CLOCK_SKEW_SECONDS
+    fixes = [
+        fix for fix in fixes
+        if fix[0] <= latest and valid_coordinates(fix[1], fix[2])
+    ]
+    fixes.sort()
+    return fixes
+
+
+class FixIngestor:
+    """Runs accepted fixes through the live pipeline."""
+
+    def __init__(self, store=position_store, broadcaster=broadcaster, persister=runtime_persister,
+                 history=history_recorder, geocoder=reverse_geocoder, routes=route_matcher,
+                 geofence=geofence_monitor, deviation=deviation_detector, reporting=reporting_rate):
+        self.store = store
+        self.broadcaster = broadcaster
+        self.persister = persister
+        self.history = history
+        self.geocoder = geocoder
+        self.routes = routes
+        self.geofence = geofence
+        self.deviation = deviation
+        self.reporting = reporting
+        # Vehicles that stop reporting sign off when the sweep expires them
+        broadcaster.on_expire(self.sign_off)
+
+    async def sign_off(self, position):
+        """
+        End a vehicle's tracking once its driver signs off or it expires:
+        depart the checkpoints it was at, resolve its off-route alert and
+        drop its per-vehicle state.
+        """
+        await self.geofence.sign_off(position)
+        await self.deviation.sign_off(position)
+        self.reporting.forget(position.key)
+
+    async def ingest(self, vehicle_type, vehicle_id, latitude, longitude, address=None, recorded_at=None):
+        position = self.store.upsert(vehicle_type, vehicle_id, latitude, longitude, address, recorded_at)
+        if not address and position.cell != position.prev_cell:
+            # Label server-side, only when the vehicle enters a new cell
+            position.address = await self.geocoder.label(position.latitude, position.longitude)
+        await self.routes.track(position)
+        await self.geofence.track(position)
+        await self.deviation.track(position)
+
+        # Fan-out happens once per tick in the broadcaster
+        self.broadcaster.publish_position(position)
+        # and the database writes once per flush interval
+        self.persister.record(position)
+        self.history.record(
+            vehicle_type,
+            position.id,
+            position.updated_at,
+            position.latitude,
+            position.longitude,
+        )
+        return position
+
+    async def ingest_batch(self, vehicle_type, vehicle_id, fixes):
+        """
+        Append a parsed batch to the history and move the vehicle live to
+        its newest fix. Returns the live position, or None when the store
+        already holds a newer fix than anything in the batch or the newest
+        fix is older than the live TTL.
+        """
+        if not fixes:
+            return None
+        *older, (recorded_at, latitude, longitude) = fixes
+        current = self.store.get(vehicle_type, vehicle_id)
+        if (
+            current is not None and current.updated_at >= recorded_at
+            or recorded_at <= time.time() - self.store.ttl
+        ):
+            # A backfill of fixes the live stream has already moved past, or
+            # too old for the vehicle to count as live
+            self.history.record_many([(vehicle_type, vehicle_id, *fix) for fix in fixes])
+            return None
+        self.history.record_many([(vehicle_type, vehicle_id, *fix) for fix in older])
+        return await self.ingest(vehicle_type, vehicle_id, latitude, longitude, recorded_at=recorded_at)
+
+
+# Process-wide ingest path shared by the fleet consumers and the HTTP fallback.
+fix_ingestor = FixIngestor()
@@ -0,0 +1,138 @@
+"""
+Measure what one broadcast tick costs as the number of subscribers grows.
+
+Frames are encoded once per wire format by the broadcaster, so encode CPU
+per tick should stay flat while only the (cheap) fan-out of the encoded
+frames scales with the subscriber count.
+
+    python manage.py benchmark_broadcast --vehicles 2000 --subscribers 1,10,100,1000
+"""
+import asyncio
+import random
+import time
+
+from channels.layers import InMemoryChannelLayer
+from django.core.management.base import BaseCommand, CommandError
+
+from myapp.broadcaster import LocationBroadcaster, location_group
+from myapp.consumers import FleetLocationConsumer
+from myapp.position_store import PositionStore
+from myapp.send_queue import SendQueue
+from myapp.subscriptions import SubscriptionRegistry
+from myapp.vehicle_details import VehicleDetailsCache
+
+
+class EncodeMeter:
+    """Wraps a broadcaster's encode() and accumulates its CPU time."""
+
+    def __init__(self, encode):
+        self._encode = encode
+        self.calls = 0
+        self.seconds = 0.0
+        self.bytes = 0
+
+    def __call__(self, frame):
+        started = time.process_time()
+        text = self._encode(frame)
+        self.seconds += time.process_time() - started
+        self.calls += 1
+        self.bytes += len(text or b"")
+        return text
+
+
+class Command(BaseCommand):
+    help = "Benchmark broadcast encode and fan-out CPU per tick against subscriber count."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--vehicles", type=int, default=2000)
+        parser.add_argument("--subscribers", default="1,10,100,1000",
+                            help="Comma-separated subscriber counts to run")
+        parser.add_argument("--ticks", type=int, default=10)
+        parser.add_argument("--vehicle-type", default="bus")
+        parser.add_argument("--binary", action="store_true",
+                            help="Subscribers use the binary subprotocol")
+
+    def handle(self, *args, **options):
+        try:
+            counts = [int(count) for count in options["subscribers"].split(",") if count]
+        except ValueError:
+            raise CommandError("--subscribers must be a comma-separated list of integers")
+
+        self.stdout.write(
+            f"{options['vehicles']} vehicles, {options['ticks']} ticks per run\n"
+            f"{'subscribers':>11} {'encodes/tick':>12} {'encode ms/tick':>14} "
+            f"{'JSON KB':>8} {'binary KB':>9} {'fan-out ms/tick':>15}"
+        )
+        for count in counts:
+            result = asyncio.run(self.run(
+                options["vehicles"], count, options["ticks"], options["vehicle_type"],
+                options["binary"],
+            ))
+            self.stdout.write(
+                f"{count:>11} {result['encodes']:>12.1f} {result['encode_ms']:>14.3f} "
+                f"{result['json_kb']:>8.1f} {result['binary_kb']:>9.1f} {result['fanout_ms']:>15.3f}"
+            )
+
+    async def run(self, vehicles, subscribers, ticks, vehicle_type, binary=False):
+        layer = InMemoryChannelLayer(capacity=ticks + 1)
+        store = PositionStore()
+        # Warm cache, as in steady state, so the run never touches the database
+        details = VehicleDetailsCache()
+        for vehicle_id in range(vehicles):
+            details.put(vehicle_type, vehicle_id, {
+                "id": vehicle_id, "driver": vehicle_id, "license_plate": f"MH12AB{vehicle_id:04d}",
+            })
+        broadcaster = LocationBroadcaster(
+            store, interval_ms=1000, channel_layer=layer, details=details,
+            subscriptions=SubscriptionRegistry(),
+        )
+        meter = broadcaster.encode = EncodeMeter(broadcaster.encode)
+        binary_meter = broadcaster.encode_binary = EncodeMeter(broadcaster.encode_binary)
+        group = location_group(vehicle_type)
+
+        channels = []
+        for _ in range(subscribers):
+            channel = await layer.new_channel()
+            await layer.group_add(group, channel)
+            broadcaster.watch({group})
+            channels.append(channel)
+
+        # One consumer stands in for every subscriber; its sends are dropped
+        async def discard(*args, **kwargs):
+            pass
+
+        consumer = FleetLocationConsumer()
+        consumer.send = discard
+        consumer.binary = binary
+        consumer.queue = SendQueue(
+            consumer.forward, discard, discard, max_frames=subscribers + 1
+        )
+        consumer.queue.start()
+
+        rng = random.Random(0)
+        fanout_seconds = 0.0
+        for _ in range(ticks):
+            for vehicle_id in range(vehicles):
+                position = store.upsert(
+                    vehicle_type, vehicle_id,
+                    18.5 + rng.random() * 0.2, 73.8 + rng.random() * 0.2,
+                )
+                broadcaster.publish(group, position)
+            await broadcaster.flush()
+
+            started = time.process_time()
+            for channel in channels:
+                event = await layer.receive(channel)
+                await getattr(consumer, event["type"])(event)
+            while consumer.queue.stats()["queued"]:
+                await asyncio.sleep(0)
+            fanout_seconds += time.process_time() - started
+        await consumer.queue.stop()
+
+        return {
+            "encodes": meter.calls / ticks,
+            "encode_ms": (meter.seconds + binary_meter.seconds) * 1000 / ticks,
+            "json_kb": meter.bytes / max(meter.calls, 1) / 1024,
+            "binary_kb": binary_meter.bytes / max(binary_meter.calls, 1) / 1024,
+            "fanout_ms": fanout_seconds * 1000 / ticks,
+        }
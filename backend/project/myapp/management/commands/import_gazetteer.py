@@ -0,0 +1,60 @@
+"""
+Load a local gazetteer CSV into the places used to label live fixes.
+
+The file needs a ``name`` column and coordinates as ``latitude``/``longitude``
+or ``lat``/``lng``; other columns are ignored.
+
+    python manage.py import_gazetteer places.csv --replace
+"""
+import csv
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from myapp.models import Place
+
+BATCH_SIZE = 1000
+
+
+def parse_row(row):
+    """(name, lat, lng) from one CSV row, or None when it can't be used."""
+    name = (row.get("name") or "").strip()
+    try:
+        lat = float(row.get("latitude") or row.get("lat"))
+        lng = float(row.get("longitude") or row.get("lng"))
+    except (TypeError, ValueError):
+        return None
+    if not name or not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        return None
+    return name, lat, lng
+
+
+class Command(BaseCommand):
+    help = "Import gazetteer places (CSV) for the offline reverse geocoder."
+
+    def add_arguments(self, parser):
+        parser.add_argument("path")
+        parser.add_argument("--source", help="Source recorded on each place (default: file name)")
+        parser.add_argument("--replace", action="store_true",
+                            help="Delete places previously imported from the same source first")
+
+    def handle(self, *args, **options):
+        path = options["path"]
+        source = options["source"] or os.path.basename(path)
+        try:
+            with open(path, newline="", encoding="utf-8-sig") as handle:
+                rows = [parse_row(row) for row in csv.DictReader(handle)]
+        except OSError as e:
+            raise CommandError(f"Could not read {path}: {e}")
+
+        places = [Place(name=name, lat=lat, lng=lng, source=source) for name, lat, lng in filter(None, rows)]
+        with transaction.atomic():
+            deleted = Place.objects.filter(source=source).delete()[0] if options["replace"] else 0
+            Place.objects.bulk_create(places, batch_size=BATCH_SIZE)
+
+        # Running servers pick the places up within LOCATION_GEOCODER_RELOAD_SECONDS
+        self.stdout.write(
+            f"Imported {len(places)} places from {path} "
+            f"({len(rows) - len(places)} skipped, {deleted} replaced)"
+        )
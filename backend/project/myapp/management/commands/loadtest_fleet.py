@@ -0,0 +1,362 @@
+"""
+Load test for the fleet WebSocket consumer.
+
+Runs N simulated drivers and M riders against FleetLocationConsumer inside
+this process through channels.testing.WebsocketCommunicator, then reports
+ingest throughput, end-to-end fan-out latency percentiles, frame sizes and
+process CPU/memory.
+
+    python manage.py loadtest_fleet --drivers 200 --riders 100 --duration 20
+    python manage.py loadtest_fleet --layer redis --redis-host 127.0.0.1
+    python manage.py loadtest_fleet --layer redis --fake-redis
+
+``--fake-redis`` starts an in-process Redis stand-in for machines without a
+Redis server; it needs ``fakeredis[lua]`` since channels_redis uses scripts. Clients, and the stand-in if
+used, share the process with the server, so CPU and memory include them.
+Database writes and vehicle lookups are disabled so the run measures the
+live path only.
+"""
+import asyncio
+import json
+import random
+import threading
+import time
+
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test import override_settings
+
+from myapp.broadcaster import LocationBroadcaster
+from myapp.consumers import FleetLocationConsumer
+from myapp.deviation import DeviationDetector
+from myapp.fleet_auth import DRIVER, FleetIdentity
+from myapp.geocoder import ReverseGeocoder
+from myapp.geofence import GeofenceMonitor
+from myapp.ingest import FixIngestor
+from myapp.position_store import create_position_store, position_key
+from myapp.route_matching import RouteMatcher
+from myapp.subscriptions import create_subscription_registry
+from myapp.vehicle_details import VehicleDetailsCache
+from myapp.wire import BINARY_SUBPROTOCOL, decode_binary
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Drivers are spread around this point
+CENTER = (18.5204, 73.8567)
+
+
+def as_identity(app, identity):
+    """Serve ``app`` as if JWTAuthMiddleware had resolved ``identity``."""
+    async def authenticated(scope, receive, send):
+        return await app({**scope, "fleet_identity": identity}, receive, send)
+    return authenticated
+
+
+def synthetic_places(spread_km, per_side=10):
+    """A grid of labelled places around CENTER standing in for the database's."""
+    degrees = spread_km / 111.32
+    step = 2 * degrees / (per_side - 1)
+    return [
+        (CENTER[0] - degrees + row * step, CENTER[1] - degrees + col * step, f"Place {row}-{col}")
+        for row in range(per_side)
+        for col in range(per_side)
+    ]
+
+
+class NullRecorder:
+    """Stands in for the database writers during a load run."""
+
+    def record(self, *args):
+        pass
+
+    def record_many(self, rows):
+        pass
+
+
+class LoadStats:
+    def __init__(self):
+        # (driver id, latitude in microdegrees) -> time the fix was sent
+        self.sent_at = {}
+        self.fixes_sent = 0
+        self.frames = 0
+        self.frame_bytes = 0
+        self.records = 0
+        self.snapshots = 0
+        self.closed = 0
+        self.latencies = []
+
+    def frame_received(self, frame, size, received_at):
+        if frame.get("type") != "batch_location_update":
+            return
+        if frame.get("mode") == "snapshot":
+            self.snapshots += 1
+        self.frames += 1
+        self.frame_bytes += size
+        for record in frame["data"]:
+            self.records += 1
+            sent_at = self.sent_at.get((int(record["id"]), round(record["latitude"] * 1_000_000)))
+            if sent_at is not None:
+                self.latencies.append(received_at - sent_at)
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class Command(BaseCommand):
+    help = "Load-test the fleet WebSocket with simulated drivers and riders."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--drivers", type=int, default=100)
+        parser.add_argument("--riders", type=int, default=50)
+        parser.add_argument("--rate", type=float, default=1.0,
+                            help="Fixes per second per driver")
+        parser.add_argument("--duration", type=float, default=10.0, help="Seconds to publish for")
+        parser.add_argument("--vehicle-type", default="bike")
+        parser.add_argument("--spread-km", type=float, default=5.0,
+                            help="Drivers start within this distance of the centre")
+        parser.add_argument("--radius-km", type=float, default=None,
+                            help="Riders subscribe to this radius instead of the whole type")
+        parser.add_argument("--update-interval", type=int, default=None,
+                            help="update_interval (ms) riders subscribe with")
+        parser.add_argument("--binary", action="store_true",
+                            help="Riders use the binary subprotocol")
+        parser.add_argument("--interval-ms", type=int, default=None,
+                            help="Broadcast tick (default LOCATION_BROADCAST_INTERVAL_MS)")
+        parser.add_argument("--layer", choices=["memory", "redis"], default="memory")
+        parser.add_argument("--redis-host", default=None)
+        parser.add_argument("--redis-port", type=int, default=None)
+        parser.add_argument("--fake-redis", action="store_true",
+                            help="Serve Redis from an in-process fakeredis server")
+        parser.add_argument("--json", action="store_true", help="Print the summary as JSON")
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        if options["drivers"] <= 0 or options["rate"] <= 0 or options["duration"] <= 0:
+            raise CommandError("--drivers, --rate and --duration must be positive")
+
+        host = options["redis_host"] or settings.REDIS_HOST
+        port = options["redis_port"] or settings.REDIS_PORT
+        fake_server = None
+        if options["fake_redis"]:
+            options["layer"] = "redis"
+            fake_server = self.start_fake_redis(host, options["redis_port"] or 0)
+            host, port = fake_server.server_address[:2]
+
+        if options["layer"] == "redis":
+            layer = {
+                "BACKEND": "channels_redis.core.RedisChannelLayer",
+                "CONFIG": {
+                    **settings.CHANNEL_LAYERS.get("default", {}).get("CONFIG", {}),
+                    "hosts": [(host, port)],
+                },
+            }
+        else:
+            layer = {"BACKEND": "channels.layers.InMemoryChannelLayer"}
+
+        try:
+            with override_settings(
+                CHANNEL_LAYERS={"default": layer},
+                LIVE_STATE_BACKEND=options["layer"],
+                REDIS_HOST=host,
+                REDIS_PORT=port,
+            ):
+                summary = asyncio.run(self.run(options))
+        finally:
+            if fake_server is not None:
+                fake_server.shutdown()
+                fake_server.server_close()
+
+        summary["layer"] = "fakeredis" if fake_server is not None else options["layer"]
+        if options["json"]:
+            self.stdout.write(json.dumps(summary))
+        else:
+            self.report(summary)
+
+    def start_fake_redis(self, host, port):
+        try:
+            from fakeredis import TcpFakeServer
+        except ImportError:
+            raise CommandError("--fake-redis needs the fakeredis[lua] package")
+        server = TcpFakeServer((host, port))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+    def consumer_class(self, options):
+        """FleetLocationConsumer wired to a fresh store and broadcaster."""
+        store = create_position_store()
+        details = VehicleDetailsCache()
+        routes = RouteMatcher()
+        for driver_id in range(1, options["drivers"] + 1):
+            details.put(options["vehicle_type"], driver_id, {})
+            routes.assign(position_key(options["vehicle_type"], driver_id), None)
+        geocoder = ReverseGeocoder()
+        geocoder.index(synthetic_places(options["spread_km"]))
+        geofence = GeofenceMonitor(recorder=NullRecorder())
+        geofence.index([])
+        broadcaster = LocationBroadcaster(
+            store, interval_ms=options["interval_ms"], details=details,
+            subscriptions=create_subscription_registry(),
+        )
+        ingestor = FixIngestor(
+            store=store,
+            broadcaster=broadcaster,
+            persister=NullRecorder(),
+            history=NullRecorder(),
+            geocoder=geocoder,
+            routes=routes,
+            geofence=geofence,
+            deviation=DeviationDetector(recorder=NullRecorder()),
+        )
+        return type("LoadTestConsumer", (FleetLocationConsumer,), {
+            "store": store,
+            "broadcaster": broadcaster,
+            "details": details,
+            "ingestor": ingestor,
+        })
+
+    async def run(self, options):
+        consumer_class = self.consumer_class(options)
+        app = consumer_class.as_asgi()
+        stats = LoadStats()
+        rng = random.Random(options["seed"])
+
+        riders = []
+        subprotocols = [BINARY_SUBPROTOCOL] if options["binary"] else None
+        subscribe = {"type": "subscribe", "vehicle_type": options["vehicle_type"]}
+        if options["radius_km"] is not None:
+            subscribe.update(latitude=CENTER[0], longitude=CENTER[1], radius_km=options["radius_km"])
+        if options["update_interval"] is not None:
+            subscribe["update_interval"] = options["update_interval"]
+        for _ in range(options["riders"]):
+            rider = WebsocketCommunicator(app, "/ws/fleet/", subprotocols=subprotocols)
+            connected, _ = await rider.connect()
+            if not connected:
+                raise CommandError("Rider could not connect")
+            await rider.receive_from()  # connection_established
+            await rider.send_json_to(subscribe)
+            riders.append(rider)
+
+        drivers = []
+        for driver_id in range(1, options["drivers"] + 1):
+            identity = FleetIdentity(DRIVER, driver_id, frozenset({options["vehicle_type"]}))
+            driver = WebsocketCommunicator(as_identity(app, identity), "/ws/fleet/")
+            await driver.connect()
+            await driver.receive_from()
+            drivers.append(driver)
+
+        readers = [asyncio.create_task(self.read(rider, stats)) for rider in riders]
+        cpu_start = time.process_time()
+        started = time.perf_counter()
+        deadline = started + options["duration"]
+        await asyncio.gather(*(
+            self.drive(driver, driver_id, options, stats, rng, deadline)
+            for driver_id, driver in enumerate(drivers, start=1)
+        ))
+        publish_seconds = time.perf_counter() - started
+
+        # Let the last ticks (and slow interval tiers) drain
+        drain = consumer_class.broadcaster.interval * 2
+        if options["update_interval"]:
+            drain += options["update_interval"] / 1000
+        await asyncio.sleep(drain)
+        cpu_seconds = time.process_time() - cpu_start
+        wall_seconds = time.perf_counter() - started
+
+        for rider in riders:
+            await rider.disconnect()
+        for reader in readers:
+            reader.cancel()
+        await asyncio.gather(*readers, return_exceptions=True)
+        for driver in drivers:
+            await driver.disconnect()
+        await consumer_class.broadcaster.stop()
+
+        latencies = sorted(stats.latencies)
+        return {
+            "drivers": options["drivers"],
+            "riders": options["riders"],
+            "rate": options["rate"],
+            "binary": options["binary"],
+            "tick_ms": round(consumer_class.broadcaster.interval * 1000),
+            "fixes_sent": stats.fixes_sent,
+            "ingest_per_second": round(stats.fixes_sent / min(publish_seconds, options["duration"]), 1),
+            "frames": stats.frames,
+            "frames_per_second": round(stats.frames / wall_seconds, 1),
+            "records_delivered": stats.records,
+            "bytes_per_frame": round(stats.frame_bytes / stats.frames) if stats.frames else 0,
+            "records_per_frame": round(stats.records / stats.frames, 1) if stats.frames else 0,
+            "resyncs": max(0, stats.snapshots - options["riders"]),
+            "closed": stats.closed,
+            "latency_ms": {
+                name: round(percentile(latencies, fraction) * 1000, 1)
+                for name, fraction in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99), ("max", 1.0))
+            },
+            "cpu_seconds": round(cpu_seconds, 2),
+            "cpu_percent": round(100 * cpu_seconds / wall_seconds, 1),
+            "peak_rss_mb": round(peak_rss_mb(), 1) if resource is not None else None,
+        }
+
+    async def drive(self, driver, driver_id, options, stats, rng, deadline):
+        """Publish fixes for one driver until the deadline, with a random start offset."""
+        period = 1 / options["rate"]
+        degrees = options["spread_km"] / 111.32
+        latitude = CENTER[0] + rng.uniform(-degrees, degrees)
+        longitude = CENTER[1] + rng.uniform(-degrees, degrees)
+        await asyncio.sleep(rng.uniform(0, period))
+        while time.perf_counter() < deadline:
+            latitude += rng.uniform(-0.0002, 0.0002)
+            longitude += rng.uniform(-0.0002, 0.0002)
+            stats.sent_at[(driver_id, round(latitude * 1_000_000))] = time.perf_counter()
+            stats.fixes_sent += 1
+            await driver.send_json_to({
+                "id": driver_id,
+                "vehicle_type": options["vehicle_type"],
+                "latitude": latitude,
+                "longitude": longitude,
+            })
+            await asyncio.sleep(period)
+
+    async def read(self, rider, stats):
+        while True:
+            message = await rider.receive_output(timeout=None)
+            received_at = time.perf_counter()
+            if message["type"] == "websocket.close":
+                stats.closed += 1
+                return
+            if message.get("bytes") is not None:
+                frame, size = decode_binary(message["bytes"]), len(message["bytes"])
+            else:
+                frame, size = json.loads(message["text"]), len(message["text"])
+            stats.frame_received(frame, size, received_at)
+
+    def report(self, summary):
+        latency = summary["latency_ms"]
+        memory = f"{summary['peak_rss_mb']} MB" if summary["peak_rss_mb"] is not None else "n/a"
+        self.stdout.write(
+            f"Layer {summary['layer']}: {summary['drivers']} drivers at {summary['rate']}/s, "
+            f"{summary['riders']} {'binary' if summary['binary'] else 'JSON'} riders, "
+            f"{summary['tick_ms']} ms tick\n"
+            f"  ingest     {summary['fixes_sent']} fixes, {summary['ingest_per_second']}/s\n"
+            f"  fan-out    {summary['frames']} frames ({summary['frames_per_second']}/s), "
+            f"{summary['records_delivered']} records, {summary['records_per_frame']} per frame\n"
+            f"  frame size {summary['bytes_per_frame']} bytes on average\n"
+            f"  latency    p50 {latency['p50']} ms, p90 {latency['p90']} ms, "
+            f"p99 {latency['p99']} ms, max {latency['max']} ms\n"
+            f"  backlog    {summary['resyncs']} resync snapshots, {summary['closed']} sockets closed\n"
+            f"  process    {summary['cpu_seconds']} s CPU ({summary['cpu_percent']}% of one core), "
+            f"peak RSS {memory}"
+        )
@@ -1,11 +1,13 @@
 from django.db import models
 # from django.db import models
 from django.contrib.auth.models import User
+from django.contrib.contenttypes.fields import GenericForeignKey
+from django.contrib.contenttypes.models import ContentType
 from django.core.validators import MinValueValidator, MaxValueValidator
 from django.core.exceptions import ValidationError
 from django.utils import timezone
 from django.contrib.auth.hashers import make_password, check_password
-from .constants import ROLE_CHOICES
+from .constants import ROLE_CHOICES, VEHICLE_TYPE_CHOICES
 
 class PhoneOTP(models.Model):
     phone = models.CharField(max_length=15)
@@ -384,54 +386,138 @@ class BikeRuntimeData(AbstractRuntimeData):
         verbose_name_plural = "Bike Runtime Data"
 
 
-# class Alert(models.Model):
-#     SEVERITY_CHOICES = [
-#         ('Low', 'Low'),
-#         ('Medium', 'Medium'),
-#         ('High', 'High'),
-#         ('Critical', 'Critical'),
-#     ]
-    
-#     content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
-#     object_id = models.PositiveIntegerField()
-#     vehicle = GenericForeignKey('content_type', 'object_id')
-    
-#     message = models.CharField(max_length=255)
-#     severity = models.CharField(max_length=10, choices=SEVERITY_CHOICES, default='Medium')
-#     created_at = models.DateTimeField(auto_now_add=True)
-#     resolved = models.BooleanField(default=False)
-#     resolved_at = models.DateTimeField(null=True, blank=True)
-    
-#     def save(self, *args, **kwargs):
-#         if self.resolved and not self.resolved_at:
-#             self.resolved_at = timezone.now()
-#         super().save(*args, **kwargs)
-    
-#     def __str__(self):
-#         return f"{self.vehicle.vehicle_id if self.vehicle else 'Unknown'} - {self.message}"
-
-# class Alert(models.Model):
-#     SEVERITY_CHOICES = [
-#         ('Low', 'Low'),
-#         ('Medium', 'Medium'),
-#         ('High', 'High'),
-#         ('Critical', 'Critical'),
-#     ]
-    
-#     vehicle = models.ForeignKey(Vehicle, on_delete=models.CASCADE)
-#     message = models.CharField(max_length=255)
-#     severity = models.CharField(max_length=10, choices=SEVERITY_CHOICES, default='Medium')
-#     created_at = models.DateTimeField(auto_now_add=True)
-#     resolved = models.BooleanField(default=False)
-#     resolved_at = models.DateTimeField(null=True, blank=True)
-    
-#     def save(self, *args, **kwargs):
-#         if self.resolved and not self.resolved_at:
-#             self.resolved_at = timezone.now()
-#         super().save(*args, **kwargs)
-    
-#     def __str__(self):
-#         return f"{self.vehicle.vehicle_id} - {self.message}"
+class LocationHistory(models.Model):
+    """
+    Append-only GPS trail of every fix received on the live stream.
+
+    Rows are written in batches and kept narrow: the vehicle type as a small
+    code and coordinates as integer microdegrees.
+    """
+    vehicle_type = models.PositiveSmallIntegerField(choices=VEHICLE_TYPE_CHOICES)
+    # The id the vehicle reports on the live stream (its driver's id)
+    vehicle_id = models.PositiveIntegerField()
+    recorded_at = models.DateTimeField()
+    lat_e6 = models.IntegerField()
+    lng_e6 = models.IntegerField()
+
+    class Meta:
+        verbose_name = "Location History"
+        verbose_name_plural = "Location History"
+        indexes = [
+            # Track range queries: one vehicle between two timestamps
+            models.Index(fields=['vehicle_type', 'vehicle_id', 'recorded_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.get_vehicle_type_display()} {self.vehicle_id} @ {self.recorded_at}"
+
+
+class CheckpointEvent(models.Model):
+    """
+    A bus arriving at or departing from a checkpoint, detected from its
+    live fixes. Written in batches like LocationHistory.
+    """
+    ARRIVAL = 'arrival'
+    DEPARTURE = 'departure'
+    EVENT_CHOICES = [
+        (ARRIVAL, 'Arrival'),
+        (DEPARTURE, 'Departure'),
+    ]
+
+    checkpoint = models.ForeignKey(
+        BusCheckpoint,
+        on_delete=models.CASCADE,
+        related_name='events',
+    )
+    # The id the vehicle reports on the live stream (its driver's id)
+    vehicle_id = models.PositiveIntegerField()
+    event = models.CharField(max_length=10, choices=EVENT_CHOICES)
+    occurred_at = models.DateTimeField()
+
+    class Meta:
+        verbose_name = "Checkpoint Event"
+        verbose_name_plural = "Checkpoint Events"
+        indexes = [
+            models.Index(fields=['checkpoint', 'occurred_at']),
+            models.Index(fields=['vehicle_id', 'occurred_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.get_event_display()} of {self.vehicle_id} at {self.checkpoint_id} @ {self.occurred_at}"
+
+
+class Place(models.Model):
+    """
+    Named point from an imported gazetteer, used to label live fixes.
+    """
+    name = models.CharField(max_length=255)
+    lat = models.FloatField()
+    lng = models.FloatField()
+    # Where the entry came from, e.g. the gazetteer file name
+    source = models.CharField(max_length=100, blank=True, default='')
+
+    class Meta:
+        verbose_name = "Place"
+        verbose_name_plural = "Places"
+
+    def __str__(self):
+        return self.name
+
+
+class Alert(models.Model):
+    SEVERITY_CHOICES = [
+        ('Low', 'Low'),
+        ('Medium', 'Medium'),
+        ('High', 'High'),
+        ('Critical', 'Critical'),
+    ]
+    GENERAL = 'general'
+    OFF_ROUTE = 'off_route'
+    KIND_CHOICES = [
+        (GENERAL, 'General'),
+        (OFF_ROUTE, 'Off route'),
+    ]
+
+    # Bus, Car or Bike
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+    object_id = models.PositiveIntegerField()
+    vehicle = GenericForeignKey('content_type', 'object_id')
+
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES, default=GENERAL)
+    message = models.CharField(max_length=255)
+    severity = models.CharField(max_length=10, choices=SEVERITY_CHOICES, default='Medium')
+    # Where the vehicle was when the alert was raised, if known
+    latitude = models.FloatField(null=True, blank=True)
+    longitude = models.FloatField(null=True, blank=True)
+    created_at = models.DateTimeField(default=timezone.now)
+    resolved = models.BooleanField(default=False)
+    resolved_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name = "Alert"
+        verbose_name_plural = "Alerts"
+        indexes = [
+            # Open alerts are a tiny slice of the table; partial indexes keep
+            # the dashboard and per-vehicle lookups independent of its size
+            models.Index(
+                fields=['-created_at'],
+                name='alert_open_recent_idx',
+                condition=models.Q(resolved=False),
+            ),
+            models.Index(
+                fields=['content_type', 'object_id', 'kind'],
+                name='alert_open_vehicle_idx',
+                condition=models.Q(resolved=False),
+            ),
+        ]
+
+    def save(self, *args, **kwargs):
+        if self.resolved and not self.resolved_at:
+            self.resolved_at = timezone.now()
+        super().save(*args, **kwargs)
+
+    def __str__(self):
+        return f"{self.vehicle or 'Unknown'} - {self.message}"
 
 
 class BookingRequest(models.Model):
@@ -0,0 +1,85 @@
+"""
+Nearest-vehicle queries over the live position store, shared by the REST
+endpoint and the fleet WebSocket.
+"""
+import math
+
+from django.conf import settings
+
+from .constants import VEHICLE_TYPES
+from .geo import cells_in_radius, valid_coordinates
+from .vehicle_details import vehicle_details
+
+DEFAULT_NEAREST_K = 10
+MAX_NEAREST_K = 50
+DEFAULT_NEAREST_RADIUS_KM = 5
+DEFAULT_MAX_NEAREST_RADIUS_KM = 50
+
+# vehicle_type -> details field holding its subtype (e.g. car_type "sedan")
+SUBTYPE_FIELDS = {
+    "bus": "bus_type",
+    "car": "car_type",
+    "bike": "bike_type",
+}
+
+
+def parse_nearest_query(params):
+    """
+    Validate a nearest-vehicle query from query params or a WebSocket
+    message. Raises ValueError with a client-facing message.
+    """
+    vehicle_type = str(params.get("vehicle_type") or "").strip().lower()
+    if vehicle_type not in VEHICLE_TYPES:
+        raise ValueError(f"Unknown vehicle_type: {params.get('vehicle_type')}")
+    try:
+        latitude = float(params.get("latitude", params.get("lat")))
+        longitude = float(params.get("longitude", params.get("lng")))
+        k = int(params.get("k") or DEFAULT_NEAREST_K)
+        radius_km = float(params.get("radius_km") or DEFAULT_NEAREST_RADIUS_KM)
+    except (TypeError, ValueError):
+        raise ValueError("latitude and longitude are required; k and radius_km must be numbers")
+    if not valid_coordinates(latitude, longitude):
+        raise ValueError("latitude/longitude out of range")
+    # NaN slips past both comparisons below and through min()
+    if not math.isfinite(radius_km):
+        raise ValueError("radius_km must be a finite number")
+    if k <= 0 or radius_km <= 0:
+        raise ValueError("k and radius_km must be positive")
+    max_radius_km = getattr(settings, "LOCATION_NEAREST_MAX_RADIUS_KM", DEFAULT_MAX_NEAREST_RADIUS_KM)
+    return {
+        "vehicle_type": vehicle_type,
+        "latitude": latitude,
+        "longitude": longitude,
+        "k": min(k, MAX_NEAREST_K),
+        "radius_km": min(radius_km, max_radius_km),
+        "subtype": str(params.get("subtype") or "").strip() or None,
+    }
+
+
+async def find_nearest(store, query):
+    """Run a parsed query and return wire dicts with a distance_km field."""
+    await store.refresh()
+    predicate = None
+    if query["subtype"] is not None:
+        # Subtypes come from the details cache the live frames already use,
+        # so only vehicles it hasn't seen yet cost a query
+        cells = cells_in_radius(query["latitude"], query["longitude"], query["radius_km"], store.cell_size)
+        await vehicle_details.attach(store.positions(query["vehicle_type"], cells))
+        field = SUBTYPE_FIELDS[query["vehicle_type"]]
+        subtype = query["subtype"].lower()
+
+        def predicate(position):
+            return str((position.details or {}).get(field) or "").lower() == subtype
+    found = store.nearest(
+        query["vehicle_type"],
+        query["latitude"],
+        query["longitude"],
+        query["k"],
+        query["radius_km"],
+        predicate,
+    )
+    await vehicle_details.attach([position for _, position in found])
+    return [
+        {**position.as_dict(), "distance_km": round(distance, 3)}
+        for distance, position in found
+    ]
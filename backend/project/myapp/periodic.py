@@ -0,0 +1,40 @@
+"""
+Background loops for the live pipeline's periodic work (database flushes,
+ETA recomputes), started lazily on the running event loop.
+"""
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class PeriodicTask:
+    """Awaits ``tick()`` every ``interval`` seconds once started."""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._task = None
+        self._early_tick = None
+
+    def ensure_started(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def tick_soon(self):
+        """Start a tick now instead of waiting for the next interval."""
+        if self._early_tick is None or self._early_tick.done():
+            self._early_tick = asyncio.get_running_loop().create_task(self._safe_tick())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self._safe_tick()
+
+    async def _safe_tick(self):
+        try:
+            await self.tick()
+        except Exception:
+            logger.exception("%s tick failed", type(self).__name__)
+
+    async def tick(self):
+        """The periodic work; subclasses override this."""
@@ -0,0 +1,368 @@
+"""
+Write-behind persistence of the live location stream.
+
+The WebSocket path only buffers fixes in memory; async tasks flush them in
+batches so the receive path never waits on the database.
+
+* RuntimePersister keeps the latest fix per vehicle and upserts it into the
+  *RuntimeData models every LOCATION_PERSIST_INTERVAL_SECONDS.
+* HistoryRecorder appends every fix to LocationHistory with bulk inserts.
+* CheckpointEventRecorder appends geofence events to CheckpointEvent and
+  moves each arriving bus's BusRuntimeData.current_checkpoint.
+* AlertRecorder raises and resolves off-route Alerts in batches.
+"""
+import logging
+from datetime import datetime, timezone
+from decimal import Decimal
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import models
+
+from .constants import VEHICLE_TYPE_CODES
+from .models import (
+    Alert, Bike, BikeRuntimeData, Bus, BusCheckpoint, BusRuntimeData, Car, CarRuntimeData,
+    CheckpointEvent, LocationHistory,
+)
+from .periodic import PeriodicTask
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PERSIST_INTERVAL_SECONDS = 10
+DEFAULT_HISTORY_FLUSH_SECONDS = 5
+DEFAULT_CHECKPOINT_EVENT_FLUSH_SECONDS = 5
+DEFAULT_ALERT_FLUSH_SECONDS = 2
+# Flush history early once this many fixes are buffered
+HISTORY_BATCH_SIZE = 2000
+# and events once this many are
+EVENT_BATCH_SIZE = 500
+# History rows held for a retry while the database is failing; the oldest
+# are dropped past this
+HISTORY_MAX_BUFFERED_ROWS = 100_000
+
+ALERT_RAISE = "raise"
+ALERT_RESOLVE = "resolve"
+
+# vehicle_type -> (vehicle model, runtime data model)
+RUNTIME_MODELS = {
+    "bus": (Bus, BusRuntimeData),
+    "car": (Car, CarRuntimeData),
+    "bike": (Bike, BikeRuntimeData),
+}
+
+
+def coordinate_value(model, field_name, value):
+    # CarRuntimeData stores coordinates as decimals, the others as floats
+    if isinstance(model._meta.get_field(field_name), models.DecimalField):
+        return Decimal(str(round(value, 6)))
+    return value
+
+
+def driver_vehicle_ids(vehicle_model, driver_ids):
+    """Map driver id -> vehicle id for the drivers that have a vehicle of this type."""
+    return dict(
+        vehicle_model.objects.filter(driver_id__in=driver_ids).values_list("driver_id", "id")
+    )
+
+
+def write_runtime_positions(fixes):
+    """
+    Upsert the current position of each vehicle.
+
+    ``fixes`` is a list of (vehicle_type, driver_id, latitude, longitude)
+    tuples, at most one per vehicle.
+    """
+    by_type = {}
+    for vehicle_type, driver_id, latitude, longitude in fixes:
+        try:
+            driver_id = int(driver_id)
+        except (TypeError, ValueError):
+            continue
+        by_type.setdefault(vehicle_type, {})[driver_id] = (latitude, longitude)
+
+    for vehicle_type, positions in by_type.items():
+        if vehicle_type not in RUNTIME_MODELS:
+            continue
+        vehicle_model, runtime_model = RUNTIME_MODELS[vehicle_type]
+        vehicle_ids = driver_vehicle_ids(vehicle_model, positions.keys())
+        rows = [
+            runtime_model(
+                vehicle_id=vehicle_ids[driver_id],
+                current_lat=coordinate_value(runtime_model, "current_lat", latitude),
+                current_lng=coordinate_value(runtime_model, "current_lng", longitude),
+            )
+            for driver_id, (latitude, longitude) in positions.items()
+            if driver_id in vehicle_ids
+        ]
+        if rows:
+            runtime_model.objects.bulk_create(
+                rows,
+                update_conflicts=True,
+                unique_fields=["vehicle"],
+                update_fields=["current_lat", "current_lng", "last_updated"],
+            )
+
+
+def write_location_history(rows):
+    """
+    Bulk insert (vehicle_type, vehicle_id, recorded_at, latitude, longitude)
+    rows; all or none of them, so a failed write can be retried.
+    """
+    objects = []
+    for vehicle_type, vehicle_id, recorded_at, latitude, longitude in rows:
+        try:
+            vehicle_id = int(vehicle_id)
+        except (TypeError, ValueError):
+            continue
+        objects.append(LocationHistory(
+            vehicle_type=VEHICLE_TYPE_CODES[vehicle_type],
+            vehicle_id=vehicle_id,
+            recorded_at=datetime.fromtimestamp(recorded_at, tz=timezone.utc),
+            lat_e6=round(latitude * 1_000_000),
+            lng_e6=round(longitude * 1_000_000),
+        ))
+    LocationHistory.objects.bulk_create(objects, batch_size=1000)
+
+
+def write_checkpoint_events(rows):
+    """
+    Bulk insert (vehicle_id, checkpoint_id, event, occurred_at) rows, in the
+    order they happened, and point each arriving bus's runtime data at the
+    checkpoint it reached last.
+    """
+    checkpoint_ids = {row[1] for row in rows}
+    existing = set(BusCheckpoint.objects.filter(id__in=checkpoint_ids).values_list("id", flat=True))
+    objects = []
+    arrivals = {}
+    for vehicle_id, checkpoint_id, event, occurred_at in rows:
+        try:
+            vehicle_id = int(vehicle_id)
+        except (TypeError, ValueError):
+            continue
+        if checkpoint_id not in existing:
+            continue  # Deleted since the event was detected
+        objects.append(CheckpointEvent(
+            checkpoint_id=checkpoint_id,
+            vehicle_id=vehicle_id,
+            event=event,
+            occurred_at=datetime.fromtimestamp(occurred_at, tz=timezone.utc),
+        ))
+        if event == CheckpointEvent.ARRIVAL:
+            arrivals[vehicle_id] = checkpoint_id
+    CheckpointEvent.objects.bulk_create(objects, batch_size=1000)
+
+    bus_ids = driver_vehicle_ids(Bus, arrivals.keys())
+    rows = [
+        BusRuntimeData(vehicle_id=bus_ids[driver_id], current_checkpoint_id=checkpoint_id)
+        for driver_id, checkpoint_id in arrivals.items()
+        if driver_id in bus_ids
+    ]
+    if rows:
+        BusRuntimeData.objects.bulk_create(
+            rows,
+            update_conflicts=True,
+            unique_fields=["vehicle"],
+            update_fields=["current_checkpoint", "last_updated"],
+        )
+
+
+def write_alerts(actions):
+    """
+    Apply (action, vehicle_type, driver_id, route_id, latitude, longitude,
+    at) off-route alert actions in order: ALERT_RAISE inserts an Alert for
+    the driver's vehicle, ALERT_RESOLVE closes its open off-route alerts.
+    """
+    parsed = []
+    driver_ids = {}
+    for action, vehicle_type, driver_id, *rest in actions:
+        try:
+            driver_id = int(driver_id)
+        except (TypeError, ValueError):
+            continue
+        if vehicle_type in RUNTIME_MODELS:
+            parsed.append((action, vehicle_type, driver_id, *rest))
+            driver_ids.setdefault(vehicle_type, set()).add(driver_id)
+
+    # (vehicle_type, driver id) -> (content type, vehicle id)
+    vehicles = {}
+    for vehicle_type, ids in driver_ids.items():
+        vehicle_model = RUNTIME_MODELS[vehicle_type][0]
+        content_type = ContentType.objects.get_for_model(vehicle_model)
+        for driver_id, vehicle_id in driver_vehicle_ids(vehicle_model, ids).items():
+            vehicles[(vehicle_type, driver_id)] = (content_type, vehicle_id)
+
+    # Consecutive actions of one kind go to the database together
+    runs = []
+    for action, vehicle_type, driver_id, route_id, latitude, longitude, at in parsed:
+        vehicle = vehicles.get((vehicle_type, driver_id))
+        if vehicle is None:
+            continue
+        if not runs or runs[-1][0] != action:
+            runs.append((action, []))
+        runs[-1][1].append((*vehicle, vehicle_type, route_id, latitude, longitude, at))
+
+    for action, run in runs:
+        if action == ALERT_RAISE:
+            Alert.objects.bulk_create([
+                Alert(
+                    content_type=content_type,
+                    object_id=vehicle_id,
+                    kind=Alert.OFF_ROUTE,
+                    severity='High',
+                    message=f"Left {vehicle_type} route {route_id}",
+                    latitude=latitude,
+                    longitude=longitude,
+                    created_at=datetime.fromtimestamp(at, tz=timezone.utc),
+                )
+                for content_type, vehicle_id, vehicle_type, route_id, latitude, longitude, at in run
+            ])
+            continue
+        by_type = {}
+        for content_type, vehicle_id, *_, at in run:
+            by_type.setdefault(content_type, []).append(vehicle_id)
+        resolved_at = datetime.fromtimestamp(run[-1][-1], tz=timezone.utc)
+        for content_type, vehicle_ids in by_type.items():
+            Alert.objects.filter(
+                content_type=content_type,
+                object_id__in=vehicle_ids,
+                kind=Alert.OFF_ROUTE,
+                resolved=False,
+            ).update(resolved=True, resolved_at=resolved_at)
+
+
+class RuntimePersister(PeriodicTask):
+    """Buffers the latest fix per vehicle and flushes it to the database in batches."""
+
+    def __init__(self, interval=None):
+        if interval is None:
+            interval = getattr(
+                settings, "LOCATION_PERSIST_INTERVAL_SECONDS", DEFAULT_PERSIST_INTERVAL_SECONDS
+            )
+        super().__init__(interval)
+        # position key -> VehiclePosition; the store updates records in
+        # place, so the newest fix is what gets written.
+        self._buffer = {}
+
+    def record(self, position):
+        self._buffer[position.key] = position
+        self.ensure_started()
+
+    async def tick(self):
+        await self.flush()
+
+    async def flush(self):
+        if not self._buffer:
+            return
+        buffer, self._buffer = self._buffer, {}
+        fixes = [
+            (position.vehicle_type, position.id, position.latitude, position.longitude)
+            for position in buffer.values()
+        ]
+        await database_sync_to_async(write_runtime_positions)(fixes)
+
+
+class RowWriter(PeriodicTask):
+    """
+    Buffers rows and hands them to ``write(rows)`` in a worker thread every
+    interval (read from the ``interval_setting`` setting), or as soon as
+    ``batch_size`` rows are waiting.
+
+    With ``max_buffered`` set, rows of a failed write are put back in front
+    of the buffer, up to that many rows in all, and retried on the next
+    interval; otherwise they are dropped. ``write`` must then be atomic.
+    """
+
+    def __init__(self, write, interval_setting, default_interval, interval=None, batch_size=EVENT_BATCH_SIZE,
+                 max_buffered=None):
+        if interval is None:
+            interval = getattr(settings, interval_setting, default_interval)
+        super().__init__(interval)
+        self.write = write
+        self.batch_size = batch_size
+        self.max_buffered = max_buffered
+        self._rows = []
+        # Set after a failed write: no early flushes until one succeeds
+        self._failing = False
+
+    def record(self, *row):
+        self._rows.append(row)
+        self._buffered()
+
+    def record_many(self, rows):
+        self._rows.extend(rows)
+        self._buffered()
+
+    def _buffered(self):
+        self.ensure_started()
+        if len(self._rows) >= self.batch_size and not self._failing:
+            self.tick_soon()
+
+    async def tick(self):
+        await self.flush()
+
+    async def flush(self):
+        if not self._rows:
+            return
+        rows, self._rows = self._rows, []
+        try:
+            await database_sync_to_async(self.write)(rows)
+        except Exception:
+            self._failing = True
+            if self.max_buffered is None:
+                raise
+            # Retried ahead of the rows recorded since
+            keep = min(max(self.max_buffered - len(self._rows), 0), len(rows))
+            self._rows = rows[len(rows) - keep:] + self._rows
+            logger.exception(
+                "%s could not write %d rows; %d kept for a retry",
+                type(self).__name__, len(rows), keep,
+            )
+            return
+        self._failing = False
+
+
+class HistoryRecorder(RowWriter):
+    """
+    Appends every fix to LocationHistory in bulk; rows are (vehicle_type,
+    vehicle_id, recorded_at, latitude, longitude).
+    """
+
+    def __init__(self, interval=None, batch_size=HISTORY_BATCH_SIZE, max_buffered=HISTORY_MAX_BUFFERED_ROWS):
+        # Replay relies on the history having no gaps, so failed writes are retried
+        super().__init__(
+            write_location_history, "LOCATION_HISTORY_FLUSH_SECONDS", DEFAULT_HISTORY_FLUSH_SECONDS,
+            interval, batch_size, max_buffered,
+        )
+
+
+class CheckpointEventRecorder(RowWriter):
+    """
+    Writes checkpoint arrivals/departures in bulk; rows are (vehicle_id,
+    checkpoint_id, event, occurred_at).
+    """
+
+    def __init__(self, interval=None, batch_size=EVENT_BATCH_SIZE):
+        super().__init__(
+            write_checkpoint_events, "LOCATION_CHECKPOINT_EVENT_FLUSH_SECONDS",
+            DEFAULT_CHECKPOINT_EVENT_FLUSH_SECONDS, interval, batch_size,
+        )
+
+
+class AlertRecorder(RowWriter):
+    """
+    Applies off-route alert actions in bulk; rows are (action, vehicle_type,
+    vehicle_id, route_id, latitude, longitude, at).
+    """
+
+    def __init__(self, interval=None, batch_size=EVENT_BATCH_SIZE):
+        super().__init__(
+            write_alerts, "LOCATION_ALERT_FLUSH_SECONDS", DEFAULT_ALERT_FLUSH_SECONDS, interval, batch_size,
+        )
+
+
+# Process-wide writers shared by every consumer instance.
+runtime_persister = RuntimePersister()
+history_recorder = HistoryRecorder()
+checkpoint_event_recorder = CheckpointEventRecorder()
+alert_recorder = AlertRecorder()
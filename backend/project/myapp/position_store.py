@@ -0,0 +1,475 @@
+"""
+Live vehicle position store used by the fleet WebSocket consumer.
+
+Positions are keyed by (vehicle_type, id) so an incoming fix is a single
+dict upsert regardless of how many vehicles are live. With more than one
+worker process the store is backed by Redis so every worker sees the whole
+fleet; the in-memory store remains for single-process and test runs.
+"""
+import heapq
+import json
+import logging
+import math
+import time
+
+from django.conf import settings
+from redis import asyncio as aioredis
+
+from .geo import KM_PER_DEGREE_LAT, cell_for, haversine_km, ring_cells
+from .route_matching import RouteProgress
+
+logger = logging.getLogger(__name__)
+
+# Roughly 2 km at the equator; small enough that a rider's surroundings
+# cover a handful of cells.
+DEFAULT_CELL_SIZE_DEG = 0.02
+DEFAULT_TTL_SECONDS = 60
+# Width in seconds of one slot of the expiry wheel.
+EXPIRY_SLOT_SECONDS = 1
+
+
+class VehiclePosition:
+    """Latest known fix for one vehicle."""
+
+    __slots__ = (
+        "vehicle_type",
+        "id",
+        "latitude",
+        "longitude",
+        "address",
+        "seq",
+        "updated_at",
+        "cell",
+        # Grid cell before the latest upsert; None for a new vehicle.
+        "prev_cell",
+        # Vehicle attributes for riders, set by the vehicle details cache.
+        "details",
+        # RouteProgress of a bus on its route, set by the route matcher.
+        "route",
+        # Expiry wheel slot the record is filed under.
+        "expiry_slot",
+        # True for a copy of a vehicle reported to another worker.
+        "remote",
+    )
+
+    def __init__(self, vehicle_type, vehicle_id, latitude, longitude, address, seq, updated_at, cell):
+        self.vehicle_type = vehicle_type
+        self.id = vehicle_id
+        self.latitude = latitude
+        self.longitude = longitude
+        self.address = address
+        self.seq = seq
+        self.updated_at = updated_at
+        self.cell = cell
+        self.prev_cell = None
+        self.details = None
+        self.route = None
+        self.expiry_slot = None
+        self.remote = False
+
+    @property
+    def key(self):
+        return position_key(self.vehicle_type, self.id)
+
+    def as_dict(self):
+        """Wire representation, matching the fields drivers send in."""
+        return {
+            "id": self.id,
+            "vehicle_type": self.vehicle_type,
+            "latitude": self.latitude,
+            "longitude": self.longitude,
+            "address": self.address,
+            "seq": self.seq,
+            "vehicle": self.details or None,
+            "route": self.route.as_dict() if self.route is not None else None,
+        }
+
+    def __repr__(self):
+        return f"<VehiclePosition {self.vehicle_type}:{self.id} seq={self.seq}>"
+
+
+def expiry_slot(timestamp):
+    return int(timestamp // EXPIRY_SLOT_SECONDS)
+
+
+def position_key(vehicle_type, vehicle_id):
+    # Drivers send ids as strings or ints depending on the client, so the
+    # key is normalised while the record keeps whatever the client sent.
+    return (vehicle_type, str(vehicle_id))
+
+
+class PositionStore:
+    """
+    Keyed store of VehiclePosition records.
+
+    Every upsert bumps a store-wide counter and stamps it on the record, so
+    each record's ``seq`` only ever grows and ``store.seq`` is the version
+    of the fleet as a whole.
+
+    Vehicles that have not reported for ``ttl`` seconds are dropped by
+    ``expire()``. Records sit in one-second slots of a timing wheel keyed by
+    last-seen time, so a sweep only visits slots that have fallen out of the
+    window instead of scanning the fleet.
+    """
+
+    def __init__(self, cell_size=DEFAULT_CELL_SIZE_DEG, ttl=DEFAULT_TTL_SECONDS):
+        self.cell_size = cell_size
+        self.ttl = ttl
+        self._positions = {}
+        # vehicle_type -> {key: VehiclePosition}, so per-type snapshots
+        # only touch that type's vehicles.
+        self._by_type = {}
+        # (vehicle_type, cell) -> {key: VehiclePosition} for area lookups.
+        self._by_cell = {}
+        # expiry slot -> set of keys last seen during that slot
+        self._expiry_slots = {}
+        self._sweep_cursor = None
+        self.seq = 0
+
+    def upsert(self, vehicle_type, vehicle_id, latitude, longitude, address=None, updated_at=None):
+        """Insert or update a vehicle's position in O(1) and return the record."""
+        key = position_key(vehicle_type, vehicle_id)
+        self.seq += 1
+        if updated_at is None:
+            updated_at = time.time()
+
+        cell = cell_for(latitude, longitude, self.cell_size)
+        position = self._positions.get(key)
+        if position is None:
+            position = VehiclePosition(
+                vehicle_type, vehicle_id, latitude, longitude, address, self.seq, updated_at, cell
+            )
+            self._positions[key] = position
+            self._by_type.setdefault(vehicle_type, {})[key] = position
+            self._by_cell.setdefault((vehicle_type, cell), {})[key] = position
+            self._file_expiry(position, updated_at)
+        else:
+            position.prev_cell = position.cell
+            if cell != position.cell:
+                self._unindex_cell(position)
+                self._by_cell.setdefault((vehicle_type, cell), {})[key] = position
+            if self._wheel_slot(updated_at) != position.expiry_slot:
+                self._unindex_expiry(position)
+                self._file_expiry(position, updated_at)
+            position.id = vehicle_id
+            position.latitude = latitude
+            position.longitude = longitude
+            # Fixes without an address keep the label the vehicle already has
+            if address is not None:
+                position.address = address
+            position.seq = self.seq
+            position.updated_at = updated_at
+            position.cell = cell
+        return position
+
+    def _wheel_slot(self, updated_at):
+        slot = expiry_slot(updated_at)
+        if self._sweep_cursor is not None and slot < self._sweep_cursor:
+            # Already past the TTL: file it where the next sweep looks first
+            return self._sweep_cursor
+        return slot
+
+    def _file_expiry(self, position, updated_at):
+        position.expiry_slot = self._wheel_slot(updated_at)
+        self._expiry_slots.setdefault(position.expiry_slot, set()).add(position.key)
+
+    def _unindex_cell(self, position):
+        cell_key = (position.vehicle_type, position.cell)
+        bucket = self._by_cell.get(cell_key)
+        if bucket is not None:
+            bucket.pop(position.key, None)
+            if not bucket:
+                del self._by_cell[cell_key]
+
+    def _unindex_expiry(self, position):
+        keys = self._expiry_slots.get(position.expiry_slot)
+        if keys is not None:
+            keys.discard(position.key)
+            if not keys:
+                del self._expiry_slots[position.expiry_slot]
+
+    def get(self, vehicle_type, vehicle_id):
+        return self._positions.get(position_key(vehicle_type, vehicle_id))
+
+    def remove(self, vehicle_type, vehicle_id):
+        """Drop a vehicle and return its last record, or None if it was unknown."""
+        key = position_key(vehicle_type, vehicle_id)
+        position = self._positions.pop(key, None)
+        if position is not None:
+            self._by_type.get(vehicle_type, {}).pop(key, None)
+            self._unindex_cell(position)
+            self._unindex_expiry(position)
+        return position
+
+    def expire(self, now=None):
+        """Remove vehicles not seen for ``ttl`` seconds and return their records."""
+        if now is None:
+            now = time.time()
+        # Slots strictly before this one only hold fixes older than the TTL
+        limit = expiry_slot(now - self.ttl)
+        if not self._expiry_slots:
+            self._sweep_cursor = limit
+            return []
+        if self._sweep_cursor is None:
+            self._sweep_cursor = min(self._expiry_slots)
+        if limit - self._sweep_cursor > len(self._expiry_slots):
+            # Long gap since the last sweep: visit occupied slots only
+            slots = sorted(slot for slot in self._expiry_slots if slot < limit)
+        else:
+            slots = range(self._sweep_cursor, limit)
+        self._sweep_cursor = max(self._sweep_cursor, limit)
+
+        expired = []
+        for slot in slots:
+            for key in self._expiry_slots.pop(slot, ()):
+                position = self._positions.get(key)
+                if position is not None:
+                    expired.append(self.remove(*key))
+        return expired
+
+    def in_cells(self, vehicle_type, cells):
+        """Vehicles of one type inside any of the given grid cells."""
+        for cell in cells:
+            bucket = self._by_cell.get((vehicle_type, cell))
+            if bucket:
+                yield from bucket.values()
+
+    def nearest(self, vehicle_type, latitude, longitude, k, radius_km, predicate=None):
+        """
+        Up to k vehicles of one type within radius_km of a point, nearest
+        first, as (distance_km, VehiclePosition) pairs.
+
+        Walks the grid in square rings around the point's cell and stops once
+        no unvisited cell can hold anything closer than the k-th hit, so the
+        cost depends on local density rather than fleet size.
+        """
+        if k <= 0:
+            return []
+        row, col = cell_for(latitude, longitude, self.cell_size)
+        cell_height_km = self.cell_size * KM_PER_DEGREE_LAT
+        cell_width_km = cell_height_km * max(math.cos(math.radians(latitude)), 0.01)
+        # Everything within ring * step km of the point lies inside rings 0..ring
+        step = min(cell_height_km, cell_width_km)
+        # Max-heap (by negated distance) of the best k so far
+        best = []
+        for ring in range(math.ceil(radius_km / step) + 1):
+            for cell in ring_cells(row, col, ring):
+                bucket = self._by_cell.get((vehicle_type, cell))
+                if not bucket:
+                    continue
+                for position in bucket.values():
+                    distance = haversine_km(latitude, longitude, position.latitude, position.longitude)
+                    if distance > radius_km:
+                        continue
+                    if len(best) == k and distance >= -best[0][0]:
+                        continue
+                    if predicate is not None and not predicate(position):
+                        continue
+                    entry = (-distance, position.seq, position)
+                    if len(best) < k:
+                        heapq.heappush(best, entry)
+                    else:
+                        heapq.heapreplace(best, entry)
+            if len(best) == k and -best[0][0] <= ring * step:
+                break
+        return [(-distance, position) for distance, _, position in sorted(best, reverse=True)]
+
+    def positions(self, vehicle_type=None, cells=None):
+        """Live records, optionally for one type and area."""
+        if cells is not None:
+            return list(self.in_cells(vehicle_type, cells))
+        if vehicle_type is None:
+            return list(self._positions.values())
+        return list(self._by_type.get(vehicle_type, {}).values())
+
+    def snapshot(self, vehicle_type=None, cells=None):
+        """Return the live fleet as wire dicts, optionally for one type and area."""
+        return [position.as_dict() for position in self.positions(vehicle_type, cells)]
+
+    def clear(self):
+        self._positions.clear()
+        self._by_type.clear()
+        self._by_cell.clear()
+        self._expiry_slots.clear()
+        self._sweep_cursor = None
+
+    async def sync(self):
+        """Push local changes to shared state. Nothing to do in memory."""
+
+    async def refresh(self, force=False):
+        """Pull changes made by other workers. Nothing to do in memory."""
+
+    def __len__(self):
+        return len(self._positions)
+
+    def __iter__(self):
+        return iter(self._positions.values())
+
+    def __contains__(self, key):
+        return key in self._positions
+
+
+class RedisPositionStore(PositionStore):
+    """
+    PositionStore shared across worker processes through Redis.
+
+    The local dict is a read-through cache: upserts land locally and are
+    written behind to Redis on the next ``sync()``, while ``refresh()`` pulls
+    in vehicles reported to other workers. Each vehicle is a Redis hash with
+    its own TTL, and a sorted set indexed by last update time lets refresh
+    read only what changed since the previous pass.
+
+    A worker only expires and announces the vehicles reported to it; its
+    copies of other workers' vehicles are dropped quietly and their hashes
+    are left to the owner and the key TTL.
+    """
+
+    key_prefix = "fleet:pos:"
+    index_key = "fleet:index"
+    # Tolerated clock skew between workers when reading the index.
+    refresh_slack = 5
+
+    def __init__(self, host, port, ttl, refresh_interval, cell_size=DEFAULT_CELL_SIZE_DEG):
+        super().__init__(cell_size, ttl)
+        self.host = host
+        self.port = port
+        self.refresh_interval = refresh_interval
+        self._redis = None
+        self._dirty = {}
+        self._removed = set()
+        self._last_refresh = 0
+        self._refresh_watermark = 0
+
+    @property
+    def redis(self):
+        if self._redis is None:
+            self._redis = aioredis.Redis(host=self.host, port=self.port, decode_responses=True)
+        return self._redis
+
+    def redis_key(self, key):
+        vehicle_type, vehicle_id = key
+        return f"{self.key_prefix}{vehicle_type}:{vehicle_id}"
+
+    def upsert(self, vehicle_type, vehicle_id, latitude, longitude, address=None, updated_at=None):
+        position = super().upsert(vehicle_type, vehicle_id, latitude, longitude, address, updated_at)
+        position.remote = False
+        self._dirty[position.key] = position
+        self._removed.discard(position.key)
+        return position
+
+    def remove(self, vehicle_type, vehicle_id):
+        key = position_key(vehicle_type, vehicle_id)
+        self._dirty.pop(key, None)
+        self._removed.add(key)
+        return super().remove(vehicle_type, vehicle_id)
+
+    def expire(self, now=None):
+        expired = []
+        for position in super().expire(now):
+            if position.remote:
+                # Not ours to delete from Redis or announce offline
+                self._removed.discard(position.key)
+            else:
+                expired.append(position)
+        return expired
+
+    async def sync(self):
+        """Write every position changed since the last sync in one pipeline."""
+        if not self._dirty and not self._removed:
+            return
+        dirty, self._dirty = self._dirty, {}
+        removed, self._removed = self._removed, set()
+        try:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for key in removed:
+                    name = self.redis_key(key)
+                    pipe.delete(name)
+                    pipe.zrem(self.index_key, name)
+                for position in dirty.values():
+                    name = self.redis_key(position.key)
+                    pipe.hset(name, mapping={
+                        "id": position.id,
+                        "vehicle_type": position.vehicle_type,
+                        "latitude": position.latitude,
+                        "longitude": position.longitude,
+                        "address": position.address or "",
+                        "updated_at": position.updated_at,
+                        # Route progress too, so every worker can compute ETAs
+                        "route": (
+                            json.dumps(position.route.as_dict()) if position.route is not None else ""
+                        ),
+                    })
+                    pipe.expire(name, self.ttl)
+                    pipe.zadd(self.index_key, {name: position.updated_at})
+                pipe.zremrangebyscore(self.index_key, "-inf", time.time() - self.ttl)
+                await pipe.execute()
+        except Exception:
+            # Keep the changes for the next attempt unless newer ones arrived.
+            for key, position in dirty.items():
+                self._dirty.setdefault(key, position)
+            self._removed |= removed - self._dirty.keys()
+            raise
+
+    async def refresh(self, force=False):
+        """Merge positions other workers wrote since the previous refresh."""
+        now = time.time()
+        if not force and now - self._last_refresh < self.refresh_interval:
+            return
+        self._last_refresh = now
+
+        since = max(self._refresh_watermark - self.refresh_slack, now - self.ttl)
+        try:
+            entries = await self.redis.zrangebyscore(self.index_key, since, "+inf", withscores=True)
+            if not entries:
+                return
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for name, _ in entries:
+                    pipe.hgetall(name)
+                records = await pipe.execute()
+        except Exception:
+            logger.exception("Could not refresh live positions from Redis")
+            return
+
+        for (_, score), fields in zip(entries, records):
+            self._refresh_watermark = max(self._refresh_watermark, score)
+            if not fields:
+                continue  # Expired between the index read and the hash read
+            updated_at = float(fields["updated_at"])
+            local = self._positions.get((fields["vehicle_type"], fields["id"]))
+            if local is not None and local.updated_at >= updated_at:
+                continue
+            # Bypass our own upsert so remote fixes are not written back.
+            position = PositionStore.upsert(
+                self,
+                fields["vehicle_type"],
+                fields["id"],
+                float(fields["latitude"]),
+                float(fields["longitude"]),
+                fields["address"] or None,
+                updated_at,
+            )
+            # A newer fix from another worker hands the vehicle over to it
+            position.remote = True
+            route = fields.get("route")
+            position.route = RouteProgress.from_dict(json.loads(route), updated_at) if route else None
+
+
+def create_position_store():
+    backend = getattr(settings, "LIVE_STATE_BACKEND", "memory")
+    cell_size = getattr(settings, "LOCATION_CELL_SIZE_DEG", DEFAULT_CELL_SIZE_DEG)
+    ttl = getattr(settings, "LIVE_STATE_TTL_SECONDS", DEFAULT_TTL_SECONDS)
+    if backend == "redis":
+        return RedisPositionStore(
+            host=settings.REDIS_HOST,
+            port=settings.REDIS_PORT,
+            ttl=ttl,
+            refresh_interval=getattr(settings, "LIVE_STATE_REFRESH_MS", 1000) / 1000,
+            cell_size=cell_size,
+        )
+    if backend != "memory":
+        raise ValueError(f"Unknown LIVE_STATE_BACKEND: {backend!r}")
+    return PositionStore(cell_size, ttl)
+
+
+# Process-wide store shared by every consumer instance.
+position_store = create_position_store()
@@ -0,0 +1,75 @@
+"""
+Motion-adaptive reporting rates for driver apps.
+
+Each vehicle is anchored at the fix where it last stopped moving. Once
+every fix for STATIONARY_WINDOW_SECONDS stays within STATIONARY_RADIUS_M of
+that anchor, the vehicle counts as stationary and its app is told to report
+every LOCATION_STATIONARY_REPORT_INTERVAL_MS. The app also sends early once
+it has moved ``min_distance_m``, so the first fix away from the anchor
+switches it back to the moving interval without waiting out the long one.
+"""
+from django.conf import settings
+
+from .geo import haversine_km
+from .position_store import DEFAULT_TTL_SECONDS
+
+MOVING = "moving"
+STATIONARY = "stationary"
+
+STATIONARY_RADIUS_M = 30
+STATIONARY_WINDOW_SECONDS = 30
+DEFAULT_MOVING_REPORT_INTERVAL_MS = 5000
+DEFAULT_STATIONARY_REPORT_INTERVAL_MS = 50000
+# Stationary vehicles still report this long before the live TTL drops them.
+TTL_MARGIN_SECONDS = 10
+
+
+class ReportingRateController:
+    """Classifies vehicles as moving or stationary from their recent fixes."""
+
+    def __init__(self, moving_ms=None, stationary_ms=None, ttl=None):
+        if moving_ms is None:
+            moving_ms = getattr(
+                settings, "LOCATION_MOVING_REPORT_INTERVAL_MS", DEFAULT_MOVING_REPORT_INTERVAL_MS
+            )
+        if stationary_ms is None:
+            stationary_ms = getattr(
+                settings, "LOCATION_STATIONARY_REPORT_INTERVAL_MS", DEFAULT_STATIONARY_REPORT_INTERVAL_MS
+            )
+        if ttl is None:
+            ttl = getattr(settings, "LIVE_STATE_TTL_SECONDS", DEFAULT_TTL_SECONDS)
+        self.intervals = {
+            MOVING: moving_ms,
+            STATIONARY: max(min(stationary_ms, (ttl - TTL_MARGIN_SECONDS) * 1000), moving_ms),
+        }
+        # position key -> [anchor lat, anchor lng, anchored at, mode]
+        self._anchors = {}
+
+    def forget(self, key):
+        self._anchors.pop(key, None)
+
+    def classify(self, position):
+        """Update the vehicle's anchor from its latest fix and return its mode."""
+        anchor = self._anchors.get(position.key)
+        if anchor is None or haversine_km(
+            anchor[0], anchor[1], position.latitude, position.longitude
+        ) * 1000 > STATIONARY_RADIUS_M:
+            self._anchors[position.key] = [position.latitude, position.longitude, position.updated_at, MOVING]
+            return MOVING
+        if position.updated_at - anchor[2] >= STATIONARY_WINDOW_SECONDS:
+            anchor[3] = STATIONARY
+        return anchor[3]
+
+    def control_frame(self, position, mode):
+        return {
+            "type": "reporting_rate",
+            "id": position.id,
+            "vehicle_type": position.vehicle_type,
+            "mode": mode,
+            "interval_ms": self.intervals[mode],
+            "min_distance_m": STATIONARY_RADIUS_M,
+        }
+
+
+# Process-wide controller shared by the fleet consumers.
+reporting_rate = ReportingRateController()
@@ -0,0 +1,390 @@
+"""
+Map-matching of live fixes onto their route polylines.
+
+Each route's polyline is decoded once into coordinate lists with cumulative
+distances, and every segment is indexed under each grid cell its buffer
+(the allowed offset either side of the line) touches. A fix then needs one
+dict lookup to find the segments it could be on, and is projected only onto
+those, which gives the distance travelled along the route, how far it is
+off the line, and for buses the current/next checkpoint. Routes are looked
+up per driver through their vehicle (the runtime data's ``current_route``,
+else the vehicle's active route), loaded in the background and cached like
+the vehicle details.
+"""
+import asyncio
+import bisect
+import logging
+import math
+import time
+from datetime import date
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db.models import Q
+
+from .geo import KM_PER_DEGREE_LAT, bbox_around, cell_for, cells_in_bbox, decode_polyline, haversine_km
+from .models import BikeRoute, BusCheckpoint, BusRoute, CarRoute
+from .persistence import RUNTIME_MODELS
+
+logger = logging.getLogger(__name__)
+
+# Roughly 550 m; each segment is indexed under the few cells its buffer covers.
+ROUTE_CELL_SIZE_DEG = 0.005
+# Fixes further than this from every segment of their route are off route.
+DEFAULT_ROUTE_MAX_OFFSET_KM = 0.3
+DEFAULT_ROUTE_ASSIGNMENT_TTL_SECONDS = 300
+
+# vehicle_type -> route model
+ROUTE_MODELS = {
+    "bus": BusRoute,
+    "car": CarRoute,
+    "bike": BikeRoute,
+}
+# Candidate segments this close to the best one are treated as equally
+# good, and the one nearest the previous match wins (loops, out-and-back).
+MATCH_TOLERANCE_KM = 0.03
+# Weight of the newest observation in the smoothed speed along the route.
+SPEED_SMOOTHING = 0.3
+MAX_SPEED_KMH = 100
+
+
+class RouteProgress:
+    """Where a vehicle is on its route as of its latest fix."""
+
+    __slots__ = (
+        "route_id",
+        "distance_km",
+        # Distance from the fix to the route line; None while off route
+        "offset_km",
+        "on_route",
+        "checkpoint_id",
+        "next_checkpoint_id",
+        "next_checkpoint_km",
+        # Smoothed speed along the route; None until two fixes matched
+        "speed_kmh",
+        # When distance_km was measured
+        "updated_at",
+    )
+
+    def __init__(self, route_id, distance_km, offset_km, on_route, checkpoint_id,
+                 next_checkpoint_id, next_checkpoint_km, updated_at, speed_kmh=None):
+        self.route_id = route_id
+        self.distance_km = distance_km
+        self.offset_km = offset_km
+        self.on_route = on_route
+        self.checkpoint_id = checkpoint_id
+        self.next_checkpoint_id = next_checkpoint_id
+        self.next_checkpoint_km = next_checkpoint_km
+        self.speed_kmh = speed_kmh
+        self.updated_at = updated_at
+
+    def as_dict(self):
+        return {
+            "route": self.route_id,
+            "distance_km": round(self.distance_km, 3),
+            "offset_km": None if self.offset_km is None else round(self.offset_km, 3),
+            "on_route": self.on_route,
+            "checkpoint": self.checkpoint_id,
+            "next_checkpoint": self.next_checkpoint_id,
+            "next_checkpoint_km": (
+                None if self.next_checkpoint_km is None else round(self.next_checkpoint_km, 3)
+            ),
+            "speed_kmh": None if self.speed_kmh is None else round(self.speed_kmh, 1),
+        }
+
+    @classmethod
+    def from_dict(cls, data, updated_at):
+        """Rebuild progress from ``as_dict()`` output (e.g. another worker's)."""
+        return cls(
+            data["route"],
+            data["distance_km"],
+            data["offset_km"],
+            data["on_route"],
+            data["checkpoint"],
+            data["next_checkpoint"],
+            data["next_checkpoint_km"],
+            updated_at,
+            data.get("speed_kmh"),
+        )
+
+
+class RouteGeometry:
+    """A decoded route polyline with a buffered segment index and checkpoint offsets."""
+
+    def __init__(self, route_id, points, checkpoints=(), buffer_km=DEFAULT_ROUTE_MAX_OFFSET_KM,
+                 cell_size=ROUTE_CELL_SIZE_DEG):
+        self.route_id = route_id
+        self.buffer_km = buffer_km
+        self.cell_size = cell_size
+        self.lats = [lat for lat, _ in points]
+        self.lngs = [lng for _, lng in points]
+        # cumulative[i] is the distance along the route to point i
+        self.cumulative = [0.0]
+        for i in range(1, len(points)):
+            self.cumulative.append(self.cumulative[-1] + haversine_km(*points[i - 1], *points[i]))
+        self.length_km = self.cumulative[-1]
+
+        # grid cell -> indexes of the segments (i, i + 1) whose box, grown
+        # by the buffer, overlaps it; a cell that isn't a key is off route
+        self._segments = {}
+        for i in range(len(points) - 1):
+            south, west, north, east = bbox_around(self.lats[i], self.lngs[i], buffer_km)
+            next_box = bbox_around(self.lats[i + 1], self.lngs[i + 1], buffer_km)
+            box = (min(south, next_box[0]), min(west, next_box[1]), max(north, next_box[2]), max(east, next_box[3]))
+            for cell in cells_in_bbox(*box, cell_size):
+                self._segments.setdefault(cell, []).append(i)
+
+        # (distance along route, checkpoint id), ordered along the route
+        placed = []
+        for checkpoint_id, lat, lng in checkpoints:
+            match = self.project(lat, lng, range(len(points) - 1))
+            if match is not None:
+                placed.append((match[0], checkpoint_id))
+        placed.sort()
+        self.checkpoint_offsets = [offset for offset, _ in placed]
+        self.checkpoint_ids = [checkpoint_id for _, checkpoint_id in placed]
+
+    def project(self, latitude, longitude, segments, previous_km=None):
+        """
+        (distance along route, offset) of the closest point on the given
+        segments, or None when there are none.
+        """
+        # Flat projection around the fix: plenty accurate over a few hundred metres
+        y_scale = KM_PER_DEGREE_LAT
+        x_scale = KM_PER_DEGREE_LAT * math.cos(math.radians(latitude))
+        candidates = []
+        for i in segments:
+            ax = (self.lngs[i] - longitude) * x_scale
+            ay = (self.lats[i] - latitude) * y_scale
+            dx = (self.lngs[i + 1] - longitude) * x_scale - ax
+            dy = (self.lats[i + 1] - latitude) * y_scale - ay
+            length_sq = dx * dx + dy * dy
+            t = 0.0 if length_sq == 0 else min(1.0, max(0.0, -(ax * dx + ay * dy) / length_sq))
+            offset = math.hypot(ax + t * dx, ay + t * dy)
+            along = self.cumulative[i] + t * (self.cumulative[i + 1] - self.cumulative[i])
+            candidates.append((offset, along))
+        if not candidates:
+            return None
+        best_offset = min(offset for offset, _ in candidates)
+        if previous_km is None:
+            return min(candidates)[::-1]
+        close = [c for c in candidates if c[0] <= best_offset + MATCH_TOLERANCE_KM]
+        offset, along = min(close, key=lambda c: abs(c[1] - previous_km))
+        return along, offset
+
+    def match(self, latitude, longitude, previous_km=None):
+        """(distance along route, offset) of a fix, or None when it is off route."""
+        segments = self._segments.get(cell_for(latitude, longitude, self.cell_size))
+        if not segments:
+            return None
+        match = self.project(latitude, longitude, segments, previous_km)
+        if match is None or match[1] > self.buffer_km:
+            return None
+        return match
+
+    def checkpoints_around(self, distance_km):
+        """
+        (last checkpoint passed, next checkpoint, index of the next one) at a
+        distance along the route; ids are None past either end.
+        """
+        i = bisect.bisect_right(self.checkpoint_offsets, distance_km)
+        current = self.checkpoint_ids[i - 1] if i > 0 else None
+        following = self.checkpoint_ids[i] if i < len(self.checkpoint_ids) else None
+        return current, following, i
+
+
+def load_route_assignments(vehicle_type, driver_ids):
+    """Map driver id (str) -> route id (or None) for drivers with a vehicle of this type."""
+    vehicle_model, runtime_model = RUNTIME_MODELS[vehicle_type]
+    numeric_ids = [int(driver_id) for driver_id in driver_ids if str(driver_id).isdigit()]
+    vehicle_drivers = dict(
+        vehicle_model.objects.filter(driver_id__in=numeric_ids).values_list("id", "driver_id")
+    )
+    current = dict(
+        runtime_model.objects
+        .filter(vehicle_id__in=list(vehicle_drivers), current_route__isnull=False)
+        .values_list("vehicle_id", "current_route_id")
+    )
+    today = date.today()
+    # Latest route per vehicle among those running today
+    scheduled = dict(
+        ROUTE_MODELS[vehicle_type].objects
+        .filter(vehicle_id__in=list(vehicle_drivers))
+        .filter(Q(start_date__isnull=True) | Q(start_date__lte=today))
+        .filter(Q(end_date__isnull=True) | Q(end_date__gte=today))
+        .order_by("id")
+        .values_list("vehicle_id", "id")
+    )
+    return {
+        str(driver_id): current.get(vehicle_id, scheduled.get(vehicle_id))
+        for vehicle_id, driver_id in vehicle_drivers.items()
+    }
+
+
+def load_route_geometry(vehicle_type, route_id, buffer_km=DEFAULT_ROUTE_MAX_OFFSET_KM):
+    """RouteGeometry for a route, or None when it has nothing to match against."""
+    polyline = (
+        ROUTE_MODELS[vehicle_type].objects.filter(pk=route_id).values_list("polyline", flat=True).first()
+    )
+    checkpoints = []
+    if vehicle_type == "bus":
+        checkpoints = list(
+            BusCheckpoint.objects
+            .filter(route_id=route_id, lat__isnull=False, lng__isnull=False)
+            .order_by("id")
+            .values_list("id", "lat", "lng")
+        )
+    points = decode_polyline(polyline) if polyline else []
+    if len(points) < 2:
+        # No stored polyline: fall back to the checkpoints in order
+        points = [(lat, lng) for _, lat, lng in checkpoints]
+    if len(points) < 2:
+        return None
+    return RouteGeometry(route_id, points, checkpoints, buffer_km)
+
+
+class RouteMatcher:
+    """
+    Keeps each live vehicle's RouteProgress up to date from its fixes.
+
+    Fixes never wait on the database: route assignments and geometries
+    missing from the cache are loaded by a background task, batched per
+    vehicle type, and a vehicle is tracked once they arrive.
+    """
+
+    def __init__(self, max_offset_km=None, ttl=None):
+        if max_offset_km is None:
+            max_offset_km = getattr(settings, "LOCATION_ROUTE_MAX_OFFSET_KM", DEFAULT_ROUTE_MAX_OFFSET_KM)
+        if ttl is None:
+            ttl = getattr(
+                settings, "LOCATION_ROUTE_ASSIGNMENT_TTL_SECONDS", DEFAULT_ROUTE_ASSIGNMENT_TTL_SECONDS
+            )
+        self.max_offset_km = max_offset_km
+        self.ttl = ttl
+        # position key (vehicle_type, driver id) -> (fetched at, route id or None)
+        self._assignments = {}
+        # (vehicle_type, route id) -> RouteGeometry or None
+        self._geometries = {}
+        # Cache misses waiting for the loader task
+        self._missing_assignments = set()
+        self._missing_geometries = set()
+        self._loader = None
+
+    def assign(self, key, route_id):
+        self._assignments[key] = (time.monotonic(), route_id)
+
+    def forget_route(self, vehicle_type, route_id):
+        self._geometries.pop((vehicle_type, route_id), None)
+
+    def clear_assignments(self):
+        self._assignments.clear()
+
+    def route_for(self, key):
+        """
+        Cached route id of the vehicle with this position key. A miss is
+        queued for the loader and answers None (or the expired entry) for now.
+        """
+        entry = self._assignments.get(key)
+        if entry is not None and time.monotonic() - entry[0] <= self.ttl:
+            return entry[1]
+        self._missing_assignments.add(key)
+        self.ensure_loading()
+        return None if entry is None else entry[1]
+
+    def cached_geometry(self, vehicle_type, route_id):
+        """Cached RouteGeometry of a route; a miss is queued for the loader."""
+        key = (vehicle_type, route_id)
+        if key in self._geometries:
+            return self._geometries[key]
+        self._missing_geometries.add(key)
+        self.ensure_loading()
+        return None
+
+    async def geometry(self, vehicle_type, route_id):
+        key = (vehicle_type, route_id)
+        if key not in self._geometries:
+            try:
+                self._geometries[key] = await database_sync_to_async(load_route_geometry)(
+                    vehicle_type, route_id, self.max_offset_km
+                )
+            except Exception:
+                logger.exception("Could not load %s route %s", vehicle_type, route_id)
+                return None
+        return self._geometries[key]
+
+    def ensure_loading(self):
+        if self._loader is None or self._loader.done():
+            self._loader = asyncio.get_running_loop().create_task(self._load_missing())
+
+    async def _load_missing(self):
+        while self._missing_assignments or self._missing_geometries:
+            missing, self._missing_assignments = self._missing_assignments, set()
+            driver_ids = {}
+            for vehicle_type, driver_id in missing:
+                driver_ids.setdefault(vehicle_type, set()).add(driver_id)
+            for vehicle_type, waiting in driver_ids.items():
+                try:
+                    loaded = await database_sync_to_async(load_route_assignments)(vehicle_type, waiting)
+                except Exception:
+                    # Retried on the vehicles' next fixes
+                    logger.exception("Could not load %s route assignments", vehicle_type)
+                    continue
+                for driver_id in waiting:
+                    self.assign((vehicle_type, driver_id), loaded.get(driver_id))
+            geometries, self._missing_geometries = self._missing_geometries, set()
+            for vehicle_type, route_id in geometries:
+                await self.geometry(vehicle_type, route_id)
+
+    async def track(self, position):
+        """Match a fix onto its vehicle's route and set ``position.route``."""
+        if position.vehicle_type not in ROUTE_MODELS:
+            return None
+        route_id = self.route_for(position.key)
+        geometry = None if route_id is None else self.cached_geometry(position.vehicle_type, route_id)
+        if geometry is None:
+            position.route = None
+            return None
+
+        previous = position.route
+        if previous is not None and previous.route_id != route_id:
+            previous = None
+        match = geometry.match(
+            position.latitude,
+            position.longitude,
+            previous.distance_km if previous is not None else None,
+        )
+        if match is None:
+            # Off route: keep the last known distance, checkpoints and speed
+            if previous is None:
+                position.route = RouteProgress(
+                    route_id, 0.0, None, False, None, None, None, position.updated_at
+                )
+            else:
+                previous.on_route = False
+                previous.offset_km = None
+            return position.route
+
+        distance_km, offset_km = match
+        checkpoint_id, next_checkpoint_id, i = geometry.checkpoints_around(distance_km)
+        next_checkpoint_km = (
+            geometry.checkpoint_offsets[i] - distance_km if next_checkpoint_id is not None else None
+        )
+        speed_kmh = None
+        if previous is not None:
+            speed_kmh = previous.speed_kmh
+            elapsed = position.updated_at - previous.updated_at
+            # Distances measured off route (or the 0 km placeholder of a
+            # vehicle never matched) aren't where it was along the line
+            if previous.on_route and elapsed > 0:
+                observed = (distance_km - previous.distance_km) / elapsed * 3600
+                observed = min(max(observed, 0.0), MAX_SPEED_KMH)
+                speed_kmh = observed if speed_kmh is None else speed_kmh + SPEED_SMOOTHING * (observed - speed_kmh)
+        position.route = RouteProgress(
+            route_id, distance_km, offset_km, True, checkpoint_id,
+            next_checkpoint_id, next_checkpoint_km, position.updated_at, speed_kmh,
+        )
+        return position.route
+
+
+# Process-wide matcher shared by the fleet consumers.
+route_matcher = RouteMatcher()
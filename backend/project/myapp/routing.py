@@ -3,4 +3,5 @@ from . import consumers
 
 websocket_urlpatterns = [
     re_path(r'^ws/bike/$', consumers.BikeLocationConsumer.as_asgi()),
-]
\ No newline at end of file
+    re_path(r'^ws/fleet/$', consumers.FleetLocationConsumer.as_asgi()),
+]
@@ -0,0 +1,173 @@
+"""
+Bounded per-connection outbound queues for the fleet WebSocket.
+
+Broadcast frames are handed to the connection's SendQueue instead of being
+sent from the channel-layer handler, so a slow socket only ever backs up
+its own queue and the consumer keeps draining the channel layer.
+
+When a queue overflows, the queued location frames are dropped and the
+writer sends one fresh snapshot in their place. That snapshot holds only
+the latest fix of each vehicle, so every superseded fix is coalesced away.
+Event frames (alerts, checkpoint events, ETAs) are not in the snapshot, so
+they stay queued. A connection whose frames wait longer than the allowed
+lag, or which overflows repeatedly, is closed.
+"""
+import asyncio
+import logging
+import time
+import weakref
+from collections import deque
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SEND_QUEUE_FRAMES = 50
+DEFAULT_MAX_SEND_LAG_SECONDS = 10
+# Overflows allowed within OVERFLOW_WINDOW_SECONDS before the client is dropped.
+MAX_OVERFLOWS = 3
+OVERFLOW_WINDOW_SECONDS = 60
+# Close code sent to clients that cannot keep up.
+LAGGARD_CLOSE_CODE = 4008
+# Broadcast events a resync snapshot supersedes.
+LOCATION_EVENT_TYPES = frozenset({"batch_location_update", "vehicle_offline"})
+
+# Every live queue in this process, for the connection metrics endpoint.
+live_queues = weakref.WeakSet()
+
+
+class SendQueue:
+    """
+    Frames waiting to go out on one connection, drained by a writer task.
+
+    ``send(event)`` writes one pre-encoded broadcast event and returns the
+    bytes written, ``resync()`` sends a fresh snapshot and ``close(code)``
+    drops the connection; all three are coroutines supplied by the consumer.
+    """
+
+    def __init__(self, send, resync, close, name=None, max_frames=None, max_lag=None):
+        if max_frames is None:
+            max_frames = getattr(settings, "LOCATION_SEND_QUEUE_FRAMES", DEFAULT_SEND_QUEUE_FRAMES)
+        if max_lag is None:
+            max_lag = getattr(settings, "LOCATION_MAX_SEND_LAG_SECONDS", DEFAULT_MAX_SEND_LAG_SECONDS)
+        self.name = name
+        self.max_frames = max_frames
+        self.max_lag = max_lag
+        self._send = send
+        self._resync = resync
+        self._close = close
+        # (enqueued at, event)
+        self._frames = deque()
+        self._needs_resync = False
+        self._overflows = deque()
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._closing = None
+        self.closed = False
+        self.connected_at = time.time()
+        self.frames_sent = 0
+        self.frames_dropped = 0
+        self.bytes_sent = 0
+        self.resyncs = 0
+        self.last_lag = 0.0
+        self.max_seen_lag = 0.0
+        live_queues.add(self)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def put(self, event):
+        """Queue a broadcast event; never blocks the channel-layer handler."""
+        if self.closed:
+            return
+        if len(self._frames) >= self.max_frames:
+            self.overflow(event)
+            return
+        self._frames.append((time.monotonic(), event))
+        self._wakeup.set()
+
+    def overflow(self, event):
+        """
+        Replace the queued location frames with one snapshot, or give up on
+        the client. Event frames stay queued.
+        """
+        now = time.monotonic()
+        self._overflows.append(now)
+        while self._overflows and now - self._overflows[0] > OVERFLOW_WINDOW_SECONDS:
+            self._overflows.popleft()
+        queued = len(self._frames)
+        self._frames = deque(
+            entry for entry in self._frames if entry[1]["type"] not in LOCATION_EVENT_TYPES
+        )
+        if event["type"] not in LOCATION_EVENT_TYPES and len(self._frames) < self.max_frames:
+            self._frames.append((now, event))
+        self.frames_dropped += queued + 1 - len(self._frames)
+        if len(self._overflows) > MAX_OVERFLOWS:
+            self.give_up("Closing fleet socket after %d overflows", len(self._overflows))
+        elif len(self._frames) >= self.max_frames:
+            self.give_up("Closing fleet socket with %d event frames queued", len(self._frames))
+        else:
+            self._needs_resync = True
+            self._wakeup.set()
+
+    def give_up(self, reason, *args):
+        """Stop writing and close the connection, even if a send is stuck."""
+        logger.info(reason, *args)
+        self.closed = True
+        self._frames.clear()
+        if self._task is not None:
+            self._task.cancel()
+        self._closing = asyncio.get_running_loop().create_task(self._close(LAGGARD_CLOSE_CODE))
+
+    async def _run(self):
+        try:
+            while True:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                while not self.closed and (self._needs_resync or self._frames):
+                    if self._needs_resync:
+                        self._needs_resync = False
+                        self.resyncs += 1
+                        await self._resync()
+                        continue
+                    enqueued_at, event = self._frames.popleft()
+                    lag = time.monotonic() - enqueued_at
+                    self.last_lag = lag
+                    self.max_seen_lag = max(self.max_seen_lag, lag)
+                    if lag > self.max_lag:
+                        self.give_up("Closing fleet socket %.1fs behind", lag)
+                        return
+                    self.bytes_sent += await self._send(event) or 0
+                    self.frames_sent += 1
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            logger.exception("Fleet socket writer failed")
+
+    async def stop(self):
+        self.closed = True
+        live_queues.discard(self)
+        if self._task is not None and self._task is not asyncio.current_task():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+
+    def stats(self):
+        return {
+            "name": self.name,
+            "connected_at": self.connected_at,
+            "queued": len(self._frames),
+            "oldest_wait_seconds": (
+                round(time.monotonic() - self._frames[0][0], 3) if self._frames else 0.0
+            ),
+            "frames_sent": self.frames_sent,
+            "frames_dropped": self.frames_dropped,
+            "bytes_sent": self.bytes_sent,
+            "resyncs": self.resyncs,
+            "last_lag_seconds": round(self.last_lag, 3),
+            "max_lag_seconds": round(self.max_seen_lag, 3),
+        }
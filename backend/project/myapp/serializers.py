@@ -128,6 +128,8 @@ class BikeRouteSerializer(serializers.ModelSerializer):
         
 def generate_tokens_for_user(user, role):
     refresh = RefreshToken.for_user(user)  # Generate JWT tokens
+    # Driver and conductor ids overlap auth user ids; the role tells them apart
+    refresh['role'] = role
     return {
         'refresh': str(refresh),
         'access': str(refresh.access_token),
@@ -0,0 +1,85 @@
+"""
+Keep the live-tracking caches (vehicle details, reverse geocoder places,
+route geometry and assignments, geofences) in step with model edits.
+"""
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from .geocoder import reverse_geocoder
+from .geofence import geofence_monitor
+from .models import (
+    Bike, BikeRoute, BikeRuntimeData, Bus, BusCheckpoint, BusRoute, BusRuntimeData, Car, CarRoute,
+    CarRuntimeData, Place,
+)
+from .route_matching import route_matcher
+from .vehicle_details import vehicle_details
+
+VEHICLE_MODEL_TYPES = {Bus: "bus", Car: "car", Bike: "bike"}
+
+
+@receiver(pre_save, sender=Bus)
+@receiver(pre_save, sender=Car)
+@receiver(pre_save, sender=Bike)
+def forget_previous_driver(sender, instance, **kwargs):
+    # A vehicle handed to another driver must drop off the old driver too
+    if instance.pk is None:
+        return
+    previous = sender.objects.filter(pk=instance.pk).values_list("driver_id", flat=True).first()
+    if previous is not None and previous != instance.driver_id:
+        vehicle_details.invalidate(VEHICLE_MODEL_TYPES[sender], previous)
+
+
+@receiver(post_save, sender=Bus)
+@receiver(post_save, sender=Car)
+@receiver(post_save, sender=Bike)
+@receiver(post_delete, sender=Bus)
+@receiver(post_delete, sender=Car)
+@receiver(post_delete, sender=Bike)
+def forget_vehicle_details(sender, instance, **kwargs):
+    if instance.driver_id is not None:
+        vehicle_details.invalidate(VEHICLE_MODEL_TYPES[sender], instance.driver_id)
+
+
+@receiver(post_save, sender=BusCheckpoint)
+@receiver(post_save, sender=BusRoute)
+@receiver(post_save, sender=Place)
+@receiver(post_delete, sender=BusCheckpoint)
+@receiver(post_delete, sender=BusRoute)
+@receiver(post_delete, sender=Place)
+def reload_places(sender, instance, **kwargs):
+    reverse_geocoder.invalidate()
+
+
+ROUTE_MODEL_TYPES = {BusRoute: "bus", CarRoute: "car", BikeRoute: "bike"}
+
+
+@receiver(post_save, sender=BusRoute)
+@receiver(post_save, sender=CarRoute)
+@receiver(post_save, sender=BikeRoute)
+@receiver(post_delete, sender=BusRoute)
+@receiver(post_delete, sender=CarRoute)
+@receiver(post_delete, sender=BikeRoute)
+def reload_route(sender, instance, **kwargs):
+    route_matcher.forget_route(ROUTE_MODEL_TYPES[sender], instance.pk)
+    route_matcher.clear_assignments()
+
+
+@receiver(post_save, sender=BusCheckpoint)
+@receiver(post_delete, sender=BusCheckpoint)
+def reload_checkpoint_route(sender, instance, **kwargs):
+    route_matcher.forget_route("bus", instance.route_id)
+    geofence_monitor.invalidate()
+
+
+@receiver(post_save, sender=Bus)
+@receiver(post_save, sender=Car)
+@receiver(post_save, sender=Bike)
+@receiver(post_save, sender=BusRuntimeData)
+@receiver(post_save, sender=CarRuntimeData)
+@receiver(post_save, sender=BikeRuntimeData)
+@receiver(post_delete, sender=Bus)
+@receiver(post_delete, sender=Car)
+@receiver(post_delete, sender=Bike)
+def reload_route_assignments(sender, instance, **kwargs):
+    # Vehicle reassignments and current_route edits; rare enough to drop them all
+    route_matcher.clear_assignments()
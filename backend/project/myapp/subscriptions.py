@@ -0,0 +1,123 @@
+"""
+Which broadcast groups have subscribers, so the broadcaster only encodes
+and sends frames somebody will receive.
+
+Consumers register the location groups they join and leave. With more than
+one worker process, each worker publishes its own groups to Redis and reads
+back everyone else's, since a fix reported to one worker has to reach
+subscribers connected to another.
+"""
+import logging
+import time
+import uuid
+from collections import Counter
+
+from django.conf import settings
+from redis import asyncio as aioredis
+
+logger = logging.getLogger(__name__)
+
+# A worker that stops publishing its groups is forgotten after this long.
+DEFAULT_WORKER_TTL_SECONDS = 10
+
+
+class SubscriptionRegistry:
+    """Subscriber counts per broadcast group on this worker."""
+
+    def __init__(self):
+        self._local = Counter()
+
+    def add(self, groups):
+        for group in groups:
+            self._local[group] += 1
+
+    def discard(self, groups):
+        for group in groups:
+            if self._local[group] <= 1:
+                del self._local[group]
+            else:
+                self._local[group] -= 1
+
+    def groups(self):
+        """Every group with a subscriber."""
+        return self._local.keys()
+
+    def __contains__(self, group):
+        return group in self._local
+
+    async def sync(self):
+        """Exchange groups with other workers. Nothing to do in memory."""
+
+
+class RedisSubscriptionRegistry(SubscriptionRegistry):
+    """
+    SubscriptionRegistry shared across worker processes through Redis.
+
+    Each worker keeps its groups in a Redis set and heartbeats its id into a
+    sorted set of live workers; ``sync()`` rewrites our set when it changed
+    and reads the union of the other live workers' sets.
+    """
+
+    key_prefix = "fleet:groups:"
+    workers_key = "fleet:group-workers"
+
+    def __init__(self, host, port, worker_ttl=DEFAULT_WORKER_TTL_SECONDS):
+        super().__init__()
+        self.host = host
+        self.port = port
+        self.worker_ttl = worker_ttl
+        self.worker_id = uuid.uuid4().hex[:12]
+        self._redis = None
+        self._remote = frozenset()
+        self._changed = True
+
+    @property
+    def redis(self):
+        if self._redis is None:
+            self._redis = aioredis.Redis(host=self.host, port=self.port, decode_responses=True)
+        return self._redis
+
+    def add(self, groups):
+        super().add(groups)
+        self._changed = True
+
+    def discard(self, groups):
+        super().discard(groups)
+        self._changed = True
+
+    def groups(self):
+        return self._local.keys() | self._remote
+
+    def __contains__(self, group):
+        return group in self._local or group in self._remote
+
+    async def sync(self):
+        name = self.key_prefix + self.worker_id
+        now = time.time()
+        changed, self._changed = self._changed, False
+        try:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                if changed:
+                    pipe.delete(name)
+                    if self._local:
+                        pipe.sadd(name, *self._local)
+                pipe.expire(name, self.worker_ttl)
+                pipe.zadd(self.workers_key, {self.worker_id: now})
+                pipe.zremrangebyscore(self.workers_key, "-inf", now - self.worker_ttl)
+                pipe.zrange(self.workers_key, 0, -1)
+                workers = (await pipe.execute())[-1]
+            others = [self.key_prefix + worker for worker in workers if worker != self.worker_id]
+            self._remote = frozenset(await self.redis.sunion(others)) if others else frozenset()
+        except Exception:
+            self._changed = self._changed or changed
+            logger.exception("Could not sync fleet subscriptions with Redis")
+
+
+def create_subscription_registry():
+    if getattr(settings, "LIVE_STATE_BACKEND", "memory") == "redis":
+        return RedisSubscriptionRegistry(settings.REDIS_HOST, settings.REDIS_PORT)
+    return SubscriptionRegistry()
+
+
+# Process-wide registry shared by the broadcaster and every consumer.
+subscriptions = create_subscription_registry()
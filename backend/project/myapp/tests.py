@@ -1,3 +1,982 @@
-from django.test import TestCase
+import asyncio
+import json
+import math
+import random
+import time
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from channels.testing import WebsocketCommunicator
+from django.core.management import call_command
+from django.test import SimpleTestCase, override_settings
+from django.urls import reverse
+
+from .broadcaster import LocationBroadcaster, cell_group, location_group
+from .eta import DEFAULT_BUS_SPEED_KMH, MIN_BUS_SPEED_KMH, EtaEngine, compute_arrivals
+from .deviation import ALERTS_GROUP, DeviationDetector
+from .fleet_auth import ANONYMOUS, DRIVER, FleetIdentity
+from .geo import PolylineEncoder, bbox_around, bbox_cell_count, cells_in_bbox, encode_polyline, haversine_km
+from .geofence import GeofenceMonitor, checkpoint_group
+from .ingest import FixIngestor, parse_batch, parse_coordinates
+from .management.commands.loadtest_fleet import Command, NullRecorder, as_identity
+from .nearest import parse_nearest_query
+from .persistence import ALERT_RAISE, ALERT_RESOLVE, RowWriter
+from .position_store import PositionStore
+from .reporting_rate import ReportingRateController
+from .route_matching import RouteGeometry, RouteMatcher, RouteProgress
+from .send_queue import LAGGARD_CLOSE_CODE, SendQueue
+from .subscriptions import SubscriptionRegistry
+from .wire import decode_binary, encode_binary, encode_json
+
+
+class WireTests(SimpleTestCase):
+    def setUp(self):
+        self.store = PositionStore()
+        self.now = 1_700_000_000
+        self.bus = self.store.upsert("bus", 7, 18.520431, 73.856743, updated_at=self.now - 3)
+        self.car = self.store.upsert("car", "12", -33.868820, 151.209296, updated_at=self.now)
+
+    def test_delta_round_trip(self):
+        frame = {
+            "type": "batch_location_update",
+            "mode": "delta",
+            "group": "location.bus.925_3692",
+            "stream": "0123456789ab",
+            "seq": 41,
+            "prev_seq": 40,
+            "data": [self.bus, self.car],
+            "removed": [{"id": 3, "vehicle_type": "bike"}],
+        }
+        decoded = decode_binary(encode_binary(frame, now=self.now))
+        self.assertEqual(decoded["group"], frame["group"])
+        self.assertEqual(decoded["stream"], frame["stream"])
+        self.assertEqual((decoded["seq"], decoded["prev_seq"]), (41, 40))
+        self.assertEqual(decoded["removed"], frame["removed"])
+        self.assertEqual(
+            [(record["id"], record["vehicle_type"], record["updated_at"]) for record in decoded["data"]],
+            [(7, "bus", self.now - 3), (12, "car", self.now)],
+        )
+        for record, position in zip(decoded["data"], (self.bus, self.car)):
+            self.assertAlmostEqual(record["latitude"], position.latitude, places=6)
+            self.assertAlmostEqual(record["longitude"], position.longitude, places=6)
+
+    def test_snapshot_and_offline_round_trip(self):
+        snapshot = {
+            "type": "batch_location_update",
+            "mode": "snapshot",
+            "stream": "00000000beef",
+            "seqs": {"location.bus": 5, "location.bus-2000ms": 2},
+            "data": [self.bus],
+        }
+        decoded = decode_binary(encode_binary(snapshot, now=self.now))
+        self.assertEqual(decoded["mode"], "snapshot")
+        self.assertEqual(decoded["seqs"], snapshot["seqs"])
+        self.assertEqual(decoded["removed"], [])
+
+        offline = {"type": "vehicle_offline", "data": [{"id": 7, "vehicle_type": "bus"}]}
+        self.assertEqual(decode_binary(encode_binary(offline, now=self.now))["data"], offline["data"])
+
+    def test_unpackable_frame_falls_back_to_json(self):
+        position = self.store.upsert("bike", "driver-x", 18.5, 73.8)
+        frame = {"type": "batch_location_update", "mode": "snapshot", "seqs": {}, "data": [position]}
+        self.assertIsNone(encode_binary(frame))
+        self.assertEqual(json.loads(encode_json(frame))["data"][0]["id"], "driver-x")
+
+
+class ExpiryWheelTests(SimpleTestCase):
+    def setUp(self):
+        self.store = PositionStore(ttl=60)
+        self.now = 1_000.0
+
+    def sweep(self, start, end):
+        expired = []
+        for second in range(start, end):
+            expired.extend(self.store.expire(self.now + second))
+        return [position.id for position in expired]
+
+    def test_expires_after_ttl(self):
+        self.store.upsert("bus", 1, 18.5, 73.8, updated_at=self.now)
+        self.assertEqual(self.sweep(0, 60), [])
+        self.assertEqual(self.sweep(60, 62), [1])
+        self.assertEqual(len(self.store), 0)
+
+    def test_new_fix_moves_the_deadline(self):
+        self.store.upsert("bus", 1, 18.5, 73.8, updated_at=self.now)
+        self.sweep(0, 30)
+        self.store.upsert("bus", 1, 18.5, 73.8, updated_at=self.now + 30)
+        self.assertEqual(self.sweep(30, 90), [])
+        self.assertEqual(self.sweep(90, 92), [1])
+
+    def test_fix_behind_the_sweep_cursor_expires_next_sweep(self):
+        self.store.upsert("bus", 1, 18.5, 73.8, updated_at=self.now)
+        self.sweep(0, 200)
+        self.store.upsert("bus", 2, 18.5, 73.8, updated_at=self.now + 100)
+        self.assertEqual(self.sweep(200, 201), [2])
+        self.assertEqual(len(self.store), 0)
+
+    def test_long_gap_between_sweeps(self):
+        self.store.upsert("bus", 1, 18.5, 73.8, updated_at=self.now)
+        self.store.upsert("bus", 2, 18.5, 73.8, updated_at=self.now + 5000)
+        self.store.expire(self.now)
+        self.assertEqual(self.sweep(4000, 4001), [1])
+        self.assertEqual(self.sweep(5061, 5062), [2])
+
+    def test_removed_vehicle_is_not_expired(self):
+        self.store.upsert("bus", 1, 18.5, 73.8, updated_at=self.now)
+        self.store.remove("bus", 1)
+        self.store.upsert("bus", 1, 18.5, 73.8, updated_at=self.now + 50)
+        self.assertEqual(self.sweep(0, 110), [])
+        self.assertEqual(self.sweep(110, 112), [1])
+
+
+class GridTests(SimpleTestCase):
+    def test_cell_count_matches_the_cells(self):
+        rng = random.Random(5)
+        for _ in range(50):
+            south, north = sorted(rng.uniform(-5, 5) for _ in range(2))
+            west, east = sorted(rng.uniform(-5, 5) for _ in range(2))
+            box = (south, west, north, east)
+            self.assertEqual(bbox_cell_count(*box, 0.5), len(cells_in_bbox(*box, 0.5)))
+        self.assertEqual(bbox_cell_count(1, 0, -1, 0, 0.5), 0)
+
+    def test_huge_radius_is_clipped_to_the_map(self):
+        self.assertEqual(bbox_around(18.5, 73.8, 1e308), (-90.0, -180.0, 90.0, 180.0))
+        self.assertEqual(bbox_cell_count(*bbox_around(0, 0, 1e9), 0.02), 9001 * 18001)
+
+
+class RecordingLayer:
+    def __init__(self):
+        self.sent = []
+
+    async def group_send(self, group, event):
+        self.sent.append((group, event))
+
+
+class NullDetails:
+    async def attach(self, positions):
+        pass
+
+
+class SyncCountingStore(PositionStore):
+    syncs = 0
+
+    async def sync(self):
+        self.syncs += 1
+
+
+@override_settings(LOCATION_UPDATE_INTERVAL_TIERS_MS=(1000, 2000), LOCATION_MAX_UPDATE_INTERVAL_MS=10000)
+class BroadcasterTests(SimpleTestCase):
+    def setUp(self):
+        self.store = SyncCountingStore()
+        self.layer = RecordingLayer()
+        self.broadcaster = LocationBroadcaster(
+            self.store, interval_ms=500, channel_layer=self.layer, details=NullDetails(),
+            subscriptions=SubscriptionRegistry(),
+        )
+
+    async def asyncTearDown(self):
+        await self.broadcaster.stop()
+
+    def frames(self):
+        sent, self.layer.sent = self.layer.sent, []
+        return [(group, json.loads(event["text"])) for group, event in sent]
+
+    def test_tier_for(self):
+        self.assertEqual(self.broadcaster.tiers, {1000: 2, 2000: 4})
+        for requested, tier in ((None, None), (0, None), (300, None), (800, 1000), (1500, 2000), (60000, 2000)):
+            with self.subTest(requested=requested):
+                self.assertEqual(self.broadcaster.tier_for(requested), tier)
+
+    async def test_unsubscribed_fixes_are_still_written_behind(self):
+        self.broadcaster.publish_position(self.store.upsert("car", 1, 18.5, 73.8))
+        await self.broadcaster.flush()
+        self.assertEqual(self.frames(), [])
+        self.assertEqual(self.store.syncs, 1)
+        await self.broadcaster.flush()
+        self.assertEqual(self.store.syncs, 2)
+
+    async def test_slower_tiers_coalesce_between_flushes(self):
+        every_tick = location_group("car")
+        slow = location_group("car", 2000)
+        self.broadcaster.watch({every_tick, slow})
+        for tick in range(4):
+            self.broadcaster.publish_position(self.store.upsert("car", tick % 2, 18.5 + tick / 100, 73.8))
+            await self.broadcaster.flush()
+            frames = dict(self.frames())
+            self.assertEqual(set(frames), {every_tick} if tick < 3 else {every_tick, slow})
+        frame = frames[slow]
+        self.assertEqual((frame["seq"], frame["prev_seq"]), (1, 0))
+        self.assertEqual({record["id"]: record["latitude"] for record in frame["data"]}, {0: 18.52, 1: 18.53})
+
+    async def test_vehicle_moving_cells_is_removed_from_the_old_cell(self):
+        self.store.upsert("car", 1, 18.5, 73.8)
+        moved = self.store.upsert("car", 1, 18.6, 73.8)
+        old_group = cell_group("car", moved.prev_cell)
+        new_group = cell_group("car", moved.cell)
+        self.broadcaster.watch({old_group, new_group})
+        self.broadcaster.publish_position(moved)
+        await self.broadcaster.flush()
+        frames = dict(self.frames())
+        self.assertEqual(frames[old_group]["removed"], [{"id": 1, "vehicle_type": "car"}])
+        self.assertEqual([record["id"] for record in frames[new_group]["data"]], [1])
+
+
+class RowWriterTests(SimpleTestCase):
+    def setUp(self):
+        self.batches = []
+        self.writer = RowWriter(self.batches.append, "TEST_FLUSH_SECONDS", 60, batch_size=3)
+
+    async def asyncTearDown(self):
+        self.writer._task.cancel()
+
+    async def test_rows_wait_for_the_interval(self):
+        self.writer.record("bus", 1)
+        self.writer.record_many([("bus", 2)])
+        await asyncio.sleep(0)
+        self.assertEqual(self.batches, [])
+        await self.writer.flush()
+        self.assertEqual(self.batches, [[("bus", 1), ("bus", 2)]])
+        await self.writer.flush()
+        self.assertEqual(len(self.batches), 1)
+
+    async def test_full_batch_flushes_early(self):
+        self.writer.record_many([("bus", 1), ("bus", 2)])
+        self.writer.record("bus", 3)
+        await self.writer._early_tick
+        self.assertEqual(self.batches, [[("bus", 1), ("bus", 2), ("bus", 3)]])
+
+
+class FailingWrite:
+    def __init__(self):
+        self.failures = 1
+        self.batches = []
+
+    def __call__(self, rows):
+        if self.failures:
+            self.failures -= 1
+            raise RuntimeError("database is down")
+        self.batches.append(rows)
+
+
+class RowWriterRetryTests(SimpleTestCase):
+    async def test_failed_rows_are_retried_first(self):
+        write = FailingWrite()
+        writer = RowWriter(write, "TEST_FLUSH_SECONDS", 60, batch_size=3, max_buffered=2)
+        writer.record_many([(1,), (2,)])
+        flush = asyncio.ensure_future(writer.flush())
+        await asyncio.sleep(0)
+        writer.record(3)
+        with self.assertLogs("myapp.persistence", "ERROR"):
+            await flush
+        # Put back ahead of the newer row, oldest dropped past the cap
+        self.assertEqual(writer._rows, [(2,), (3,)])
+        writer.record(4)
+        # and no early flushes hammering a failing database
+        self.assertIsNone(writer._early_tick)
+        await writer.flush()
+        writer._task.cancel()
+        self.assertEqual(write.batches, [[(2,), (3,), (4,)]])
+
+    async def test_without_a_cap_failed_rows_are_dropped(self):
+        write = FailingWrite()
+        writer = RowWriter(write, "TEST_FLUSH_SECONDS", 60)
+        writer.record(1)
+        with self.assertRaises(RuntimeError):
+            await writer.flush()
+        await writer.flush()
+        writer._task.cancel()
+        self.assertEqual(write.batches, [])
+
+
+class SendQueueTests(SimpleTestCase):
+    def setUp(self):
+        self.log = []
+
+    async def send(self, event):
+        self.log.append(event["text"])
+        return len(event["text"])
+
+    async def resync(self):
+        self.log.append("snapshot")
+
+    async def close(self, code):
+        self.log.append(("close", code))
+
+    def queue(self, **options):
+        return SendQueue(self.send, self.resync, self.close, **options)
+
+    @staticmethod
+    def location(text):
+        return {"type": "batch_location_update", "text": text}
+
+    @staticmethod
+    def alert(text):
+        return {"type": "fleet.alert", "text": text}
+
+    async def drain(self, queue):
+        queue.start()
+        for _ in range(10):
+            await asyncio.sleep(0)
+        await queue.stop()
+
+    async def test_frames_go_out_in_order(self):
+        queue = self.queue(max_frames=5)
+        for text in ("a", "b", "c"):
+            queue.put(self.location(text))
+        await self.drain(queue)
+        self.assertEqual(self.log, ["a", "b", "c"])
+        self.assertEqual((queue.frames_sent, queue.bytes_sent, queue.frames_dropped), (3, 3, 0))
+
+    async def test_overflow_resyncs_and_keeps_events(self):
+        queue = self.queue(max_frames=3)
+        queue.put(self.location("a"))
+        queue.put(self.alert("alert 1"))
+        queue.put(self.location("b"))
+        queue.put(self.location("c"))
+        queue.put(self.alert("alert 2"))
+        await self.drain(queue)
+        self.assertEqual(self.log, ["snapshot", "alert 1", "alert 2"])
+        self.assertEqual((queue.frames_dropped, queue.resyncs), (3, 1))
+
+    async def test_queue_full_of_events_is_closed(self):
+        queue = self.queue(max_frames=2)
+        for text in ("alert 1", "alert 2", "alert 3"):
+            queue.put(self.alert(text))
+        await queue._closing
+        self.assertTrue(queue.closed)
+        self.assertEqual(self.log, [("close", LAGGARD_CLOSE_CODE)])
+        queue.put(self.alert("alert 4"))
+        self.assertEqual(queue.stats()["queued"], 0)
+
+    async def test_repeated_overflows_close_the_socket(self):
+        queue = self.queue(max_frames=1)
+        for text in "abcdefgh":
+            queue.put(self.location(text))
+        await queue._closing
+        self.assertEqual(self.log, [("close", LAGGARD_CLOSE_CODE)])
+
+    async def test_lagging_socket_is_closed(self):
+        queue = self.queue(max_lag=0.01)
+        queue.put(self.location("a"))
+        await asyncio.sleep(0.05)
+        queue.start()
+        await asyncio.sleep(0)
+        await queue._closing
+        self.assertEqual(self.log, [("close", LAGGARD_CLOSE_CODE)])
+
+
+@override_settings(LOCATION_RESUME_HISTORY_FRAMES=3, LOCATION_RESUME_WINDOW_SECONDS=60)
+class ResumeHistoryTests(SimpleTestCase):
+    def setUp(self):
+        self.store = PositionStore()
+        self.broadcaster = LocationBroadcaster(
+            self.store, interval_ms=500, channel_layer=RecordingLayer(), details=NullDetails(),
+            subscriptions=SubscriptionRegistry(),
+        )
+        self.group = location_group("car")
+        self.broadcaster.watch({self.group})
+
+    async def asyncTearDown(self):
+        await self.broadcaster.stop()
+
+    async def fix(self, vehicle_id):
+        self.broadcaster.publish_position(self.store.upsert("car", vehicle_id, 18.5, 73.8))
+        await self.broadcaster.flush()
+
+    async def test_changed_since(self):
+        await self.fix(1)
+        await self.fix(2)
+        self.broadcaster.publish_offline(self.store.remove("car", 1))
+        await self.fix(3)
+        changed = self.broadcaster.changed_since
+        self.assertEqual(self.broadcaster.current_frame_seq(self.group), 3)
+        self.assertEqual(changed(self.group, 3), set())
+        self.assertEqual(changed(self.group, 2), {("car", "1"), ("car", "3")})
+        # History keeps three entries; seq 0 has dropped out of it
+        self.assertEqual(changed(self.group, 1), {("car", "1"), ("car", "2"), ("car", "3")})
+        self.assertIsNone(changed(self.group, 0))
+        self.assertIsNone(changed(self.group, 4))
+        self.assertIsNone(changed(location_group("bus"), 0))
+
+    async def test_idle_group_is_forgotten_and_its_seqs_move_on(self):
+        await self.fix(1)
+        self.broadcaster.unwatch({self.group})
+        now = time.monotonic()
+        self.broadcaster.prune_groups(now + 30)
+        self.assertEqual(self.broadcaster.changed_since(self.group, 0), {("car", "1")})
+        self.broadcaster.prune_groups(now + 61)
+        self.assertIsNone(self.broadcaster.changed_since(self.group, 0))
+        self.assertEqual(self.broadcaster._history, {})
+
+        self.broadcaster.watch({self.group})
+        # A client still holding seq 1 can't be caught up from the new history
+        self.assertIsNone(self.broadcaster.changed_since(self.group, 1))
+        await self.fix(2)
+        self.assertEqual(self.broadcaster.current_frame_seq(self.group), 3)
+
+
+class ParseBatchTests(SimpleTestCase):
+    now = 1_700_000_000
+
+    def test_fixes_are_sorted_oldest_first(self):
+        fixes = parse_batch({"fixes": [
+            {"latitude": 18.51, "longitude": 73.81, "recorded_at": self.now - 10},
+            {"latitude": "18.50", "longitude": "73.80", "recorded_at": self.now - 20},
+        ]}, now=self.now)
+        self.assertEqual(fixes, [(self.now - 20, 18.5, 73.8), (self.now - 10, 18.51, 73.81)])
+
+    def test_polyline_trail(self):
+        points = [(18.5, 73.8), (18.50012, 73.80034), (18.5003, 73.8009)]
+        times = PolylineEncoder(dimensions=1)
+        data = {
+            "polyline": encode_polyline(points),
+            "times": "".join(times.add(self.now - 30 + 5 * i) for i in range(len(points))),
+        }
+        fixes = parse_batch(data, now=self.now)
+        self.assertEqual([fix[0] for fix in fixes], [self.now - 30, self.now - 25, self.now - 20])
+        for (_, lat, lng), (expected_lat, expected_lng) in zip(fixes, points):
+            self.assertAlmostEqual(lat, expected_lat, places=5)
+            self.assertAlmostEqual(lng, expected_lng, places=5)
+
+    def test_malformed_batches_are_rejected(self):
+        for data in (
+            {},
+            {"fixes": "nope"},
+            {"fixes": [{"latitude": 18.5, "longitude": 73.8}]},
+            {"fixes": [{"latitude": "x", "longitude": 73.8, "recorded_at": self.now}]},
+            {"fixes": [1, 2]},
+            {"polyline": encode_polyline([(18.5, 73.8)]), "times": ""},
+            {"fixes": [{"latitude": 18.5, "longitude": 73.8, "recorded_at": self.now}] * 2001},
+        ):
+            with self.subTest(data=str(data)[:60]):
+                with self.assertRaises(ValueError):
+                    parse_batch(data, now=self.now)
+
+    def test_bad_fixes_are_dropped(self):
+        fixes = parse_batch({"fixes": [
+            {"latitude": 18.5, "longitude": 73.8, "recorded_at": self.now + 3600},
+            {"latitude": float("nan"), "longitude": 73.8, "recorded_at": self.now},
+            {"latitude": 91, "longitude": 73.8, "recorded_at": self.now},
+            {"latitude": 18.5, "longitude": float("inf"), "recorded_at": self.now},
+            {"latitude": 18.5, "longitude": 73.8, "recorded_at": self.now},
+        ]}, now=self.now)
+        self.assertEqual(fixes, [(self.now, 18.5, 73.8)])
+
+    def test_parse_coordinates(self):
+        self.assertEqual(parse_coordinates("18.7", 73), (18.7, 73.0))
+        for latitude, longitude in ((float("nan"), 73.8), (18.5, 181), (None, 73.8), ("north", 73.8)):
+            with self.subTest(latitude=latitude, longitude=longitude):
+                with self.assertRaises(ValueError):
+                    parse_coordinates(latitude, longitude)
+
+
+class NullBroadcaster:
+    def publish_position(self, position):
+        pass
+
+    def on_expire(self, callback):
+        pass
+
+
+class NullGeocoder:
+    async def label(self, latitude, longitude):
+        return None
+
+
+class NullTracker:
+    async def track(self, position):
+        pass
+
+
+class RecordingHistory(NullRecorder):
+    def __init__(self):
+        self.rows = []
+
+    def record(self, *row):
+        self.rows.append(row)
+
+    def record_many(self, rows):
+        self.rows.extend(rows)
+
+
+class IngestBatchTests(SimpleTestCase):
+    def setUp(self):
+        self.store = PositionStore(ttl=60)
+        self.history = RecordingHistory()
+        self.ingestor = FixIngestor(
+            store=self.store, broadcaster=NullBroadcaster(), persister=NullRecorder(),
+            history=self.history, geocoder=NullGeocoder(), routes=NullTracker(), geofence=NullTracker(),
+            deviation=NullTracker(),
+        )
+
+    async def test_newest_fix_goes_live(self):
+        now = time.time()
+        fixes = [(now - 10, 18.5, 73.8), (now - 5, 18.51, 73.81)]
+        position = await self.ingestor.ingest_batch("bike", 1, fixes)
+        self.assertEqual((position.latitude, position.updated_at), (18.51, now - 5))
+        self.assertEqual(len(self.history.rows), 2)
+
+    async def test_batch_older_than_ttl_is_history_only(self):
+        now = time.time()
+        position = await self.ingestor.ingest_batch("bike", 1, [(now - 120, 18.5, 73.8)])
+        self.assertIsNone(position)
+        self.assertIsNone(self.store.get("bike", 1))
+        self.assertEqual(self.history.rows, [("bike", 1, now - 120, 18.5, 73.8)])
+
+    async def test_backfill_behind_the_live_fix_is_history_only(self):
+        now = time.time()
+        self.store.upsert("bike", 1, 18.6, 73.9, updated_at=now)
+        position = await self.ingestor.ingest_batch("bike", 1, [(now - 5, 18.5, 73.8)])
+        self.assertIsNone(position)
+        self.assertEqual(self.store.get("bike", 1).latitude, 18.6)
+
+
+def metres_north(metres):
+    return metres / 1000 / 111.32
+
+
+class GeofenceTests(SimpleTestCase):
+    def setUp(self):
+        self.monitor = GeofenceMonitor(radius_m=75, recorder=NullRecorder())
+        # Two checkpoints of different routes, 11 m apart
+        self.monitor.index([(10, 1, 18.5, 73.8), (11, 2, 18.5, 73.8001)])
+        self.store = PositionStore()
+
+    def detect(self, metres, route=None):
+        position = self.store.upsert("bus", 1, 18.5 + metres_north(metres), 73.8)
+        position.route = route
+        return self.monitor.detect(position)
+
+    def test_arrival_and_departure_with_hysteresis(self):
+        self.assertEqual(self.detect(200), [])
+        self.assertEqual(self.detect(60), [("arrival", 10, 1), ("arrival", 11, 2)])
+        self.assertEqual(self.detect(5), [])
+        # Between the arrival and departure radii: still there
+        self.assertEqual(self.detect(100), [])
+        self.assertEqual(self.detect(130), [("departure", 10, 1), ("departure", 11, 2)])
+        self.assertEqual(self.monitor._inside, {})
+        self.assertEqual(self.detect(100), [])
+
+    def test_buses_only_stop_at_their_routes_checkpoints(self):
+        route = RouteProgress(2, 0.0, 0.0, True, None, None, None, 0)
+        self.assertEqual(self.detect(10, route), [("arrival", 11, 2)])
+        # Reassigned to another route: the old route's checkpoint is left
+        route = RouteProgress(1, 0.0, 0.0, True, None, None, None, 0)
+        self.assertEqual(self.detect(10, route), [("departure", 11, 2), ("arrival", 10, 1)])
+
+
+class DeviationTests(SimpleTestCase):
+    def setUp(self):
+        self.detector = DeviationDetector(recorder=NullRecorder(), confirm_seconds=30, max_offset_km=0.3)
+        self.store = PositionStore()
+
+    def detect(self, at, offset_km=None, assigned=True):
+        position = self.store.upsert("bus", 1, 18.5, 73.8, updated_at=at)
+        position.route = RouteProgress(
+            1, 1.0, offset_km, offset_km is not None, None, None, None, at,
+        ) if assigned else None
+        return self.detector.detect(position)
+
+    def test_alert_needs_a_confirmed_excursion_and_return(self):
+        self.assertEqual([self.detect(at) for at in (0, 20, 30, 40)], [None, None, ALERT_RAISE, None])
+        # Skirting the buffer edge doesn't start the return
+        self.assertIsNone(self.detect(50, 0.25))
+        self.assertEqual([self.detect(at, 0.1) for at in (60, 85, 90)], [None, None, ALERT_RESOLVE])
+        self.assertEqual(self.detector._excursions, {})
+
+    def test_brief_excursions_are_ignored(self):
+        self.assertIsNone(self.detect(0))
+        self.assertIsNone(self.detect(10, 0.05))
+        self.assertIsNone(self.detect(20))
+        # The excursion restarted at 20 s
+        self.assertIsNone(self.detect(45))
+        self.assertEqual(self.detect(50), ALERT_RAISE)
+
+    def test_unassigned_route_resolves_the_alert(self):
+        self.detect(0)
+        self.assertEqual(self.detect(30), ALERT_RAISE)
+        self.assertEqual(self.detect(35, assigned=False), ALERT_RESOLVE)
+        self.assertIsNone(self.detect(40, assigned=False))
+
+
+class OffRoute:
+    async def track(self, position):
+        position.route = RouteProgress(1, 0.0, None, False, None, None, None, position.updated_at)
+
+
+class SignOffTests(SimpleTestCase):
+    def setUp(self):
+        self.layer = RecordingLayer()
+        self.store = PositionStore(ttl=60)
+        self.broadcaster = LocationBroadcaster(
+            self.store, channel_layer=self.layer, details=NullDetails(), subscriptions=SubscriptionRegistry(),
+        )
+        self.geofence = GeofenceMonitor(recorder=NullRecorder(), channel_layer=self.layer)
+        self.geofence.index([(10, 1, 18.5, 73.8)])
+        self.deviation = DeviationDetector(recorder=NullRecorder(), channel_layer=self.layer, confirm_seconds=0)
+        self.reporting = ReportingRateController(ttl=60)
+        self.ingestor = FixIngestor(
+            store=self.store, broadcaster=self.broadcaster, persister=NullRecorder(), history=NullRecorder(),
+            geocoder=NullGeocoder(), routes=OffRoute(), geofence=self.geofence, deviation=self.deviation,
+            reporting=self.reporting,
+        )
+
+    async def asyncTearDown(self):
+        await self.broadcaster.stop()
+
+    def events(self):
+        sent, self.layer.sent = self.layer.sent, []
+        return [(group, json.loads(event["text"])["event"]) for group, event in sent]
+
+    async def test_expired_vehicle_departs_and_resolves_its_alert(self):
+        position = await self.ingestor.ingest("bus", 1, 18.5, 73.8, recorded_at=time.time() - 61)
+        self.reporting.classify(position)
+        self.assertEqual(self.events(), [(checkpoint_group(10), "arrival"), (ALERTS_GROUP, "raised")])
+
+        await self.broadcaster.sweep()
+        self.assertIsNone(self.store.get("bus", 1))
+        self.assertEqual(self.events(), [(checkpoint_group(10), "departure"), (ALERTS_GROUP, "resolved")])
+        self.assertEqual((self.geofence._inside, self.deviation._excursions, self.reporting._anchors), ({}, {}, {}))
+
+        # Nothing is left to close out twice
+        await self.ingestor.sign_off(position)
+        self.assertEqual(self.events(), [])
+
+
+class ComputeArrivalsTests(SimpleTestCase):
+    def brute_force(self, buses, tables, now, limit):
+        arrivals = {}
+        for vehicle_id, route_id, distance, speed, measured_at in buses:
+            if route_id not in tables:
+                continue
+            speed = max(DEFAULT_BUS_SPEED_KMH if speed is None else speed, MIN_BUS_SPEED_KMH)
+            for offset, checkpoint_id in zip(*tables[route_id]):
+                if offset <= distance:
+                    continue
+                eta = max((offset - distance) / speed * 3600 - (now - measured_at), 0.0)
+                arrivals.setdefault(checkpoint_id, []).append((eta, vehicle_id, offset - distance))
+        return {
+            checkpoint_id: [
+                (vehicle_id, int(round(eta)), round(remaining, 3))
+                for eta, vehicle_id, remaining in sorted(entries)[:limit]
+            ]
+            for checkpoint_id, entries in arrivals.items()
+        }
+
+    def test_matches_brute_force(self):
+        rng = random.Random(7)
+        tables = {}
+        next_checkpoint = 1
+        for route_id in range(1, 9):
+            count = rng.randint(1, 12)
+            offsets = sorted(rng.uniform(0, 30) for _ in range(count))
+            tables[route_id] = (offsets, list(range(next_checkpoint, next_checkpoint + count)))
+            next_checkpoint += count
+        now = 10_000.0
+        buses = [
+            (
+                vehicle_id,
+                rng.randint(1, 10),  # routes 9 and 10 have no table
+                rng.uniform(0, 30),
+                rng.choice([None, 2.0, rng.uniform(5, 60)]),
+                now,
+            )
+            for vehicle_id in range(300)
+        ]
+        for limit in (1, 5):
+            arrivals = compute_arrivals(buses, tables, now, limit=limit)
+            expected = self.brute_force(buses, tables, now, limit)
+            self.assertEqual(arrivals.keys(), expected.keys())
+            for checkpoint_id, entries in arrivals.items():
+                self.assertEqual(
+                    [(entry["id"], entry["eta_seconds"], entry["distance_km"]) for entry in entries],
+                    expected[checkpoint_id],
+                )
+
+    def test_time_since_the_fix_is_subtracted(self):
+        tables = {1: ([0.0, 1.0, 2.0], [10, 11, 12])}
+        buses = [(5, 1, 0.5, None, 100.0)]
+        arrivals = compute_arrivals(buses, tables, 130.0)
+        self.assertEqual(arrivals[11][0]["eta_seconds"], round(0.5 / DEFAULT_BUS_SPEED_KMH * 3600 - 30))
+        self.assertNotIn(10, arrivals)
+        self.assertEqual(compute_arrivals(buses, {}, 130.0), {})
+
+
+class StaticRoutes:
+    def __init__(self, *geometries):
+        self.geometries = {geometry.route_id: geometry for geometry in geometries}
+
+    async def geometry(self, vehicle_type, route_id):
+        return self.geometries.get(route_id)
+
+
+class EtaEngineTests(SimpleTestCase):
+    async def test_only_buses_on_their_route_get_etas(self):
+        geometry = RouteGeometry(1, [(18.5, 73.8), (18.5, 73.9)], [(10, 18.5, 73.82), (11, 18.5, 73.88)])
+        store = PositionStore()
+        now = time.time()
+        for vehicle_id, on_route in ((1, True), (2, False)):
+            store.upsert("bus", vehicle_id, 18.5, 73.81).route = RouteProgress(
+                1, 1.0, 0.0 if on_route else None, on_route, None, 10, 1.1, now,
+            )
+        # First fix off route: a placeholder that was never matched
+        store.upsert("bus", 3, 18.6, 73.81).route = RouteProgress(1, 0.0, None, False, None, None, None, now)
+        engine = EtaEngine(store, StaticRoutes(geometry))
+        self.assertEqual([arrival["id"] for arrival in await engine.arrivals_for(10)], [1])
+        self.assertEqual([arrival["id"] for arrival in await engine.arrivals_for(11)], [1])
+
+
+class RouteMatcherTests(SimpleTestCase):
+    def setUp(self):
+        # Straight east along 18.5 N, checkpoints at about 2 km and 8 km
+        self.geometry = RouteGeometry(1, [(18.5, 73.8), (18.5, 73.9)], [(10, 18.5, 73.819), (11, 18.5, 73.876)])
+        self.matcher = RouteMatcher(max_offset_km=0.3)
+        self.matcher.assign(("bus", "1"), 1)
+        self.matcher._geometries[("bus", 1)] = self.geometry
+        self.store = PositionStore()
+
+    async def fix(self, latitude, longitude, updated_at):
+        position = self.store.upsert("bus", "1", latitude, longitude, updated_at=updated_at)
+        return await self.matcher.track(position)
+
+    async def test_progress_along_the_route(self):
+        progress = await self.fix(18.5005, 73.81, 1000)
+        self.assertTrue(progress.on_route)
+        self.assertAlmostEqual(progress.distance_km, haversine_km(18.5, 73.8, 18.5, 73.81), places=2)
+        self.assertEqual((progress.checkpoint_id, progress.next_checkpoint_id), (None, 10))
+        self.assertIsNone(progress.speed_kmh)
+        progress = await self.fix(18.5, 73.83, 1000 + 360)
+        self.assertEqual((progress.checkpoint_id, progress.next_checkpoint_id), (10, 11))
+        # About 2.1 km in six minutes
+        self.assertAlmostEqual(progress.speed_kmh, 21.1, places=0)
+
+    async def test_off_route_keeps_the_last_match(self):
+        await self.fix(18.5, 73.81, 1000)
+        progress = await self.fix(18.52, 73.82, 1060)
+        self.assertFalse(progress.on_route)
+        self.assertIsNone(progress.offset_km)
+        self.assertAlmostEqual(progress.distance_km, 1.055, places=2)
+
+    async def test_first_match_after_an_off_route_start_has_no_speed(self):
+        progress = await self.fix(18.52, 73.81, 1000)
+        self.assertEqual((progress.distance_km, progress.on_route), (0.0, False))
+        progress = await self.fix(18.5, 73.86, 1010)
+        self.assertTrue(progress.on_route)
+        self.assertIsNone(progress.speed_kmh)
+
+    async def test_misses_load_in_the_background(self):
+        matcher = RouteMatcher()
+        loads = []
+
+        def load_route_assignments(vehicle_type, driver_ids):
+            loads.append((vehicle_type, set(driver_ids)))
+            return {"2": 1}
+
+        with mock.patch("myapp.route_matching.load_route_assignments", load_route_assignments), \
+                mock.patch("myapp.route_matching.load_route_geometry", return_value=self.geometry):
+            first = self.store.upsert("bus", "2", 18.5, 73.81)
+            second = self.store.upsert("bus", "3", 18.5, 73.81)
+            self.assertIsNone(await matcher.track(first))
+            self.assertIsNone(await matcher.track(second))
+            await matcher._loader
+            self.assertEqual(loads, [("bus", {"2", "3"})])
+            self.assertIsNone(await matcher.track(second))
+            self.assertIsNone(await matcher.track(first))
+            await matcher._loader
+            self.assertTrue((await matcher.track(first)).on_route)
+        self.assertEqual(len(loads), 1)
+
+
+class NearestTests(SimpleTestCase):
+    def test_matches_brute_force(self):
+        rng = random.Random(3)
+        store = PositionStore(cell_size=0.02)
+        for vehicle_id in range(800):
+            store.upsert("car", vehicle_id, 18.5 + rng.uniform(-0.2, 0.2), 73.8 + rng.uniform(-0.2, 0.2))
+            store.upsert("bike", vehicle_id, 18.5 + rng.uniform(-0.2, 0.2), 73.8 + rng.uniform(-0.2, 0.2))
+
+        def even(position):
+            return position.id % 2 == 0
+
+        for _ in range(25):
+            latitude = 18.5 + rng.uniform(-0.25, 0.25)
+            longitude = 73.8 + rng.uniform(-0.25, 0.25)
+            k = rng.choice([1, 5, 20])
+            radius_km = rng.choice([0.5, 3, 10, 60])
+            predicate = rng.choice([None, even])
+            expected = sorted(
+                (haversine_km(latitude, longitude, position.latitude, position.longitude), position.id)
+                for position in store.positions("car")
+                if predicate is None or predicate(position)
+            )
+            expected = [entry for entry in expected if entry[0] <= radius_km][:k]
+            found = store.nearest("car", latitude, longitude, k, radius_km, predicate)
+            self.assertEqual([position.id for _, position in found], [vehicle_id for _, vehicle_id in expected])
+            for (distance, _), (expected_distance, _) in zip(found, expected):
+                self.assertTrue(math.isclose(distance, expected_distance))
+
+    def test_query_parsing(self):
+        query = parse_nearest_query({
+            "vehicle_type": "Car", "lat": "18.5", "lng": "73.8", "k": "500", "radius_km": "1e9",
+        })
+        self.assertEqual((query["vehicle_type"], query["k"], query["radius_km"]), ("car", 50, 50))
+        for params in (
+            {"radius_km": "nan"},
+            {"radius_km": "inf"},
+            {"radius_km": "-1"},
+            {"latitude": "nan"},
+            {"longitude": "-inf"},
+            {"latitude": "91"},
+            {"k": "0"},
+            {"vehicle_type": "boat"},
+        ):
+            with self.subTest(params=params):
+                with self.assertRaises(ValueError):
+                    parse_nearest_query({"vehicle_type": "car", "latitude": "18.5", "longitude": "73.8", **params})
+
+    def test_view_rejects_nan_radius(self):
+        response = self.client.get(reverse("nearest-vehicles"), {
+            "vehicle_type": "car", "latitude": 18.5, "longitude": 73.8, "radius_km": "nan",
+        })
+        self.assertEqual(response.status_code, 400)
+
+    def test_empty_results(self):
+        store = PositionStore()
+        store.upsert("car", 1, 18.5, 73.8)
+        self.assertEqual(store.nearest("car", 18.5, 73.8, 0, 5), [])
+        self.assertEqual(store.nearest("bus", 18.5, 73.8, 5, 5), [])
+        self.assertEqual(store.nearest("car", 19.5, 73.8, 5, 5), [])
+
+
+# One bike driver on the load-test harness's consumer, kept off the database
+HARNESS_OPTIONS = {"drivers": 1, "vehicle_type": "bike", "interval_ms": 50, "spread_km": 5}
+
+
+@override_settings(
+    CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}},
+    LIVE_STATE_BACKEND="memory",
+)
+class ConsumerFixTests(SimpleTestCase):
+    async def connect_driver(self):
+        consumer_class = Command().consumer_class(HARNESS_OPTIONS)
+        app = as_identity(consumer_class.as_asgi(), FleetIdentity(DRIVER, 1, frozenset({"bike"})))
+        driver = WebsocketCommunicator(app, "/ws/fleet/")
+        connected, _ = await driver.connect()
+        self.assertTrue(connected)
+        await driver.receive_json_from()  # connection_established
+        return consumer_class, driver
+
+    async def test_malformed_fixes_get_errors_and_the_socket_survives(self):
+        consumer_class, driver = await self.connect_driver()
+        fix = {"id": 1, "vehicle_type": "bike", "address": "Depot"}
+        await driver.send_to(text_data="{not json")
+        frame = await driver.receive_json_from()
+        self.assertEqual(frame["type"], "error")
+        self.assertTrue(frame["message"].startswith("Invalid JSON format"))
+        for message in (
+            "[1, 2]",
+            '"just a string"',
+            json.dumps({**fix, "latitude": "north", "longitude": 73.8}),
+            '{"id": 1, "vehicle_type": "bike", "latitude": NaN, "longitude": 73.8}',
+            json.dumps({**fix, "latitude": 95, "longitude": 73.8}),
+            json.dumps({**fix, "latitude": None, "longitude": 73.8}),
+        ):
+            with self.subTest(message=message):
+                await driver.send_to(text_data=message)
+                self.assertEqual((await driver.receive_json_from())["type"], "error")
+        self.assertIsNone(consumer_class.store.get("bike", 1))
+
+        # A missing field isn't a fix at all, and is ignored
+        await driver.send_json_to({"id": 1, "vehicle_type": "bike", "latitude": 18.5})
+        self.assertTrue(await driver.receive_nothing(0.1))
+
+        # Numeric strings are still accepted as they were before validation
+        await driver.send_json_to({**fix, "latitude": "18.7", "longitude": "73.8"})
+        await driver.receive_nothing(0.1)
+        position = consumer_class.store.get("bike", 1)
+        self.assertEqual((position.latitude, position.longitude), (18.7, 73.8))
+        await driver.disconnect()
+        await consumer_class.broadcaster.stop()
+
+    async def test_dropped_connection_ends_tracking_but_keeps_the_vehicle_live(self):
+        consumer_class, driver = await self.connect_driver()
+        await driver.send_json_to({
+            "id": 1, "vehicle_type": "bike", "latitude": 18.5, "longitude": 73.8, "address": "Depot",
+        })
+        await driver.receive_nothing(0.1)
+        self.assertIn(("bike", "1"), consumer_class.ingestor.reporting._anchors)
+        await driver.disconnect(code=1006)
+        self.assertIsNotNone(consumer_class.store.get("bike", 1))
+        self.assertNotIn(("bike", "1"), consumer_class.ingestor.reporting._anchors)
+        await consumer_class.broadcaster.stop()
+
+    async def test_fix_for_another_driver_is_refused(self):
+        consumer_class, driver = await self.connect_driver()
+        await driver.send_json_to({"id": 2, "vehicle_type": "bike", "latitude": 18.5, "longitude": 73.8})
+        self.assertEqual((await driver.receive_json_from())["type"], "error")
+        self.assertIsNone(consumer_class.store.get("bike", 2))
+        await driver.disconnect()
+        await consumer_class.broadcaster.stop()
+
+
+@override_settings(
+    CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}},
+    LIVE_STATE_BACKEND="memory",
+    LOCATION_MAX_SUBSCRIBED_CELLS=256,
+)
+class ConsumerAreaTests(SimpleTestCase):
+    async def subscribe(self, message):
+        consumer_class = Command().consumer_class(HARNESS_OPTIONS)
+        rider = WebsocketCommunicator(as_identity(consumer_class.as_asgi(), ANONYMOUS), "/ws/fleet/")
+        connected, _ = await rider.connect()
+        self.assertTrue(connected)
+        await rider.receive_json_from()  # connection_established
+        await rider.send_json_to({"type": "subscribe", "vehicle_type": "bike", **message})
+        frame = await rider.receive_json_from()
+        await rider.disconnect()
+        await consumer_class.broadcaster.stop()
+        return frame
+
+    async def test_huge_areas_fall_back_to_the_type_group(self):
+        for message in (
+            {"viewport": {"south": -90, "west": -180, "north": 90, "east": 180}},
+            {"latitude": 18.5, "longitude": 73.8, "radius_km": 1e300},
+        ):
+            with self.subTest(message=message):
+                frame = await self.subscribe(message)
+                self.assertEqual(frame["mode"], "snapshot")
+                self.assertEqual(list(frame["seqs"]), ["location.bike"])
+
+    async def test_small_area_joins_its_cells(self):
+        frame = await self.subscribe({"latitude": 18.5, "longitude": 73.8, "radius_km": 1})
+        self.assertTrue(frame["seqs"])
+        self.assertTrue(all(group.startswith("location.bike.") for group in frame["seqs"]))
+
+    async def test_bad_areas_are_rejected(self):
+        for message in (
+            {"viewport": {"south": "-Infinity", "west": 0, "north": 1, "east": 1}},
+            {"viewport": {"south": 0, "west": 0, "north": 91, "east": 1}},
+            {"viewport": {"south": 0, "west": 0}},
+            {"latitude": 18.5, "longitude": 73.8, "radius_km": "inf"},
+            {"latitude": 18.5, "longitude": 73.8, "radius_km": "nan"},
+            {"latitude": 18.5, "longitude": 73.8, "radius_km": -1},
+            {"latitude": float("inf"), "longitude": 73.8, "radius_km": 1},
+        ):
+            with self.subTest(message=message):
+                frame = await self.subscribe(message)
+                self.assertEqual(frame, {"type": "error", "message": "Invalid subscription area"})
+
+
+class LoadTestCommandTests(SimpleTestCase):
+    def test_small_run_delivers_every_driver(self):
+        out = StringIO()
+        call_command(
+            "loadtest_fleet", drivers=5, riders=3, rate=10, duration=0.5, interval_ms=50, json=True, stdout=out,
+        )
+        summary = json.loads(out.getvalue())
+        self.assertEqual((summary["layer"], summary["drivers"], summary["riders"]), ("memory", 5, 3))
+        self.assertGreater(summary["fixes_sent"], 0)
+        # Every rider gets every fix, coalesced into a frame per tick
+        self.assertGreaterEqual(summary["records_delivered"], summary["fixes_sent"] * 3 * 0.9)
+        self.assertLess(summary["frames"], summary["fixes_sent"] * 3)
+        self.assertEqual((summary["resyncs"], summary["closed"]), (0, 0))
@@ -61,6 +61,7 @@ urlpatterns = [
     path('bus-checkpoints/<int:pk>/', views.get_bus_checkpoint),
     path('bus-checkpoints/update/<int:pk>/', views.update_bus_checkpoint),
     path('bus-checkpoints/delete/<int:pk>/', views.delete_bus_checkpoint),
+    path('bus-checkpoints/<int:pk>/eta', views.get_bus_checkpoint_eta, name='bus-checkpoint-eta'),
   
     path('create-car/', views.create_car, name='create-car'),
     path('car-details/', views.get_car_details, name='get-car'),
@@ -89,5 +90,12 @@ urlpatterns = [
     path('bookings/create/', views.create_booking, name='create_booking'),
     path('otp-entries/', views.get_all_otp_entries, name='get_all_otp_entries'),
     path('bookings/', views.get_booking_requests, name='get-bookings'),
-    path('bookings/driver-id/', views.get_bookings_by_driver, name='get-bookings')
+    path('bookings/driver-id/', views.get_bookings_by_driver, name='get-bookings'),
+
+    path('location-history/<str:vehicle_type>/<int:vehicle_id>/', views.get_location_history, name='location-history'),
+    path('nearest-vehicles/', views.get_nearest_vehicles, name='nearest-vehicles'),
+    path('fixes/', views.upload_fixes, name='upload-fixes'),
+    path('fleet-connections/', views.get_fleet_connections, name='fleet-connections'),
+    path('alerts/', views.get_open_alerts, name='open-alerts'),
+    path('alerts/<int:pk>/resolve/', views.resolve_alert, name='resolve-alert'),
 ]
\ No newline at end of file
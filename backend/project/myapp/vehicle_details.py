@@ -0,0 +1,99 @@
+"""
+In-process driver -> vehicle details cache for live location frames.
+
+Frames carry the vehicle attributes riders need (subtype, plate, seating)
+so clients don't look each vehicle up over HTTP. Details are read from the
+database once per driver, refreshed after a TTL, and dropped early by the
+Bus/Car/Bike save and delete signals (see ``myapp.signals``).
+"""
+import logging
+import time
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+
+from .models import Bike, Bus, Car
+from .position_store import position_key
+
+logger = logging.getLogger(__name__)
+
+# Backstop for changes saved by another process, where our signals don't fire.
+DEFAULT_VEHICLE_DETAILS_TTL_SECONDS = 300
+
+# vehicle_type -> (model, fields sent to riders)
+DETAIL_FIELDS = {
+    "bus": (Bus, ("id", "license_plate", "bus_type", "seating_capacity", "has_ac", "has_wifi")),
+    "car": (Car, ("id", "license_plate", "car_type", "seating_capacity", "fuel_type")),
+    "bike": (Bike, ("id", "license_plate", "bike_type", "fuel_type")),
+}
+
+
+def load_vehicle_details(vehicle_type, driver_ids):
+    """Map driver id (str) -> details dict for drivers with a vehicle of this type."""
+    model, fields = DETAIL_FIELDS[vehicle_type]
+    numeric_ids = [int(driver_id) for driver_id in driver_ids if str(driver_id).isdigit()]
+    details = {}
+    for row in model.objects.filter(driver_id__in=numeric_ids).values("driver_id", *fields):
+        driver_id = row.pop("driver_id")
+        details[str(driver_id)] = {**row, "driver": driver_id}
+    return details
+
+
+class VehicleDetailsCache:
+    """(vehicle_type, driver id) -> details dict, empty when the driver has no vehicle."""
+
+    def __init__(self, ttl=None):
+        if ttl is None:
+            ttl = getattr(settings, "VEHICLE_DETAILS_TTL_SECONDS", DEFAULT_VEHICLE_DETAILS_TTL_SECONDS)
+        self.ttl = ttl
+        # position key -> (fetched at, details)
+        self._entries = {}
+
+    def get(self, vehicle_type, driver_id):
+        entry = self._entries.get(position_key(vehicle_type, driver_id))
+        if entry is None or time.monotonic() - entry[0] > self.ttl:
+            return None
+        return entry[1]
+
+    def put(self, vehicle_type, driver_id, details):
+        self._entries[position_key(vehicle_type, driver_id)] = (time.monotonic(), details)
+
+    def invalidate(self, vehicle_type, driver_id):
+        self._entries.pop(position_key(vehicle_type, driver_id), None)
+
+    def clear(self):
+        self._entries.clear()
+
+    async def attach(self, positions):
+        """
+        Set ``details`` on each position, loading every miss with one query
+        per vehicle type.
+        """
+        now = time.monotonic()
+        missing = {}
+        for position in positions:
+            entry = self._entries.get(position.key)
+            if entry is not None and now - entry[0] <= self.ttl:
+                position.details = entry[1]
+            else:
+                missing.setdefault(position.vehicle_type, []).append(position)
+        for vehicle_type, waiting in missing.items():
+            if vehicle_type not in DETAIL_FIELDS:
+                continue
+            try:
+                loaded = await database_sync_to_async(load_vehicle_details)(
+                    vehicle_type, {position.key[1] for position in waiting}
+                )
+            except Exception:
+                # Frames still go out, just without details; retried next time
+                logger.exception("Could not load %s details", vehicle_type)
+                continue
+            now = time.monotonic()
+            for position in waiting:
+                details = loaded.get(position.key[1], {})
+                self._entries[position.key] = (now, details)
+                position.details = details
+
+
+# Process-wide cache shared by the broadcaster and consumers.
+vehicle_details = VehicleDetailsCache()
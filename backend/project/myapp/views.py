@@ -1333,4 +1333,232 @@ def get_bookings_by_driver(request):
         bookings = BookingRequest.objects.filter(driver_id=driver_id).values()
         return JsonResponse(list(bookings), safe=False)
     else:
-        return JsonResponse({'error': 'Only GET method is allowed'}, status=405)
\ No newline at end of file
+        return JsonResponse({'error': 'Only GET method is allowed'}, status=405)
+
+# ------------------ LIVE TRACKING ------------------ #
+
+from channels.db import database_sync_to_async
+from django.http import StreamingHttpResponse
+from django.utils.dateparse import parse_datetime
+from .constants import VEHICLE_TYPE_CODES
+from .eta import eta_engine
+from .fleet_auth import IsFleetStaff, authenticate_token
+from .geo import PolylineEncoder
+from .ingest import fix_ingestor, normalize_vehicle_type, parse_batch
+from .nearest import find_nearest, parse_nearest_query
+from .position_store import position_store
+from .send_queue import live_queues
+
+# Points per chunk written to the streamed track response
+TRACK_STREAM_CHUNK = 1000
+
+
+def _bearer_token(request):
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    if scheme.lower() == 'bearer' and token.strip():
+        return token.strip()
+    return None
+
+
+def _json_fragment(text):
+    # Polyline text can contain backslashes, which JSON needs escaped
+    return json.dumps(text)[1:-1]
+
+
+def _stream_track(vehicle_type, vehicle_id, rows):
+    """
+    Yield a JSON document for a track as it is read from the database.
+
+    ``polyline`` is a standard encoded polyline (1e-5 degree precision) and
+    ``times`` encodes the epoch second of each point the same way, as
+    deltas from the previous point.
+    """
+    yield json.dumps({'vehicle_type': vehicle_type, 'vehicle_id': vehicle_id})[:-1]
+    yield ', "polyline": "'
+    encoder = PolylineEncoder()
+    time_encoder = PolylineEncoder(dimensions=1)
+    chunk = []
+    times = []
+    count = 0
+    for lat_e6, lng_e6, recorded_at in rows:
+        chunk.append(encoder.add(round(lat_e6 / 10), round(lng_e6 / 10)))
+        times.append(time_encoder.add(int(recorded_at.timestamp())))
+        count += 1
+        if len(chunk) >= TRACK_STREAM_CHUNK:
+            yield _json_fragment(''.join(chunk))
+            chunk = []
+    yield _json_fragment(''.join(chunk))
+    yield f'", "times": "{_json_fragment("".join(times))}", "points": {count}}}'
+
+
+@csrf_exempt
+def get_location_history(request, vehicle_type, vehicle_id):
+    """
+    Stream a vehicle's recorded track between ?start= and ?end= (ISO 8601),
+    for staff or the vehicle's own driver.
+    """
+    if request.method != 'GET':
+        return JsonResponse({'error': 'Only GET method is allowed.'}, status=405)
+    raw_token = _bearer_token(request)
+    identity = authenticate_token(raw_token) if raw_token else None
+    if identity is None:
+        return JsonResponse({'error': 'A valid access token is required'}, status=401)
+
+    type_code = VEHICLE_TYPE_CODES.get(vehicle_type)
+    if type_code is None:
+        return JsonResponse({'error': f'Unknown vehicle type: {vehicle_type}'}, status=404)
+    if not (identity.is_staff or identity.may_report(vehicle_type, vehicle_id)):
+        return JsonResponse({'error': "Not allowed to read this vehicle's history"}, status=403)
+
+    try:
+        start = parse_datetime(request.GET.get('start', ''))
+        end = parse_datetime(request.GET.get('end', ''))
+    except ValueError:
+        start = end = None
+    if start is None or end is None:
+        return JsonResponse({'error': 'start and end must be ISO 8601 datetimes'}, status=400)
+    if timezone.is_naive(start):
+        start = timezone.make_aware(start)
+    if timezone.is_naive(end):
+        end = timezone.make_aware(end)
+    if end < start:
+        return JsonResponse({'error': 'end must not be before start'}, status=400)
+
+    rows = (
+        LocationHistory.objects
+        .filter(vehicle_type=type_code, vehicle_id=vehicle_id, recorded_at__range=(start, end))
+        .order_by('recorded_at')
+        .values_list('lat_e6', 'lng_e6', 'recorded_at')
+        .iterator(chunk_size=2000)
+    )
+    return StreamingHttpResponse(
+        _stream_track(vehicle_type, vehicle_id, rows),
+        content_type='application/json',
+    )
+
+
+@csrf_exempt
+async def get_nearest_vehicles(request):
+    """
+    The k live vehicles of a type closest to ?latitude=&longitude=, within
+    ?radius_km=, optionally only of one ?subtype= (car_type, bike_type, ...).
+    """
+    if request.method != 'GET':
+        return JsonResponse({'error': 'Only GET method is allowed.'}, status=405)
+    try:
+        query = parse_nearest_query(request.GET)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    vehicles = await find_nearest(position_store, query)
+    return JsonResponse({'count': len(vehicles), 'vehicles': vehicles})
+
+
+@csrf_exempt
+async def upload_fixes(request):
+    """
+    Batched fixes from a driver app that couldn't use its socket, in the
+    same ``fixes`` or ``polyline``/``times`` forms (see ``myapp.ingest``).
+    """
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Only POST method is allowed.'}, status=405)
+    raw_token = _bearer_token(request)
+    identity = None
+    if raw_token:
+        identity = await database_sync_to_async(authenticate_token)(raw_token)
+    if identity is None:
+        return JsonResponse({'error': 'A valid driver access token is required'}, status=401)
+    try:
+        data = json.loads(request.body)
+    except json.JSONDecodeError:
+        return JsonResponse({'error': 'Invalid JSON'}, status=400)
+    if not isinstance(data, dict):
+        return JsonResponse({'error': 'Expected a JSON object'}, status=400)
+
+    vehicle_type = normalize_vehicle_type(data.get('vehicle_type'))
+    if vehicle_type is None:
+        return JsonResponse({'error': f"Unknown vehicle_type: {data.get('vehicle_type')}"}, status=400)
+    if not identity.may_report(vehicle_type, data.get('id')):
+        return JsonResponse({'error': 'Not allowed to report fixes for this vehicle'}, status=403)
+    try:
+        fixes = parse_batch(data)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    position = await fix_ingestor.ingest_batch(vehicle_type, data['id'], fixes)
+    return JsonResponse({
+        'batch': data.get('batch'),
+        'accepted': len(fixes),
+        'live': position is not None,
+    })
+
+
+@csrf_exempt
+async def get_bus_checkpoint_eta(request, pk):
+    """Live ETAs of the buses heading for a checkpoint, soonest first."""
+    if request.method != 'GET':
+        return JsonResponse({'error': 'Only GET method is allowed.'}, status=405)
+    if not await BusCheckpoint.objects.filter(pk=pk).aexists():
+        return JsonResponse({'error': 'Checkpoint not found'}, status=404)
+    arrivals = await eta_engine.arrivals_for(pk)
+    return JsonResponse({
+        'checkpoint': pk,
+        'computed_at': eta_engine.computed_at,
+        'arrivals': arrivals,
+    })
+
+
+@api_view(['GET'])
+@authentication_classes([JWTAuthentication])
+@permission_classes([IsFleetStaff])
+def get_fleet_connections(request):
+    """Send-queue metrics for every fleet socket served by this worker."""
+    connections = sorted(
+        (queue.stats() for queue in list(live_queues)),
+        key=lambda stats: stats['last_lag_seconds'],
+        reverse=True,
+    )
+    return Response({'count': len(connections), 'connections': connections})
+
+
+def alert_dict(alert):
+    return {
+        'id': alert.id,
+        'kind': alert.kind,
+        'severity': alert.severity,
+        'message': alert.message,
+        'vehicle': {'id': alert.object_id, 'vehicle_type': alert.content_type.model},
+        'latitude': alert.latitude,
+        'longitude': alert.longitude,
+        'created_at': alert.created_at,
+    }
+
+
+@api_view(['GET'])
+@authentication_classes([JWTAuthentication])
+@permission_classes([IsFleetStaff])
+def get_open_alerts(request):
+    """Unresolved alerts, newest first (``?limit=``, default 100)."""
+    try:
+        limit = min(int(request.GET.get('limit', 100)), 1000)
+    except ValueError:
+        return Response({'error': 'limit must be an integer'}, status=400)
+    alerts = (
+        Alert.objects
+        .filter(resolved=False)
+        .select_related('content_type')
+        .order_by('-created_at')[:max(limit, 0)]
+    )
+    alerts = [alert_dict(alert) for alert in alerts]
+    return Response({'count': len(alerts), 'alerts': alerts})
+
+
+@api_view(['POST'])
+@authentication_classes([JWTAuthentication])
+@permission_classes([IsFleetStaff])
+def resolve_alert(request, pk):
+    try:
+        alert = Alert.objects.get(pk=pk)
+    except Alert.DoesNotExist:
+        return Response({'error': 'Alert not found'}, status=404)
+    alert.resolved = True
+    alert.save()
+    return Response(alert_dict(alert))
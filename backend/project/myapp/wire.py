@@ -0,0 +1,177 @@
+"""
+Wire encodings for live location frames.
+
+Frames are plain dicts whose ``data`` lists hold VehiclePosition records.
+JSON is the default. Clients that offer the ``BINARY_SUBPROTOCOL`` when they
+connect get location frames as packed little-endian binary messages instead.
+Control messages (connection_established, error) stay JSON text either way.
+
+Binary frame layout::
+
+    header   B version, B kind, 6s stream, I base time (unix seconds)
+    delta    B group length, group (utf-8), I seq, I prev_seq
+    snapshot H group count, then per group: B length, group, I seq
+    extend   same as snapshot
+    offline  nothing further
+    records  I count, then per vehicle RECORD (15 bytes)
+    removed  I count, then per vehicle REMOVED (5 bytes)
+
+RECORD is ``I id, B type, i lat, i lng, H age``, where lat/lng are in
+microdegrees and age is the number of seconds before the base time that the
+fix was taken. Binary records do not carry the address, per-vehicle seq,
+vehicle details or route progress. Offline frames list their vehicles under removed.
+"""
+import json
+import struct
+import time
+
+from .constants import VEHICLE_TYPE_CODES
+
+BINARY_SUBPROTOCOL = "fleet.binary.v1"
+BINARY_VERSION = 1
+
+KIND_DELTA = 1
+KIND_SNAPSHOT = 2
+KIND_EXTEND = 3
+KIND_OFFLINE = 4
+MODE_KINDS = {"delta": KIND_DELTA, "snapshot": KIND_SNAPSHOT, "extend": KIND_EXTEND}
+
+HEADER = struct.Struct("<BB6sI")
+SEQ = struct.Struct("<I")
+SEQ_PAIR = struct.Struct("<II")
+COUNT = struct.Struct("<I")
+GROUP_COUNT = struct.Struct("<H")
+RECORD = struct.Struct("<IBiiH")
+REMOVED = struct.Struct("<IB")
+
+MAX_AGE_SECONDS = 0xFFFF
+VEHICLE_TYPE_NAMES = {code: name for name, code in VEHICLE_TYPE_CODES.items()}
+
+
+def _wire_dict(value):
+    # json.dumps hook: VehiclePosition records serialise as their wire dict
+    try:
+        return value.as_dict()
+    except AttributeError:
+        raise TypeError(f"{type(value).__name__} is not JSON serializable") from None
+
+
+def encode_json(frame):
+    return json.dumps(frame, separators=(",", ":"), default=_wire_dict)
+
+
+def _pack_group(group):
+    name = group.encode()
+    return bytes((len(name),)) + name
+
+
+def _vehicle_id(value):
+    vehicle_id = int(value)
+    if not 0 <= vehicle_id <= 0xFFFFFFFF:
+        raise ValueError(vehicle_id)
+    return vehicle_id
+
+
+def encode_binary(frame, now=None):
+    """
+    Pack a frame in the binary layout, or return None when it can't be
+    (e.g. a client sent a non-numeric vehicle id) so the caller falls back
+    to JSON for that frame.
+    """
+    if frame["type"] == "vehicle_offline":
+        kind = KIND_OFFLINE
+        records, removed = (), frame["data"]
+    else:
+        kind = MODE_KINDS[frame["mode"]]
+        records, removed = frame["data"], frame.get("removed", ())
+    base_time = int(time.time() if now is None else now)
+
+    try:
+        parts = [HEADER.pack(BINARY_VERSION, kind, bytes.fromhex(frame.get("stream", "0" * 12)), base_time)]
+        if kind == KIND_DELTA:
+            parts.append(_pack_group(frame["group"]))
+            parts.append(SEQ_PAIR.pack(frame["seq"], frame["prev_seq"]))
+        elif kind != KIND_OFFLINE:
+            seqs = frame.get("seqs", {})
+            parts.append(GROUP_COUNT.pack(len(seqs)))
+            for group, seq in seqs.items():
+                parts.append(_pack_group(group))
+                parts.append(SEQ.pack(seq))
+
+        parts.append(COUNT.pack(len(records)))
+        for position in records:
+            age = min(MAX_AGE_SECONDS, max(0, base_time - int(position.updated_at)))
+            parts.append(RECORD.pack(
+                _vehicle_id(position.id),
+                VEHICLE_TYPE_CODES[position.vehicle_type],
+                round(position.latitude * 1_000_000),
+                round(position.longitude * 1_000_000),
+                age,
+            ))
+        parts.append(COUNT.pack(len(removed)))
+        for vehicle in removed:
+            parts.append(REMOVED.pack(
+                _vehicle_id(vehicle["id"]), VEHICLE_TYPE_CODES[vehicle["vehicle_type"]]
+            ))
+    except (KeyError, TypeError, ValueError, struct.error):
+        return None
+    return b"".join(parts)
+
+
+def _unpack_group(data, offset):
+    length = data[offset]
+    offset += 1
+    return data[offset:offset + length].decode(), offset + length
+
+
+def decode_binary(data):
+    """Unpack a binary frame into the same shape as its JSON counterpart."""
+    version, kind, stream, base_time = HEADER.unpack_from(data)
+    if version != BINARY_VERSION:
+        raise ValueError(f"Unsupported binary frame version {version}")
+    offset = HEADER.size
+    if kind == KIND_OFFLINE:
+        frame = {"type": "vehicle_offline"}
+    else:
+        mode = next(name for name, code in MODE_KINDS.items() if code == kind)
+        frame = {"type": "batch_location_update", "mode": mode, "stream": stream.hex()}
+    if kind == KIND_DELTA:
+        frame["group"], offset = _unpack_group(data, offset)
+        frame["seq"], frame["prev_seq"] = SEQ_PAIR.unpack_from(data, offset)
+        offset += SEQ_PAIR.size
+    elif kind != KIND_OFFLINE:
+        (count,) = GROUP_COUNT.unpack_from(data, offset)
+        offset += GROUP_COUNT.size
+        seqs = frame["seqs"] = {}
+        for _ in range(count):
+            group, offset = _unpack_group(data, offset)
+            (seqs[group],) = SEQ.unpack_from(data, offset)
+            offset += SEQ.size
+
+    (count,) = COUNT.unpack_from(data, offset)
+    offset += COUNT.size
+    records = []
+    for vehicle_id, type_code, lat, lng, age in RECORD.iter_unpack(
+        data[offset:offset + count * RECORD.size]
+    ):
+        records.append({
+            "id": vehicle_id,
+            "vehicle_type": VEHICLE_TYPE_NAMES[type_code],
+            "latitude": lat / 1_000_000,
+            "longitude": lng / 1_000_000,
+            "updated_at": base_time - age,
+        })
+    offset += count * RECORD.size
+
+    (count,) = COUNT.unpack_from(data, offset)
+    offset += COUNT.size
+    removed = [
+        {"id": vehicle_id, "vehicle_type": VEHICLE_TYPE_NAMES[type_code]}
+        for vehicle_id, type_code in REMOVED.iter_unpack(data[offset:offset + count * REMOVED.size])
+    ]
+    if kind == KIND_OFFLINE:
+        frame["data"] = removed
+    else:
+        frame["data"] = records
+        frame["removed"] = removed
+    return frame
@@ -10,11 +10,13 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'project.settings')
 
 from django.core.asgi import get_asgi_application
 from channels.routing import ProtocolTypeRouter, URLRouter
+from myapp.fleet_auth import JWTAuthMiddleware
 from myapp.routing import websocket_urlpatterns  # Direct import from myapp
 
 application = ProtocolTypeRouter({
     "http": get_asgi_application(),
-    "websocket": URLRouter(
+    # Sockets authenticate once, at connect
+    "websocket": JWTAuthMiddleware(URLRouter(
         websocket_urlpatterns
-    ),
+    )),
 })
\ No newline at end of file
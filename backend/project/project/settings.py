@@ -90,6 +90,66 @@ CHANNEL_LAYERS = {
         },
     },
 }
+
+# Live location tracking
+# Fixes arriving within one window are coalesced into a single frame per group.
+LOCATION_BROADCAST_INTERVAL_MS = config('LOCATION_BROADCAST_INTERVAL_MS', default=500, cast=int)
+# Subscribers may ask for a slower update_interval; requests are rounded up
+# to one of these tiers (ms) and capped at LOCATION_MAX_UPDATE_INTERVAL_MS.
+LOCATION_UPDATE_INTERVAL_TIERS_MS = (1000, 2000, 5000, 10000)
+LOCATION_MAX_UPDATE_INTERVAL_MS = config('LOCATION_MAX_UPDATE_INTERVAL_MS', default=10000, cast=int)
+# Recent frames per group a reconnecting subscriber can resume across before
+# it needs a full snapshot.
+LOCATION_RESUME_HISTORY_FRAMES = config('LOCATION_RESUME_HISTORY_FRAMES', default=120, cast=int)
+# A group's resume history is kept this long (seconds) after its last
+# subscriber leaves, then dropped.
+LOCATION_RESUME_WINDOW_SECONDS = config('LOCATION_RESUME_WINDOW_SECONDS', default=60, cast=int)
+# Where live positions are shared between workers: "redis" (same server as
+# CHANNEL_LAYERS) or "memory" for single-process and test runs.
+LIVE_STATE_BACKEND = config('LIVE_STATE_BACKEND', default='redis')
+# A vehicle with no fix for this long is dropped and announced offline.
+LIVE_STATE_TTL_SECONDS = config('LIVE_STATE_TTL_SECONDS', default=60, cast=int)
+LIVE_STATE_REFRESH_MS = config('LIVE_STATE_REFRESH_MS', default=1000, cast=int)
+# Live positions are indexed on a fixed lat/lng grid; riders subscribing to
+# an area join the groups of the cells it covers.
+LOCATION_CELL_SIZE_DEG = config('LOCATION_CELL_SIZE_DEG', default=0.02, cast=float)
+LOCATION_MAX_SUBSCRIBED_CELLS = config('LOCATION_MAX_SUBSCRIBED_CELLS', default=256, cast=int)
+# Whether fleet sockets without a token may connect to watch (never to report).
+LOCATION_WS_ALLOW_ANONYMOUS = config('LOCATION_WS_ALLOW_ANONYMOUS', default=True, cast=bool)
+# Vehicle details attached to live frames are re-read from the database after
+# this long even without a save signal (e.g. edits made by another process).
+VEHICLE_DETAILS_TTL_SECONDS = config('VEHICLE_DETAILS_TTL_SECONDS', default=300, cast=int)
+# Upper bound on the search radius of nearest-vehicle queries.
+LOCATION_NEAREST_MAX_RADIUS_KM = config('LOCATION_NEAREST_MAX_RADIUS_KM', default=50, cast=float)
+# Offline reverse geocoder labelling fixes with the nearest checkpoint, route
+# end or gazetteer place within this distance.
+LOCATION_GEOCODER_MAX_DISTANCE_KM = config('LOCATION_GEOCODER_MAX_DISTANCE_KM', default=2, cast=float)
+LOCATION_GEOCODER_RELOAD_SECONDS = config('LOCATION_GEOCODER_RELOAD_SECONDS', default=600, cast=int)
+# Fixes further than this from their route's polyline count as off route.
+LOCATION_ROUTE_MAX_OFFSET_KM = config('LOCATION_ROUTE_MAX_OFFSET_KM', default=0.3, cast=float)
+# Vehicles off route (or back on it) for this long raise (or resolve) an alert.
+LOCATION_OFF_ROUTE_CONFIRM_SECONDS = config('LOCATION_OFF_ROUTE_CONFIRM_SECONDS', default=30, cast=int)
+# Reporting intervals driver apps are told to use while moving and while parked;
+# the parked one is capped below LIVE_STATE_TTL_SECONDS.
+LOCATION_MOVING_REPORT_INTERVAL_MS = config('LOCATION_MOVING_REPORT_INTERVAL_MS', default=5000, cast=int)
+LOCATION_STATIONARY_REPORT_INTERVAL_MS = config('LOCATION_STATIONARY_REPORT_INTERVAL_MS', default=50000, cast=int)
+# Bus ETAs to upcoming checkpoints are recomputed for the whole fleet this often.
+LOCATION_ETA_INTERVAL_SECONDS = config('LOCATION_ETA_INTERVAL_SECONDS', default=5, cast=int)
+# Buses within this many metres of a checkpoint have arrived at it.
+LOCATION_GEOFENCE_RADIUS_M = config('LOCATION_GEOFENCE_RADIUS_M', default=75, cast=int)
+# Latest fix per vehicle is written to the *RuntimeData tables this often.
+LOCATION_PERSIST_INTERVAL_SECONDS = config('LOCATION_PERSIST_INTERVAL_SECONDS', default=10, cast=int)
+# Every fix is appended to LocationHistory in batches this often.
+LOCATION_HISTORY_FLUSH_SECONDS = config('LOCATION_HISTORY_FLUSH_SECONDS', default=5, cast=int)
+# Checkpoint arrivals and departures are written in batches this often.
+LOCATION_CHECKPOINT_EVENT_FLUSH_SECONDS = config('LOCATION_CHECKPOINT_EVENT_FLUSH_SECONDS', default=5, cast=int)
+# Off-route alerts are raised and resolved in the database in batches this often.
+LOCATION_ALERT_FLUSH_SECONDS = config('LOCATION_ALERT_FLUSH_SECONDS', default=2, cast=int)
+# Each fleet socket buffers at most this many broadcast frames; on overflow
+# the backlog is replaced by a snapshot, and sockets that stay behind are closed.
+LOCATION_SEND_QUEUE_FRAMES = config('LOCATION_SEND_QUEUE_FRAMES', default=50, cast=int)
+LOCATION_MAX_SEND_LAG_SECONDS = config('LOCATION_MAX_SEND_LAG_SECONDS', default=10, cast=int)
+
 CORS_ALLOWED_ORIGINS = [
     "http://localhost:19006",  # React Native development server
     "http://192.168.29.6",     # Your current Django backend IP
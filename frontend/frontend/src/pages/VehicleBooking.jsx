@@ -17,6 +17,10 @@ import { GoogleMap, Marker, InfoWindow, Data } from "@react-google-maps/api";
 import { useNavigate, useLocation } from "react-router-dom";
 import axios from "axios";
 
+// Live fleet per service and area, kept across mounts so a remount resumes
+// from the last frames seen instead of downloading a fresh snapshot
+const fleetCache = new Map();
+
 const VehicleBooking = () => {
   const navigate = useNavigate();
   const location = useLocation();
@@ -154,33 +158,98 @@ const VehicleBooking = () => {
   }, []);
 
   // Fetch vehicle details from API
-  const fetchVehicleDetails = async (vehicleId) => {
-    try {
-      const endpoint = selectedService === 'car'
-        ? `http://127.0.0.1:8000/api/car/driver/${vehicleId}/`
-        : `http://127.0.0.1:8000/api/bike/driver/${vehicleId}/`;
-
-      const response = await axios.get(endpoint);
-      return response.data;
-    } catch (error) {
-      console.error('Error fetching vehicle details:', error);
-      return null;
-    }
-  };
-
   // WebSocket connection
   useEffect(() => {
     if (!userLocation) return;
 
     const WS_URL = 'ws://10.40.11.244:8000/ws/bike/';
-    const ws = new WebSocket(WS_URL);
+    // Signed-in riders connect with their access token
+    let accessToken = null;
+    try {
+      accessToken = JSON.parse(localStorage.getItem('tokens'))?.access;
+    } catch {
+      accessToken = null;
+    }
+    const ws = new WebSocket(
+      accessToken ? `${WS_URL}?token=${encodeURIComponent(accessToken)}` : WS_URL
+    );
+
+    // Live fleet kept client-side: the server sends a snapshot on subscribe
+    // and only changed vehicles afterwards. Each server worker numbers its
+    // frames separately per group, so the last seq is tracked per stream.
+    const cacheKey = `${selectedService}:${userLocation.lat},${userLocation.lng}`;
+    if (!fleetCache.has(cacheKey)) {
+      fleetCache.set(cacheKey, { fleet: new Map(), lastSeq: new Map() });
+    }
+    const { fleet, lastSeq } = fleetCache.get(cacheKey);
+    if (fleet.size) {
+      setLiveVehicles([...fleet.values()]);
+    }
+    const removeVehicles = (items = []) =>
+      items.forEach(item => fleet.delete(`${item.vehicle_type}:${item.id}`));
+
+    const applyFrame = (data) => {
+      if (data.mode === 'snapshot' || data.mode === 'extend') {
+        if (data.mode === 'snapshot') {
+          fleet.clear();
+          lastSeq.clear();
+        }
+        removeVehicles(data.removed);
+        Object.entries(data.seqs || {}).forEach(([group, seq]) =>
+          lastSeq.set(`${data.stream}/${group}`, seq));
+      } else {
+        const streamKey = `${data.stream}/${data.group}`;
+        const last = lastSeq.get(streamKey);
+        if (last !== undefined && data.seq <= last) {
+          return false;  // Already covered by the snapshot we hold
+        }
+        if (last !== undefined && data.prev_seq !== last) {
+          ws.send(JSON.stringify({ type: 'resync' }));
+          return false;
+        }
+        lastSeq.set(streamKey, data.seq);
+        removeVehicles(data.removed);
+      }
+      data.data.forEach(item => fleet.set(`${item.vehicle_type}:${item.id}`, item));
+      return true;
+    };
+
+    // The list of closest vehicles comes from the server; ask at most once
+    // per NEAREST_REFRESH_MS however often the fleet changes.
+    const NEAREST_REFRESH_MS = 2000;
+    let lastNearest = 0;
+    let nearestTimer = null;
+    const requestNearest = () => {
+      if (nearestTimer) return;
+      const wait = Math.max(0, lastNearest + NEAREST_REFRESH_MS - Date.now());
+      nearestTimer = setTimeout(() => {
+        nearestTimer = null;
+        lastNearest = Date.now();
+        if (ws.readyState !== WebSocket.OPEN) return;
+        ws.send(JSON.stringify({
+          type: 'nearest',
+          vehicle_type: selectedService,
+          subtype: vehicleType || undefined,
+          latitude: userLocation.lat,
+          longitude: userLocation.lng,
+          radius_km: 10,
+          k: 10
+        }));
+      }, wait);
+    };
 
     ws.onopen = () => {
       setConnectionStatus('connected');
       ws.send(JSON.stringify({
         type: 'subscribe',
         vehicle_type: selectedService,
-        update_interval: 2000
+        latitude: userLocation.lat,
+        longitude: userLocation.lng,
+        radius_km: 10,
+        update_interval: 2000,
+        // Catch up from the frames seen before; the server falls back to a
+        // snapshot when it can't
+        since: lastSeq.size ? Object.fromEntries(lastSeq) : undefined
       }));
     };
 
@@ -189,51 +258,35 @@ const VehicleBooking = () => {
         const data = JSON.parse(event.data);
         console.log(data)
 
-        if (data.type === 'batch_location_update' && Array.isArray(data.data)) {
-          // First filter by selected service type
-          const serviceVehicles = data.data.filter(item => item.vehicle_type === selectedService);
-          setLiveVehicles(serviceVehicles);
-
-          const vehiclesWithDetails = await Promise.all(
-            serviceVehicles.map(async (vehicle) => {
-              const details = await fetchVehicleDetails(vehicle.id);
-              const distance = calculateDistance(
-                userLocation.lat,
-                userLocation.lng,
-                vehicle.latitude,
-                vehicle.longitude
-              );
-
-              return {
-                user_id,
-                ...vehicle,
-                ...details,
-                toCity,
-                fromCity,
-                position: { lat: vehicle.latitude, lng: vehicle.longitude },
-                vehicleSubType: selectedService === 'car' ? details.car_type : details.bike_type,
-                distanceFromUser: distance,
-                isLive: true
-              };
-            })
-          );
-
-          // Filter by the vehicle type passed from RideNowUI
-          const filteredByType = vehicleType
-            ? vehiclesWithDetails.filter(v =>
-              selectedService === 'car'
-                ? v.car_type.toLowerCase() === vehicleType
-                : v.bike_type.toLowerCase() === vehicleType
-            )
-            : vehiclesWithDetails;
-
-          // Sort by distance
-          const sortedVehicles = [...filteredByType].sort((a, b) =>
-            a.distanceFromUser - b.distanceFromUser
-          );
-          console.log(sortedVehicles)
-          setVehicles(sortedVehicles);
+        if (data.type === 'nearest_vehicles') {
+          // Vehicle details (type, plate, seating) arrive with each vehicle
+          const vehiclesWithDetails = data.data.map((vehicle) => {
+            const details = vehicle.vehicle || {};
+            return {
+              user_id,
+              ...vehicle,
+              ...details,
+              toCity,
+              fromCity,
+              position: { lat: vehicle.latitude, lng: vehicle.longitude },
+              vehicleSubType: selectedService === 'car' ? details.car_type : details.bike_type,
+              distanceFromUser: vehicle.distance_km,
+              isLive: true
+            };
+          });
+          // Already filtered by subtype and sorted by distance on the server
+          setVehicles(vehiclesWithDetails);
           setLoading(false);
+          return;
+        }
+
+        const changed = data.type === 'vehicle_offline'
+          ? (removeVehicles(data.data), true)
+          : data.type === 'batch_location_update' && Array.isArray(data.data) && applyFrame(data);
+        if (changed) {
+          // The server only sends the subscribed service type
+          setLiveVehicles([...fleet.values()]);
+          requestNearest();
         }
       } catch (error) {
         console.error('Error processing WebSocket message:', error);
@@ -249,7 +302,10 @@ const VehicleBooking = () => {
       setConnectionStatus('disconnected');
     };
 
-    return () => ws.close();
+    return () => {
+      clearTimeout(nearestTimer);
+      ws.close();
+    };
   }, [selectedService, userLocation, vehicleType]);
 
   // Calculate ETA
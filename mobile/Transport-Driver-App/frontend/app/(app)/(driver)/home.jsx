@@ -19,6 +19,22 @@ import {
 import MapView, { Marker, Polyline } from 'react-native-maps';
 import API_CONFIG, { getApiUrl, getWsUrl } from '../../../constants/ApiConfig';
 
+// How often the app reads GPS; also the reporting interval while moving
+const LOCATION_POLL_MS = 5000;
+// Fixes kept while offline, oldest dropped first
+const MAX_BUFFERED_FIXES = 2000;
+// Once the socket has given up, buffered fixes go over HTTP this many at a time
+const HTTP_UPLOAD_MIN_FIXES = 12;
+
+const distanceMeters = (a, b) => {
+  const toRad = (deg) => (deg * Math.PI) / 180;
+  const dLat = toRad(b.latitude - a.latitude);
+  const dLng = toRad(b.longitude - a.longitude);
+  const h = Math.sin(dLat / 2) ** 2 +
+    Math.cos(toRad(a.latitude)) * Math.cos(toRad(b.latitude)) * Math.sin(dLng / 2) ** 2;
+  return 2 * 6371000 * Math.asin(Math.sqrt(h));
+};
+
 const DriverHome = ({ navigation }) => {
   // State variables
   const [activeTab, setActiveTab] = useState('home');
@@ -250,32 +266,23 @@ const DriverHome = ({ navigation }) => {
     }
   };
 
-  // Get address from coordinates
-  const getAddressFromCoords = async (latitude, longitude) => {
-    try {
-      const reverseGeocode = await Location.reverseGeocodeAsync({ latitude, longitude });
-      if (reverseGeocode.length > 0) {
-        const firstResult = reverseGeocode[0];
-        const addressParts = [
-          firstResult.street,
-          firstResult.city,
-          firstResult.region,
-          firstResult.postalCode,
-          firstResult.country
-        ].filter(Boolean);
-        return addressParts.join(', ');
-      }
-      return "Unknown location";
-    } catch (error) {
-      console.error("Reverse geocode error:", error);
-      return "Could not get address";
-    }
-  };
-
   // WebSocket and location tracking
   useEffect(() => {
     let ws;
     let locationInterval;
+    // Reporting rate the server asks for; starts at the moving rate
+    let reportIntervalMs = LOCATION_POLL_MS;
+    let minDistanceM = null;
+    let lastSent = null;
+    // Last fleet frame seq seen per stream/group, so a reconnect resumes
+    // from there instead of pulling a full snapshot
+    const lastSeq = {};
+    // Fixes taken while the socket was down, uploaded as one batch later;
+    // dropped only once the server acknowledges them
+    const bufferedFixes = [];
+    let batchCounter = 0;
+    let batchInFlight = null;
+    let socketGaveUp = false;
     let reconnectAttempts = 0;
     const maxReconnectAttempts = 5;
     const reconnectDelay = 3000;
@@ -285,8 +292,10 @@ const DriverHome = ({ navigation }) => {
         const driverId = await AsyncStorage.getItem('user_id');
         if (!driverId || !vehicleData?.vehicle_type) return;
 
+        // The server only accepts fixes from the driver the token belongs to
+        const accessToken = await AsyncStorage.getItem('access_token');
         const wsUrl = getWsUrl(API_CONFIG.ENDPOINTS.WEBSOCKET.BIKE);
-        ws = new WebSocket(wsUrl);
+        ws = new WebSocket(`${wsUrl}?token=${encodeURIComponent(accessToken || '')}`);
         setConnectionStatus('connecting');
 
         ws.onopen = () => {
@@ -295,14 +304,18 @@ const DriverHome = ({ navigation }) => {
           setIsTracking(true);
           setConnectionStatus('connected');
           reconnectAttempts = 0;
+          socketGaveUp = false;
+          batchInFlight = null;
 
           ws.send(JSON.stringify({
             action: 'subscribe',
             driver_id: driverId,
-            vehicle_type: vehicleData.vehicle_type
+            vehicle_type: vehicleData.vehicle_type,
+            since: Object.keys(lastSeq).length ? lastSeq : undefined
           }));
 
           startLocationUpdates(ws, driverId);
+          sendBufferedFixes(ws, driverId);
         };
 
         ws.onmessage = (e) => {
@@ -314,6 +327,29 @@ const DriverHome = ({ navigation }) => {
               case 'connection_established':
                 console.log('🔌 Connection confirmed:', data.message);
                 break;
+              case 'batch_location_update':
+                if (data.mode === 'delta') {
+                  lastSeq[`${data.stream}/${data.group}`] = data.seq;
+                } else {
+                  if (data.mode === 'snapshot') {
+                    Object.keys(lastSeq).forEach((key) => delete lastSeq[key]);
+                  }
+                  Object.entries(data.seqs || {}).forEach(([group, seq]) => {
+                    lastSeq[`${data.stream}/${group}`] = seq;
+                  });
+                }
+                break;
+              case 'fixes_ack':
+                if (batchInFlight && data.batch === batchInFlight.batch) {
+                  bufferedFixes.splice(0, batchInFlight.count);
+                  batchInFlight = null;
+                }
+                break;
+              case 'reporting_rate':
+                console.log(`⏱️ Reporting every ${data.interval_ms}ms (${data.mode})`);
+                reportIntervalMs = data.interval_ms;
+                minDistanceM = data.min_distance_m;
+                break;
               case 'location_update':
                 console.log('📍 Location update:', data.data);
                 setLiveLocations(prev => [...prev, data.data].slice(-50));
@@ -349,33 +385,96 @@ const DriverHome = ({ navigation }) => {
       }
     };
 
+    const bufferFix = (fix) => {
+      bufferedFixes.push(fix);
+      if (bufferedFixes.length > MAX_BUFFERED_FIXES) {
+        bufferedFixes.splice(0, bufferedFixes.length - MAX_BUFFERED_FIXES);
+      }
+    };
+
+    const nextBatch = (driverId) => {
+      batchCounter++;
+      batchInFlight = { batch: batchCounter, count: bufferedFixes.length };
+      return {
+        id: driverId,
+        vehicle_type: vehicleData.vehicle_type,
+        batch: batchCounter,
+        fixes: bufferedFixes.slice(),
+      };
+    };
+
+    // One message for everything taken while offline
+    const sendBufferedFixes = (wsConnection, driverId) => {
+      if (!bufferedFixes.length || batchInFlight) return;
+      const batch = nextBatch(driverId);
+      console.log(`📦 Sending ${batch.fixes.length} buffered fixes`);
+      wsConnection.send(JSON.stringify({ type: 'fixes', ...batch }));
+    };
+
+    // HTTP fallback for when the socket can't be brought back
+    const uploadBufferedFixes = async (driverId) => {
+      if (bufferedFixes.length < HTTP_UPLOAD_MIN_FIXES || batchInFlight) return;
+      const batch = nextBatch(driverId);
+      try {
+        const accessToken = await AsyncStorage.getItem('access_token');
+        await axios.post(getApiUrl(API_CONFIG.ENDPOINTS.FIXES), batch, {
+          headers: { Authorization: `Bearer ${accessToken}` },
+        });
+        bufferedFixes.splice(0, batch.fixes.length);
+      } catch (error) {
+        console.log('❌ Fix upload error:', error.message);
+      } finally {
+        batchInFlight = null;
+      }
+    };
+
     const startLocationUpdates = async (wsConnection, driverId) => {
       if (locationInterval) clearInterval(locationInterval);
+      reportIntervalMs = LOCATION_POLL_MS;
+      minDistanceM = null;
+      lastSent = null;
 
       locationInterval = setInterval(async () => {
-        if (wsConnection.readyState === WebSocket.OPEN) {
-          try {
-            const location = await Location.getCurrentPositionAsync({});
-            const address = await getAddressFromCoords(
-              location.coords.latitude,
-              location.coords.longitude
-            );
-
-            const message = {
-              id: driverId,
-              vehicle_type: vehicleData.vehicle_type,
-              latitude: location.coords.latitude,
-              longitude: location.coords.longitude,
-              address: address,
-            };
+        try {
+          const location = await Location.getCurrentPositionAsync({});
+          const { latitude, longitude } = location.coords;
+          // While parked, only send once the slow interval is up or the
+          // vehicle has moved off, so the server sees it start right away
+          const now = Date.now();
+          if (
+            lastSent &&
+            now - lastSent.at < reportIntervalMs - LOCATION_POLL_MS / 2 &&
+            !(minDistanceM && distanceMeters(lastSent, { latitude, longitude }) >= minDistanceM)
+          ) {
+            return;
+          }
+          lastSent = { latitude, longitude, at: now };
 
-            console.log('📤 Sending location:', message);
-            wsConnection.send(JSON.stringify(message));
-          } catch (error) {
-            console.log('❌ Location error:', error);
+          if (wsConnection.readyState !== WebSocket.OPEN || bufferedFixes.length) {
+            // Keep the fix so the history has no hole where the signal dropped
+            bufferFix({ latitude, longitude, recorded_at: now / 1000 });
+            if (wsConnection.readyState === WebSocket.OPEN) {
+              sendBufferedFixes(wsConnection, driverId);
+            } else if (socketGaveUp) {
+              await uploadBufferedFixes(driverId);
+            }
+            return;
           }
+
+          // The server labels fixes with the nearest known place itself
+          const message = {
+            id: driverId,
+            vehicle_type: vehicleData.vehicle_type,
+            latitude,
+            longitude,
+          };
+
+          console.log('📤 Sending location:', message);
+          wsConnection.send(JSON.stringify(message));
+        } catch (error) {
+          console.log('❌ Location error:', error);
         }
-      }, 5000);
+      }, LOCATION_POLL_MS);
     };
 
     const handleReconnect = () => {
@@ -385,6 +484,7 @@ const DriverHome = ({ navigation }) => {
         setTimeout(connectWebSocket, reconnectDelay);
       } else {
         console.log('⏹️ Max reconnection attempts reached');
+        socketGaveUp = true;
         setIsTracking(false);
       }
     };
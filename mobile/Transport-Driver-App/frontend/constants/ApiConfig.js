@@ -22,6 +22,8 @@ const API_CONFIG = {
       CAR: (driverId) => `/api/car/driver/${driverId}/`,
       BIKE: (driverId) => `/api/bike/driver/${driverId}/`
     },
+    // Batched fix upload when the socket is unavailable
+    FIXES: '/api/fixes/',
     WEBSOCKET: {
       BIKE: '/ws/bike/'
     }